@@ -0,0 +1,4 @@
+from dotenv import load_dotenv
+
+# Load env vars from .env when running locally (before any submodule reads its config)
+load_dotenv()
@@ -0,0 +1,227 @@
+"""Static and SPA asset serving: precompressed variants, strong ETags, cache policy.
+
+The built frontend (``STATIC_DIR``, default ``static``) is indexed once at startup.
+Each file gets a strong ETag from its content hash, and ``.br`` / ``.gz`` siblings
+written at image build time (``python -m app.assets --precompress static``) are
+served to clients whose Accept-Encoding allows them. The workers never compress
+per request. ``If-None-Match`` revalidation answers 304 without a body.
+
+Cache-Control:
+- Vite's content-hashed bundles (``assets/<name>-<hash>.<ext>``) never change
+  under the same URL: a year, immutable.
+- ``index.html`` must be revalidated on every load (``no-cache``). It is held in
+  memory with its compressed variants and served on the SPA routes.
+- Everything else (the images from frontend/public) is cached for
+  ``STATIC_MAX_AGE`` seconds, then revalidated by ETag.
+
+Brotli variants need the ``brotli`` package at build time only; without it the
+tool writes gzip alone.
+"""
+import argparse
+import gzip
+import hashlib
+import logging
+import mimetypes
+import os
+import re
+from typing import Dict, Mapping, NamedTuple, Optional, Tuple
+
+from starlette.responses import FileResponse, PlainTextResponse, Response
+
+logger = logging.getLogger(__name__)
+
+static_dir = os.getenv("STATIC_DIR", "static")
+try:
+    max_age = max(0, int(os.getenv("STATIC_MAX_AGE", "3600")))
+except Exception:
+    max_age = 3600
+
+IMMUTABLE = "public, max-age=31536000, immutable"
+INDEX = "index.html"
+# Preference order when the client accepts several
+ENCODINGS = (("br", ".br"), ("gzip", ".gz"))
+COMPRESSIBLE = (".html", ".js", ".mjs", ".css", ".svg", ".json", ".map", ".txt", ".xml", ".ico", ".wasm",
+                ".webmanifest")
+_HASHED = re.compile(r"^assets/.+-[A-Za-z0-9_-]{8,}\.[A-Za-z0-9]+$")
+_CHUNK = 1024 * 1024
+
+mimetypes.add_type("text/javascript", ".js")
+mimetypes.add_type("text/javascript", ".mjs")
+mimetypes.add_type("application/manifest+json", ".webmanifest")
+
+
+class Asset(NamedTuple):
+    path: str
+    media_type: str
+    digest: str
+    cache_control: str
+    encodings: Dict[str, str]  # content-coding -> precompressed file ("" when only in memory)
+
+    def etag(self, encoding: Optional[str]) -> str:
+        # Each representation needs its own strong validator
+        return f'"{self.digest}-{encoding}"' if encoding else f'"{self.digest}"'
+
+
+def _digest(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as fh:
+        for chunk in iter(lambda: fh.read(_CHUNK), b""):
+            h.update(chunk)
+    return h.hexdigest()[:20]
+
+
+def cache_control(name: str) -> str:
+    if name == INDEX:
+        return "no-cache"
+    if _HASHED.match(name):
+        return IMMUTABLE
+    return f"public, max-age={max_age}"
+
+
+def negotiate(accept_encoding: str, available: Mapping[str, str]) -> Optional[str]:
+    """The preferred precompressed coding the client accepts, or None for identity."""
+    if not available or not accept_encoding:
+        return None
+    accepted = {}
+    for item in accept_encoding.split(","):
+        coding, _, params = item.strip().partition(";")
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        accepted[coding.strip().lower()] = q
+    for coding, _ in ENCODINGS:
+        if coding in available and accepted.get(coding, accepted.get("*", 0.0)) > 0:
+            return coding
+    return None
+
+
+def _not_modified(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    # Weak comparison, as If-None-Match specifies
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if (tag[2:] if tag.startswith("W/") else tag) == etag:
+            return True
+    return False
+
+
+class AssetFiles:
+    """Index of a built static directory; ``response()`` serves one file from it."""
+
+    def __init__(self, directory: str, memory: Tuple[str, ...] = (INDEX,)) -> None:
+        self.directory = directory
+        self._assets: Dict[str, Asset] = {}
+        self._bodies: Dict[Tuple[str, Optional[str]], bytes] = {}
+        if os.path.isdir(directory):
+            self._scan()
+            for name in memory:
+                self._hold(name)
+
+    def _scan(self) -> None:
+        suffixes = tuple(ext for _, ext in ENCODINGS)
+        for root, _, files in os.walk(self.directory):
+            for fname in files:
+                if fname.endswith(suffixes):
+                    continue
+                path = os.path.join(root, fname)
+                name = os.path.relpath(path, self.directory).replace(os.sep, "/")
+                encodings = {coding: path + ext for coding, ext in ENCODINGS if os.path.isfile(path + ext)}
+                self._assets[name] = Asset(
+                    path=path,
+                    media_type=mimetypes.guess_type(fname)[0] or "application/octet-stream",
+                    digest=_digest(path),
+                    cache_control=cache_control(name),
+                    encodings=encodings,
+                )
+
+    def _hold(self, name: str) -> None:
+        asset = self._assets.get(name)
+        if asset is None:
+            return
+        with open(asset.path, "rb") as fh:
+            body = fh.read()
+        self._bodies[(name, None)] = body
+        for coding, path in asset.encodings.items():
+            with open(path, "rb") as fh:
+                self._bodies[(name, coding)] = fh.read()
+        if "gzip" not in asset.encodings:
+            # Not precompressed: small enough to do once here
+            self._bodies[(name, "gzip")] = gzip.compress(body, 9, mtime=0)
+            asset.encodings["gzip"] = ""
+
+    def response(self, name: str, headers: Mapping[str, str]) -> Response:
+        """Response for GET/HEAD of ``name`` (path relative to the directory) given the request headers."""
+        asset = self._assets.get(name)
+        if asset is None:
+            return PlainTextResponse("Not Found", status_code=404)
+        coding = negotiate(headers.get("accept-encoding", ""), asset.encodings)
+        etag = asset.etag(coding)
+        out = {"etag": etag, "cache-control": asset.cache_control}
+        if asset.encodings:
+            out["vary"] = "Accept-Encoding"
+        if coding:
+            out["content-encoding"] = coding
+        if _not_modified(headers.get("if-none-match"), etag):
+            return Response(status_code=304, headers=out)
+        body = self._bodies.get((name, coding))
+        if body is not None:
+            return Response(body, media_type=asset.media_type, headers=out)
+        return FileResponse(asset.encodings[coding] if coding else asset.path, media_type=asset.media_type, headers=out)
+
+
+def precompress(directory: str, min_bytes: int = 1024, min_saving: float = 0.1) -> Dict[str, int]:
+    """Write ``.gz`` (and ``.br`` with the brotli package) next to every compressible file,
+    keeping only variants at least ``min_saving`` smaller. Run at image build time.
+    """
+    try:
+        import brotli
+    except ImportError:
+        brotli = None
+        logger.warning("brotli not installed: writing gzip variants only")
+    totals = {"files": 0, "bytes": 0, "gzip_bytes": 0, "br_bytes": 0}
+    for root, _, files in os.walk(directory):
+        for fname in files:
+            if not fname.endswith(COMPRESSIBLE):
+                continue
+            path = os.path.join(root, fname)
+            with open(path, "rb") as fh:
+                body = fh.read()
+            if len(body) < min_bytes:
+                continue
+            totals["files"] += 1
+            totals["bytes"] += len(body)
+            variants = [("gzip", ".gz", gzip.compress(body, 9, mtime=0))]
+            if brotli is not None:
+                variants.append(("br", ".br", brotli.compress(body, quality=11)))
+            for coding, ext, data in variants:
+                if len(data) <= len(body) * (1.0 - min_saving):
+                    with open(path + ext, "wb") as fh:
+                        fh.write(data)
+                    totals[f"{coding}_bytes"] += len(data)
+                elif os.path.exists(path + ext):
+                    os.remove(path + ext)
+    return totals
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Static asset build steps")
+    parser.add_argument("--precompress", metavar="DIR", help="write .br/.gz variants of compressible files in DIR")
+    parser.add_argument("--min-bytes", type=int, default=1024, help="leave smaller files uncompressed")
+    args = parser.parse_args()
+    if not args.precompress:
+        parser.error("nothing to do (use --precompress DIR)")
+    logging.basicConfig(level=logging.INFO)
+    totals = precompress(args.precompress, args.min_bytes)
+    print(f"{totals['files']} files, {totals['bytes'] / 1024:.0f} KB: gzip {totals['gzip_bytes'] / 1024:.0f} KB, "
+          f"br {totals['br_bytes'] / 1024:.0f} KB")
+
+
+if __name__ == "__main__":
+    main()
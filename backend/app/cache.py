@@ -0,0 +1,230 @@
+"""Content-addressed byte caches.
+
+``ByteCache`` is a two-tier cache for immutable byte blobs: an in-memory LRU with a
+byte budget, optionally backed by a directory on disk that survives restarts. Keys
+are hex digests derived from the content plus whatever parameters influenced the
+cached value (see ``content_key``), so a hit is always safe to reuse. With ``ttl``
+set, entries also expire that many seconds after they were stored (disk entries
+then carry their expiry in an 8-byte header).
+"""
+import asyncio
+import hashlib
+import logging
+import os
+import struct
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Iterator, Optional
+
+from . import metrics
+from .executor import io_pool
+
+logger = logging.getLogger(__name__)
+
+
+def content_key(data: bytes, *params: Any) -> str:
+    """sha256 of ``data`` combined with the parameters that shaped the derived value."""
+    h = hashlib.sha256(data)
+    for p in params:
+        h.update(b"\0")
+        h.update(str(p).encode("utf-8"))
+    return h.hexdigest()
+
+
+_EXPIRY = struct.Struct("<d")
+
+
+class _DiskTier:
+    def __init__(self, directory: str, max_bytes: int, ttl: float = 0.0) -> None:
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._total = sum(
+            os.path.getsize(os.path.join(directory, f)) for f in os.listdir(directory) if f.endswith(".bin")
+        )
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key + ".bin")
+
+    def get(self, key: str) -> Optional[bytes]:
+        path = self._path(key)
+        try:
+            with open(path, "rb") as fh:
+                data = fh.read()
+        except OSError:
+            return None
+        if self.ttl:
+            if len(data) < _EXPIRY.size or _EXPIRY.unpack_from(data)[0] < time.time():
+                self._remove(path, len(data))
+                return None
+            data = data[_EXPIRY.size:]
+        try:
+            os.utime(path)  # mtime doubles as LRU recency
+        except OSError:
+            pass
+        return data
+
+    def _remove(self, path: str, size: int) -> None:
+        try:
+            os.remove(path)
+        except OSError:
+            return
+        with self._lock:
+            self._total -= size
+
+    def put(self, key: str, value: bytes) -> int:
+        """Store ``value``; returns the number of files evicted to stay within budget."""
+        path = self._path(key)
+        if os.path.exists(path) and not self.ttl:
+            return 0
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "wb") as fh:
+            if self.ttl:
+                fh.write(_EXPIRY.pack(time.time() + self.ttl))
+            fh.write(value)
+        os.replace(tmp, path)
+        with self._lock:
+            self._total += len(value) + (_EXPIRY.size if self.ttl else 0)
+            if self._total <= self.max_bytes:
+                return 0
+            return self._evict()
+
+    def _evict(self) -> int:
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".bin"):
+                continue
+            full = os.path.join(self.directory, name)
+            try:
+                st = os.stat(full)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, full))
+        entries.sort()
+        self._total = sum(e[1] for e in entries)
+        evicted = 0
+        target = int(self.max_bytes * 0.9)
+        for _, size, full in entries:
+            if self._total <= target:
+                break
+            try:
+                os.remove(full)
+            except OSError:
+                continue
+            self._total -= size
+            evicted += 1
+        return evicted
+
+
+class ByteCache:
+    def __init__(
+        self, name: str, max_bytes: int, disk_dir: Optional[str] = None, disk_max_bytes: int = 0, ttl: float = 0.0
+    ) -> None:
+        self.name = name
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._items: "OrderedDict[str, bytes]" = OrderedDict()
+        self._expires: Dict[str, float] = {}  # only populated with a ttl
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._counters = {"hits": 0, "misses": 0, "evictions": 0, "expired": 0, "disk_hits": 0, "disk_evictions": 0}
+        self._disk: Optional[_DiskTier] = None
+        if disk_dir:
+            try:
+                self._disk = _DiskTier(disk_dir, disk_max_bytes, ttl)
+            except OSError as err:
+                logger.warning("%s cache: disk tier disabled (%s)", name, err)
+        metrics.add_collector(self._metric_samples)
+
+    def _count(self, counter: str, n: int = 1) -> None:
+        with self._lock:
+            self._counters[counter] += n
+
+    def _get_memory(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            value = self._items.get(key)
+            if value is None:
+                return None
+            if self.ttl and self._expires.get(key, 0.0) < time.monotonic():
+                del self._items[key]
+                self._expires.pop(key, None)
+                self._bytes -= len(value)
+                self._counters["expired"] += 1
+                return None
+            self._items.move_to_end(key)
+            return value
+
+    def _put_memory(self, key: str, value: bytes) -> None:
+        size = len(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self._bytes -= len(old)
+            self._items[key] = value
+            self._bytes += size
+            if self.ttl:
+                self._expires[key] = time.monotonic() + self.ttl
+            while self._bytes > self.max_bytes:
+                old_key, evicted = self._items.popitem(last=False)
+                self._expires.pop(old_key, None)
+                self._bytes -= len(evicted)
+                self._counters["evictions"] += 1
+
+    def get(self, key: str) -> Optional[bytes]:
+        """Blocking lookup (memory, then disk). Prefer ``aget`` on the event loop."""
+        value = self._get_memory(key)
+        if value is None and self._disk is not None:
+            value = self._disk.get(key)
+            if value is not None:
+                self._count("disk_hits")
+                self._put_memory(key, value)
+        self._count("hits" if value is not None else "misses")
+        return value
+
+    def put(self, key: str, value: bytes) -> None:
+        self._put_memory(key, value)
+        if self._disk is not None:
+            try:
+                self._count("disk_evictions", self._disk.put(key, value))
+            except OSError as err:
+                logger.warning("%s cache: disk write failed (%s)", self.name, err)
+
+    async def aget(self, key: str) -> Optional[bytes]:
+        value = self._get_memory(key)
+        if value is not None:
+            self._count("hits")
+            return value
+        if self._disk is None:
+            self._count("misses")
+            return None
+        return await asyncio.get_running_loop().run_in_executor(io_pool, self.get, key)
+
+    async def aput(self, key: str, value: bytes) -> None:
+        if self._disk is None:
+            self._put_memory(key, value)
+            return
+        await asyncio.get_running_loop().run_in_executor(io_pool, self.put, key, value)
+
+    def _metric_samples(self) -> Iterator[metrics.Sample]:
+        with self._lock:
+            counters = dict(self._counters)
+            size = self._bytes
+        for event, n in counters.items():
+            yield "tryon_cache_events_total", "counter", "Cache lookups and evictions", {"cache": self.name, "event": event}, n
+        yield "tryon_cache_bytes", "gauge", "Bytes held in the memory tier", {"cache": self.name}, size
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                **self._counters,
+                "entries": len(self._items),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "disk": self._disk.directory if self._disk is not None else None,
+            }
@@ -0,0 +1,194 @@
+"""Pre-registered garment catalog.
+
+A garment is ingested once: decoded, downscaled, background-removed and encoded to
+PNG + base64, then addressed by an ID derived from its content (so re-registering
+the same file is a no-op). Try-on requests can then pass ``clothing_id`` and only
+the user image is processed per request.
+
+With ``CATALOG_DIR`` set, cut-outs are persisted as ``<id>.png`` and loaded lazily,
+and at most ``CATALOG_CACHE_MB`` of them stay loaded. Point every worker (and
+every ``app.serve`` process) at the same directory so IDs resolve everywhere.
+
+Without it, the catalog lives in the memory of one worker process: an ID is only
+known to the worker that registered it (a pre-forked ``app.serve`` with several
+workers answers 404 for it on the others), and nothing can be evicted, so
+registrations are refused with ``CatalogFull`` once ``CATALOG_CACHE_MB`` is held.
+
+Bulk ingestion of a whole catalog directory (run offline, e.g. at deploy time):
+
+    cd backend && CATALOG_DIR=/data/catalog python -m app.catalog ./garments --workers 4
+"""
+import argparse
+import asyncio
+import base64
+import io
+import json
+import os
+import sys
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Dict, Optional
+
+from PIL import Image
+
+from . import preprocess
+from .executor import io_pool
+
+_IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".webp", ".bmp")
+
+
+@dataclass(frozen=True)
+class Garment:
+    id: str
+    png: bytes
+    b64: str
+    width: int
+    height: int
+
+    @property
+    def nbytes(self) -> int:
+        return len(self.png) + len(self.b64)
+
+
+class CatalogFull(Exception):
+    """A memory-only catalog holds ``max_loaded_bytes`` and cannot evict to make room."""
+
+
+def _make_garment(garment_id: str, png: bytes) -> Garment:
+    with Image.open(io.BytesIO(png)) as img:
+        width, height = img.size
+    return Garment(garment_id, png, base64.b64encode(png).decode("utf-8"), width, height)
+
+
+class GarmentCatalog:
+    def __init__(self, directory: Optional[str] = None, max_loaded_bytes: int = 256 * 1024 * 1024) -> None:
+        self.directory = directory
+        self.max_loaded_bytes = max_loaded_bytes
+        self._loaded: "OrderedDict[str, Garment]" = OrderedDict()
+        self._loaded_bytes = 0
+        self._lock = threading.Lock()
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def garment_id(raw: bytes) -> str:
+        return "g_" + preprocess.cutout_key(raw, "garment")[:24]
+
+    def _path(self, garment_id: str) -> Optional[str]:
+        if not self.directory or not garment_id.startswith("g_") or not garment_id[2:].isalnum():
+            return None
+        return os.path.join(self.directory, garment_id + ".png")
+
+    def _full(self, extra: int = 0) -> bool:
+        return not self.directory and self._loaded_bytes + extra > self.max_loaded_bytes
+
+    def _remember(self, garment: Garment, new: bool = False) -> None:
+        with self._lock:
+            if garment.id in self._loaded:
+                self._loaded.move_to_end(garment.id)
+                return
+            if new and self._full(garment.nbytes):
+                raise CatalogFull()
+            self._loaded[garment.id] = garment
+            self._loaded_bytes += garment.nbytes
+            # Only garments that can be reloaded from disk are evictable
+            while self.directory and self._loaded_bytes > self.max_loaded_bytes and len(self._loaded) > 1:
+                _, old = self._loaded.popitem(last=False)
+                self._loaded_bytes -= old.nbytes
+
+    def get(self, garment_id: str) -> Optional[Garment]:
+        """Blocking lookup (may read from disk). Prefer ``aget`` on the event loop."""
+        with self._lock:
+            garment = self._loaded.get(garment_id)
+            if garment is not None:
+                self._loaded.move_to_end(garment_id)
+                return garment
+        path = self._path(garment_id)
+        if path is None or not os.path.exists(path):
+            return None
+        with open(path, "rb") as fh:
+            garment = _make_garment(garment_id, fh.read())
+        self._remember(garment)
+        return garment
+
+    async def aget(self, garment_id: str) -> Optional[Garment]:
+        with self._lock:
+            garment = self._loaded.get(garment_id)
+        if garment is not None:
+            return garment
+        return await asyncio.get_running_loop().run_in_executor(io_pool, self.get, garment_id)
+
+    def register(self, raw: bytes) -> Garment:
+        """Ingest a garment image (blocking, CPU heavy). Raises on undecodable input, and
+        CatalogFull when a memory-only catalog has no room left.
+        """
+        garment_id = self.garment_id(raw)
+        existing = self.get(garment_id)
+        if existing is not None:
+            return existing
+        if self._full():
+            raise CatalogFull()  # before the cut-out work
+        garment = _make_garment(garment_id, preprocess.cutout_png_sync(raw))
+        path = self._path(garment_id)
+        if path is not None:
+            tmp = path + ".tmp"
+            with open(tmp, "wb") as fh:
+                fh.write(garment.png)
+            os.replace(tmp, path)
+        self._remember(garment, new=True)
+        return garment
+
+    def __len__(self) -> int:
+        if self.directory:
+            return sum(1 for f in os.listdir(self.directory) if f.startswith("g_") and f.endswith(".png"))
+        return len(self._loaded)
+
+
+def ingest_directory(catalog: GarmentCatalog, directory: str, workers: int) -> Dict[str, Optional[str]]:
+    """Register every image under ``directory`` on a worker pool.
+    Returns a manifest of relative path -> garment ID (None for files that failed).
+    """
+    paths = []
+    for root, _, files in os.walk(directory):
+        for name in sorted(files):
+            if name.lower().endswith(_IMAGE_EXTENSIONS):
+                paths.append(os.path.join(root, name))
+
+    def ingest(path: str) -> Optional[str]:
+        try:
+            with open(path, "rb") as fh:
+                return catalog.register(fh.read()).id
+        except Exception as err:
+            print(f"skip {path}: {err}", file=sys.stderr)
+            return None
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="catalog-ingest") as pool:
+        ids = list(pool.map(ingest, paths))
+    return {os.path.relpath(p, directory): gid for p, gid in zip(paths, ids)}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Bulk-ingest a directory of garment images into the catalog")
+    parser.add_argument("directory", help="directory of garment images (searched recursively)")
+    parser.add_argument("--catalog-dir", default=os.getenv("CATALOG_DIR"), help="output catalog (default: $CATALOG_DIR)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 2, help="ingestion worker threads")
+    parser.add_argument("--manifest", help="write the path -> garment ID manifest to this JSON file")
+    args = parser.parse_args()
+    if not args.catalog_dir:
+        parser.error("--catalog-dir or CATALOG_DIR is required")
+
+    manifest = ingest_directory(GarmentCatalog(args.catalog_dir), args.directory, max(1, args.workers))
+    out = json.dumps(manifest, indent=2)
+    if args.manifest:
+        with open(args.manifest, "w") as fh:
+            fh.write(out)
+    else:
+        print(out)
+    failed = sum(1 for gid in manifest.values() if gid is None)
+    print(f"ingested {len(manifest) - failed}/{len(manifest)} garments into {args.catalog_dir}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
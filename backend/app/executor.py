@@ -0,0 +1,97 @@
+"""Execution model for the try-on pipeline.
+
+Blocking work never runs on the asyncio event loop. CPU-bound stages (PIL decode,
+rembg/onnxruntime, OpenCV post-processing, Gemini payload encoding) run on a bounded thread pool: those
+libraries release the GIL inside their native kernels, so threads give real
+parallelism without having to pickle the ONNX session into subprocesses. Blocking
+I/O gets a separate pool so a slow disk or upstream can never starve CPU work;
+Gemini itself is called through an async client and only uses the stage limit.
+
+On top of the pools every stage has its own concurrency limit (an asyncio
+semaphore), so excess requests queue cheaply on the event loop instead of piling
+up inside a worker thread. Limits are configurable via ``<STAGE>_CONCURRENCY``.
+"""
+import asyncio
+import contextvars
+import functools
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Tuple, TypeVar
+
+from . import metrics
+
+T = TypeVar("T")
+
+
+def _env_int(name: str, default: int, lo: int, hi: int) -> int:
+    try:
+        return max(lo, min(hi, int(os.getenv(name, str(default)))))
+    except Exception:
+        return default
+
+
+_cpu_workers = _env_int("CPU_WORKERS", os.cpu_count() or 2, 1, 64)
+_io_workers = _env_int("IO_WORKERS", 16, 1, 256)
+# onnxruntime sessions per rembg model (see app.sessions). More rembg calls than sessions
+# would only block pool threads waiting for one, so the rembg stage defaults to this
+rembg_sessions = _env_int("REMBG_SESSIONS", 2, 1, 64)
+
+# stage name -> (pool kind, max requests inside the stage at once)
+STAGES: Dict[str, Tuple[str, int]] = {
+    "decode": ("cpu", _env_int("DECODE_CONCURRENCY", _cpu_workers, 1, 256)),
+    "rembg": ("cpu", _env_int("REMBG_CONCURRENCY", min(_cpu_workers, rembg_sessions), 1, 256)),
+    "postprocess": ("cpu", _env_int("POSTPROCESS_CONCURRENCY", _cpu_workers, 1, 256)),
+    # Gemini payloads: inline image transcode, base64 and JSON bodies, response parsing, hashing
+    "encode": ("cpu", _env_int("ENCODE_CONCURRENCY", _cpu_workers, 1, 256)),
+    "gemini": ("io", _env_int("GEMINI_CONCURRENCY", _io_workers, 1, 256)),
+}
+
+cpu_pool = ThreadPoolExecutor(max_workers=_cpu_workers, thread_name_prefix="tryon-cpu")
+io_pool = ThreadPoolExecutor(max_workers=_io_workers, thread_name_prefix="tryon-io")
+
+# Semaphores are bound to the loop that first awaits them, so create them lazily
+_semaphores: Dict[str, Tuple[asyncio.AbstractEventLoop, asyncio.Semaphore]] = {}
+
+
+def _stage_semaphore(stage: str) -> asyncio.Semaphore:
+    loop = asyncio.get_running_loop()
+    entry = _semaphores.get(stage)
+    if entry is None or entry[0] is not loop:
+        entry = (loop, asyncio.Semaphore(STAGES[stage][1]))
+        _semaphores[stage] = entry
+    return entry[1]
+
+
+def limit(stage: str) -> asyncio.Semaphore:
+    """Concurrency limit for ``stage``; use as ``async with limit(stage):`` around async work."""
+    return _stage_semaphore(stage)
+
+
+async def run_stage(stage: str, fn: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+    """Run a blocking callable for ``stage`` on its pool, honoring the stage limit."""
+    kind, _ = STAGES[stage]
+    pool = cpu_pool if kind == "cpu" else io_pool
+    queued = time.perf_counter()
+
+    def call() -> T:
+        metrics.stage_queue_seconds.observe(time.perf_counter() - queued, stage=stage)
+        return fn(*args, **kwargs)
+
+    async with _stage_semaphore(stage):
+        loop = asyncio.get_running_loop()
+        # Run in a copy of the caller's context so trace spans nest under the request
+        return await loop.run_in_executor(pool, functools.partial(contextvars.copy_context().run, call))
+
+
+def stats() -> Dict[str, Any]:
+    return {
+        "cpu_workers": _cpu_workers,
+        "io_workers": _io_workers,
+        "stages": {name: {"pool": kind, "limit": limit} for name, (kind, limit) in STAGES.items()},
+    }
+
+
+def shutdown() -> None:
+    cpu_pool.shutdown(wait=False)
+    io_pool.shutdown(wait=False)
@@ -0,0 +1,69 @@
+"""Face detection shared by the collage guard and the face-preservation blend.
+
+The Haar cascade XML is parsed once per thread (``cv2.CascadeClassifier`` is not
+documented as thread-safe, and CPU-pool threads are long-lived), instead of on
+every call. Detection runs on a downscaled grayscale copy capped at
+``FACE_DETECT_DIM`` pixels on the long side; boxes are mapped back to full
+resolution, and ``min_size`` is always expressed in full-resolution pixels.
+"""
+import os
+import threading
+from typing import List, Optional, Sequence, Tuple
+
+import cv2
+import numpy as np
+
+Box = Tuple[int, int, int, int]
+
+_CASCADE_PATH = cv2.data.haarcascades + "haarcascade_frontalface_default.xml"
+# Haar frontal-face cascade's native window; smaller minSize values are meaningless
+_CASCADE_WINDOW = 24
+
+try:
+    _detect_dim = max(256, int(os.getenv("FACE_DETECT_DIM", "768")))
+except Exception:
+    _detect_dim = 768
+
+_local = threading.local()
+
+
+def _classifier() -> cv2.CascadeClassifier:
+    clf = getattr(_local, "classifier", None)
+    if clf is None:
+        clf = cv2.CascadeClassifier(_CASCADE_PATH)
+        if clf.empty():
+            raise RuntimeError(f"Failed to load face cascade from {_CASCADE_PATH}")
+        _local.classifier = clf
+    return clf
+
+
+def to_gray(bgr: np.ndarray) -> np.ndarray:
+    if bgr.ndim == 2:
+        return bgr
+    return cv2.cvtColor(bgr, cv2.COLOR_BGR2GRAY)
+
+
+def detect_faces(image: np.ndarray, min_size: int = 50, detect_dim: Optional[int] = None) -> List[Box]:
+    """Face boxes (x, y, w, h) in full-resolution coordinates for a BGR or grayscale image."""
+    gray = to_gray(image)
+    H, W = gray.shape[:2]
+    limit = detect_dim or _detect_dim
+    scale = 1.0
+    if max(H, W) > limit:
+        scale = limit / float(max(H, W))
+        gray = cv2.resize(gray, (max(1, int(W * scale)), max(1, int(H * scale))), interpolation=cv2.INTER_AREA)
+    small_min = max(_CASCADE_WINDOW, int(min_size * scale))
+    found = _classifier().detectMultiScale(gray, scaleFactor=1.1, minNeighbors=5, minSize=(small_min, small_min))
+    boxes: List[Box] = []
+    for (x, y, w, h) in found:
+        box = (int(x / scale), int(y / scale), int(w / scale), int(h / scale))
+        if box[2] >= min_size and box[3] >= min_size:
+            boxes.append(box)
+    return boxes
+
+
+def largest_face(faces: Sequence[Box], min_size: int = 0) -> Optional[Box]:
+    candidates = [f for f in faces if f[2] >= min_size and f[3] >= min_size]
+    if not candidates:
+        return None
+    return max(candidates, key=lambda r: r[2] * r[3])
@@ -1,45 +1,133 @@
+import asyncio
 import base64
+import json
 import logging
 import os
-from typing import Optional
+import time
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple, Union
 
-import requests
+import cv2
+import httpx
+import numpy as np
 
+from . import metrics, upstream
+from .executor import run_stage
+from .postprocess import OUTPUT_FORMATS, encode_image
 
-GEMINI_API_BASE = "https://generativelanguage.googleapis.com/v1beta/models"
+
+DEFAULT_MODEL = "gemini-2.5-flash-image-preview"
+# Overridable so benchmarks can point the client at a local stub server
+GEMINI_API_BASE = os.getenv("GEMINI_API_BASE", "https://generativelanguage.googleapis.com/v1beta/models")
 
 logger = logging.getLogger(__name__)
 
+try:
+    _http_timeout = max(1.0, float(os.getenv("GEMINI_HTTP_TIMEOUT", "15")))
+except Exception:
+    _http_timeout = 15.0
+try:
+    _max_connections = max(1, int(os.getenv("GEMINI_MAX_CONNECTIONS", "20")))
+except Exception:
+    _max_connections = 20
+# Codec and size of the inline_data images. PNG at the cut-out size (the default) sends
+# the inputs as they are; WebP or JPEG and/or a smaller longest side shrink the upload,
+# which is most of the request, and with it Gemini's time to first byte.
+_image_format = os.getenv("GEMINI_IMAGE_FORMAT", "png").lower()
+if _image_format not in OUTPUT_FORMATS:
+    _image_format = "png"
+try:
+    _image_max_dim = max(0, int(os.getenv("GEMINI_IMAGE_MAX_DIM", "0")))
+except Exception:
+    _image_max_dim = 0
+try:
+    _image_quality = max(1, min(100, int(os.getenv("GEMINI_IMAGE_QUALITY", "90"))))
+except Exception:
+    _image_quality = 90
 
-def _ensure_base64(data: bytes) -> str:
-    return base64.b64encode(data).decode("utf-8")
+# Keep-alive connection pool shared by every call in this process. The client is
+# bound to the event loop that created it, so it is (re)created lazily per loop.
+_async_client: Optional[Tuple[asyncio.AbstractEventLoop, httpx.AsyncClient]] = None
 
 
-def generate_tryon_image(
-    user_png_bytes: bytes,
-    clothing_png_bytes: bytes,
-    background_choice: str,
-    api_key: Optional[str] = None,
-    model: str = "gemini-2.5-flash-image-preview",
-    strict: bool = False,
-    retry_note: Optional[str] = None,
-    profile: Optional[str] = None,
-) -> str:
-    """
-    Calls Gemini API to generate a try-on image.
+def _get_async_client() -> httpx.AsyncClient:
+    global _async_client
+    loop = asyncio.get_running_loop()
+    if _async_client is None or _async_client[0] is not loop or _async_client[1].is_closed:
+        client = httpx.AsyncClient(
+            timeout=httpx.Timeout(_http_timeout),
+            limits=httpx.Limits(max_connections=_max_connections, max_keepalive_connections=_max_connections),
+        )
+        _async_client = (loop, client)
+    return _async_client[1]
 
-    Returns: base64 PNG string of the generated image.
-    Raises: RuntimeError on failure.
-    """
-    key = api_key or os.getenv("GEMINI_API_KEY")
-    if not key:
-        raise RuntimeError("GEMINI_API_KEY is not set")
 
-    headers = {"Content-Type": "application/json"}
+async def aclose_client() -> None:
+    global _async_client
+    if _async_client is not None:
+        client = _async_client[1]
+        _async_client = None
+        await client.aclose()
+
+
+def _ensure_base64(data: Union[bytes, str]) -> bytes:
+    """ASCII base64 of PNG bytes; a str (catalog garment, pre-encoded batch input) is already encoded."""
+    if isinstance(data, str):
+        return data.encode("ascii")
+    return base64.b64encode(data)
+
 
-    user_b64 = _ensure_base64(user_png_bytes)
-    clothing_b64 = _ensure_base64(clothing_png_bytes)
+class InlineImage(NamedTuple):
+    """One inline_data part, encoded and ready to splice into a request body."""
 
+    mime_type: str
+    data: bytes  # ASCII base64
+
+
+def _transcode_inline(png: bytes) -> Optional[Tuple[str, bytes]]:
+    """``png`` re-encoded per GEMINI_IMAGE_FORMAT / GEMINI_IMAGE_MAX_DIM, or None to send it as is."""
+    img = cv2.imdecode(np.frombuffer(png, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+    if img is None:
+        return None
+    h, w = img.shape[:2]
+    if _image_max_dim and max(h, w) > _image_max_dim:
+        scale = _image_max_dim / float(max(h, w))
+        img = cv2.resize(img, (max(1, int(w * scale)), max(1, int(h * scale))), interpolation=cv2.INTER_AREA)
+    elif _image_format == "png":
+        return None
+    if _image_format == "jpeg" and img.ndim == 3 and img.shape[2] == 4:
+        # JPEG has no alpha: flatten the cut-out onto white
+        alpha = img[:, :, 3:4].astype(np.float32) * (1.0 / 255.0)
+        img = (img[:, :, :3] * alpha + 255.0 * (1.0 - alpha) + 0.5).astype(np.uint8)
+    data = encode_image(img, _image_format, _image_quality)
+    return (OUTPUT_FORMATS[_image_format][1], data) if data is not None else None
+
+
+def encode_inline(image: Union[bytes, str, InlineImage]) -> InlineImage:
+    """Inline part for a PNG (bytes or base64 str), in the configured upload codec and size."""
+    if isinstance(image, InlineImage):
+        return image
+    if _image_format != "png" or _image_max_dim:
+        transcoded = _transcode_inline(base64.b64decode(image) if isinstance(image, str) else image)
+        if transcoded is not None:
+            return InlineImage(transcoded[0], base64.b64encode(transcoded[1]))
+    return InlineImage("image/png", _ensure_base64(image))
+
+
+# Placeholders for the image parts while the JSON text is serialized
+_USER_SLOT = "@@user_image@@"
+_CLOTHING_SLOT = "@@clothing_image@@"
+
+
+def _build_payload(
+    user_b64: str,
+    clothing_b64: str,
+    background_choice: str,
+    strict: bool,
+    retry_note: Optional[str],
+    profile: Optional[str],
+    user_mime: str = "image/png",
+    clothing_mime: str = "image/png",
+) -> Dict[str, Any]:
     # Prompt profiles
     if (profile or "").lower() in ("sep10", "classic"):
         # A gentler profile resembling the version used around Sept 10
@@ -88,55 +176,221 @@ def generate_tryon_image(
                             " Output: a clean, artifact-free, high-resolution PNG. Return one inline PNG image as the first part." + retry_text
                         )
                     },
-                    {"inline_data": {"mime_type": "image/png", "data": user_b64}},
-                    {"inline_data": {"mime_type": "image/png", "data": clothing_b64}},
+                    {"inline_data": {"mime_type": user_mime, "data": user_b64}},
+                    {"inline_data": {"mime_type": clothing_mime, "data": clothing_b64}},
                 ],
             }
         ]
     }
+    return payload
 
+
+class EncodedInputs:
+    """Both input images of a request, encoded for inline_data once.
+
+    ``body()`` serializes the request for one prompt. Only the small prompt skeleton
+    goes through json.dumps; the multi-MB base64 parts are spliced in as bytes. Bodies
+    are memoized per prompt, so every attempt, variant and model fallback that sends
+    the same prompt reuses one bytes object, and a new prompt only rebuilds the text.
+    """
+
+    def __init__(self, user_image: Union[bytes, str, InlineImage], clothing_image: Union[bytes, str, InlineImage]) -> None:
+        with metrics.stage("base64"):
+            self.user = encode_inline(user_image)
+            self.clothing = encode_inline(clothing_image)
+        self._bodies: Dict[Tuple[str, bool, Optional[str], Optional[str]], bytes] = {}
+
+    def body(self, background_choice: str, strict: bool, retry_note: Optional[str], profile: Optional[str]) -> bytes:
+        """Serialized JSON request body; built off the event loop in async calls."""
+        key = (background_choice, strict, retry_note, profile)
+        cached = self._bodies.get(key)
+        if cached is not None:
+            return cached
+        text = json.dumps(_build_payload(
+            _USER_SLOT, _CLOTHING_SLOT, background_choice, strict, retry_note, profile,
+            self.user.mime_type, self.clothing.mime_type,
+        ))
+        head, rest = text.split(f'"{_USER_SLOT}"', 1)
+        mid, tail = rest.split(f'"{_CLOTHING_SLOT}"', 1)
+        body = b"".join((
+            head.encode("utf-8"), b'"', self.user.data, b'"',
+            mid.encode("utf-8"), b'"', self.clothing.data, b'"',
+            tail.encode("utf-8"),
+        ))
+        self._bodies[key] = body
+        return body
+
+
+def _models_to_try(model: str) -> List[str]:
     # Try requested model first, then fall back to known image-capable preview models if not found
     models_to_try = [
         model,
         "gemini-2.5-flash-image-preview",
         "gemini-2.0-flash-preview-image-generation",
     ]
+    return models_to_try[:2]
 
-    last_error_text = None
-    data = None
-    for candidate_model in models_to_try[:2]:
-        url = f"{GEMINI_API_BASE}/{candidate_model}:generateContent?key={key}"
-        try:
-            resp = requests.post(url, json=payload, headers=headers, timeout=15)
-        except requests.RequestException as req_err:
-            logger.error("Gemini request failed for %s: %s", candidate_model, str(req_err)[:300])
-            last_error_text = str(req_err)[:300]
-            continue
-        if resp.status_code == 200:
-            data = resp.json()
-            break
-        # If model not found, try next
-        if resp.status_code == 404:
-            logger.error("Gemini API error: %s %s", resp.status_code, resp.text[:500])
-            last_error_text = resp.text[:500]
-            continue
-        # For transient/server/quota errors, try the next candidate model
-        if resp.status_code in (429, 500, 502, 503):
-            logger.warning("Gemini transient error on %s: %s %s", candidate_model, resp.status_code, resp.text[:300])
-            last_error_text = resp.text[:300]
-            continue
-        # Any other error -> raise immediately
-        logger.error("Gemini API error: %s %s", resp.status_code, resp.text[:500])
-        raise RuntimeError(
-            f"Gemini API error: {resp.status_code} {resp.text[:500]}"
-        )
 
-    if data is None:
-        # Exhausted candidates
-        raise RuntimeError(
-            f"Gemini API error: 404 {last_error_text or 'Model not found'}"
-        )
+def candidate_models(model: str = DEFAULT_MODEL) -> List[str]:
+    """Models a call for ``model`` goes through, in order: ``model`` then the default
+    preview model, so a call for DEFAULT_MODEL has a single candidate."""
+    return list(dict.fromkeys(_models_to_try(model)))
 
+
+def _api_key(api_key: Optional[str]) -> str:
+    key = api_key or os.getenv("GEMINI_API_KEY")
+    if not key:
+        raise RuntimeError("GEMINI_API_KEY is not set")
+    return key
+
+
+def _model_url(candidate_model: str, key: str) -> str:
+    base = os.getenv("GEMINI_API_BASE", GEMINI_API_BASE)
+    return f"{base}/{candidate_model}:generateContent?key={key}"
+
+
+def _check_status(candidate_model: str, status_code: int, text: str) -> str:
+    """Classify a non-200 response. Returns the error text when the next candidate
+    model should be tried; raises RuntimeError for non-retryable errors.
+    """
+    # If model not found, try next
+    if status_code == 404:
+        logger.error("Gemini API error: %s %s", status_code, text[:500])
+        return text[:500]
+    # For transient/server/quota errors, try the next candidate model
+    if status_code in upstream.TRANSIENT_STATUSES:
+        logger.warning("Gemini transient error on %s: %s %s", candidate_model, status_code, text[:300])
+        return text[:300]
+    # Any other error -> raise immediately
+    logger.error("Gemini API error: %s %s", status_code, text[:500])
+    raise RuntimeError(
+        f"Gemini API error: {status_code} {text[:500]}"
+    )
+
+
+def _observe_call(candidate_model: str, status: Optional[int], started: float) -> None:
+    elapsed = time.monotonic() - started
+    metrics.gemini_seconds.observe(elapsed, model=candidate_model, status=str(status) if status is not None else "error")
+    if status == 200:
+        upstream.latencies.observe(elapsed)
+
+
+class _Round:
+    """Outcome of one pass over the candidate models."""
+
+    def __init__(self) -> None:
+        self.tried = False
+        self.transient = False
+        self.retry_after: Optional[float] = None
+        self.error_text: Optional[str] = None
+
+    def failed(self, cb: "upstream.CircuitBreaker", candidate_model: str, status_code: int, text: str, headers: Any) -> None:
+        """Record a non-200 response (raises for non-retryable ones, like _check_status)."""
+        if status_code in upstream.TRANSIENT_STATUSES:
+            retry_after = upstream.parse_retry_after(headers.get("Retry-After"))
+            cb.record_failure(retry_after)
+            self.transient = True
+            if retry_after is not None:
+                self.retry_after = max(self.retry_after or 0.0, retry_after)
+        else:
+            cb.release_probe()
+        self.error_text = _check_status(candidate_model, status_code, text)
+
+    def network_error(self, cb: "upstream.CircuitBreaker", candidate_model: str, err: Exception) -> None:
+        logger.error("Gemini request failed for %s: %s", candidate_model, str(err)[:300])
+        cb.record_failure()
+        self.transient = True
+        self.error_text = str(err)[:300]
+
+    def next_delay(self, attempt: int, models: List[str]) -> float:
+        """Seconds to wait before the next round; raises when there is no point retrying."""
+        if not self.tried:
+            wait = min(upstream.breaker(m).retry_in() for m in models)
+            if wait > upstream.breaker_wait() or attempt >= upstream.upstream_retries:
+                raise upstream.UpstreamUnavailable(wait)
+            return wait
+        if not self.transient or attempt >= upstream.upstream_retries:
+            # Exhausted candidates
+            raise RuntimeError(f"Gemini API error: 404 {self.error_text or 'Model not found'}")
+        if self.retry_after is not None and self.retry_after > upstream.backoff_max:
+            raise RuntimeError(f"Gemini API error: upstream asked to retry in {self.retry_after:.0f}s")
+        return upstream.backoff_delay(attempt, self.retry_after)
+
+
+async def generate_tryon_image_async(
+    user_png_bytes: Union[bytes, str],
+    clothing_png_bytes: Union[bytes, str],
+    background_choice: str,
+    api_key: Optional[str] = None,
+    model: str = DEFAULT_MODEL,
+    strict: bool = False,
+    retry_note: Optional[str] = None,
+    profile: Optional[str] = None,
+    inputs: Optional[EncodedInputs] = None,
+) -> str:
+    """
+    Calls Gemini API to generate a try-on image over the shared keep-alive client, under
+    the adaptive concurrency limit and per-model circuit breakers (see app.upstream).
+    Image inputs are PNG bytes or already base64-encoded strings. Pass ``inputs`` (from
+    ``EncodedInputs``) to share the encoded images across attempts and variants.
+
+    Returns: base64 PNG string of the generated image.
+    Raises: RuntimeError on failure (UpstreamBusy / UpstreamUnavailable when shedding load).
+    """
+    key = _api_key(api_key)
+    headers = {"Content-Type": "application/json"}
+    if inputs is None:
+        inputs = await run_stage("encode", EncodedInputs, user_png_bytes, clothing_png_bytes)
+    body = await run_stage("encode", inputs.body, background_choice, strict, retry_note, profile)
+    client = _get_async_client()
+    models = candidate_models(model)
+
+    for attempt in range(upstream.upstream_retries + 1):
+        rnd = _Round()
+        for candidate_model in models:
+            cb = upstream.breaker(candidate_model)
+            if not cb.allow():
+                continue
+            if rnd.tried:
+                metrics.model_fallbacks.inc(model=candidate_model)
+            rnd.tried = True
+            url = _model_url(candidate_model, key)
+            try:
+                await upstream.limiter.acquire()
+            except BaseException:
+                cb.release_probe()
+                raise
+            started = time.monotonic()
+            status: Optional[int] = None
+            try:
+                with metrics.stage("gemini", model=candidate_model):
+                    resp = await client.post(url, content=body, headers=headers)
+                status = resp.status_code
+                _observe_call(candidate_model, status, started)
+            except httpx.HTTPError as req_err:
+                _observe_call(candidate_model, None, started)
+                rnd.network_error(cb, candidate_model, req_err)
+                continue
+            except BaseException:
+                cb.release_probe()
+                raise
+            finally:
+                upstream.limiter.release(
+                    time.monotonic() - started if status is not None else None,
+                    overloaded=status in upstream.TRANSIENT_STATUSES,
+                    success=status == 200,
+                )
+            if status == 200:
+                cb.record_success()
+                return _extract_image(await run_stage("encode", resp.json))
+            rnd.failed(cb, candidate_model, resp.status_code, resp.text, resp.headers)
+        delay = rnd.next_delay(attempt, models)
+        metrics.retries.inc(reason="upstream")
+        await asyncio.sleep(delay)
+    raise RuntimeError("Gemini API error: retries exhausted")
+
+
+def _extract_image(data: Any) -> str:
     # Try to extract image data from candidates → content → parts → inline_data
     try:
         candidates = data.get("candidates", [])
@@ -163,5 +417,3 @@ def generate_tryon_image(
 
     # Some responses may encode data differently or return only text (fallback)
     raise RuntimeError("Gemini did not return an image")
-
-
@@ -0,0 +1,547 @@
+"""Asynchronous try-on jobs.
+
+``POST /api/jobs`` validates and stores the uploads, enqueues a job and answers 202
+with its ID right away. Clients then poll ``GET /api/jobs/{id}``, or pass
+``webhook_url`` to receive the final job state. The queue backend is pluggable
+(``JOB_QUEUE``):
+
+- ``memory`` (default): an in-process queue. ``JOB_WORKERS`` worker tasks run it on
+  the web process's event loop. Jobs are lost on restart.
+- ``redis``: a Redis-compatible server at ``REDIS_URL``. The web tier only enqueues,
+  and separate worker processes run the pipeline (``python -m app.worker``), so a
+  burst queues in Redis instead of pinning web workers.
+
+Workers generate under ``JOB_TIMEOUT`` instead of the HTTP ``TRYON_TIMEOUT``. Jobs
+and their results expire ``JOB_TTL`` seconds after the last update. Submissions are
+refused with 503 once ``JOB_MAX_QUEUE`` jobs are waiting, or, for the memory queue
+(which holds the raw uploads in RAM), once they hold ``JOB_MAX_QUEUE_MB``.
+
+Webhooks are posted from the server, so their targets are checked twice: when the
+job is submitted and again at delivery, against the addresses the host resolves to
+then. Loopback, private, link-local and reserved addresses are refused unless the
+host is listed in ``WEBHOOK_ALLOWED_HOSTS``. When that list is set, no other host is
+accepted. Delivery connects to the checked address, so a DNS answer that changes in
+between cannot redirect it.
+"""
+import asyncio
+import ipaddress
+import json
+import logging
+import os
+import socket
+import time
+import uuid
+from collections import deque
+from dataclasses import asdict, dataclass, field
+from typing import Any, Deque, Dict, List, Optional, Tuple, Union
+from urllib.parse import urlsplit, urlunsplit
+
+import httpx
+
+from . import pipeline
+
+logger = logging.getLogger(__name__)
+
+try:
+    _job_timeout = max(1.0, float(os.getenv("JOB_TIMEOUT", "120")))
+except Exception:
+    _job_timeout = 120.0
+try:
+    _job_ttl = max(60, int(os.getenv("JOB_TTL", "3600")))
+except Exception:
+    _job_ttl = 3600
+try:
+    _max_queue = max(1, int(os.getenv("JOB_MAX_QUEUE", "1000")))
+except Exception:
+    _max_queue = 1000
+try:
+    _max_queue_bytes = max(1, int(os.getenv("JOB_MAX_QUEUE_MB", "256"))) * 1024 * 1024
+except Exception:
+    _max_queue_bytes = 256 * 1024 * 1024
+# Redis queue: a worker that has not renewed its lease for this long is presumed dead,
+# and the jobs it claimed go back to the queue
+try:
+    _lease_s = max(5, int(os.getenv("JOB_LEASE", "60")))
+except Exception:
+    _lease_s = 60
+try:
+    _webhook_attempts = max(1, min(10, int(os.getenv("WEBHOOK_RETRIES", "3"))))
+except Exception:
+    _webhook_attempts = 3
+# Optional comma-separated allowlist of webhook hosts. Listed hosts may resolve to
+# private addresses; when set, no other host is accepted.
+_webhook_hosts = {h.strip().lower() for h in os.getenv("WEBHOOK_ALLOWED_HOSTS", "").split(",") if h.strip()}
+
+_SAMPLE_WINDOW = 1000
+
+
+@dataclass
+class Job:
+    id: str
+    background: str
+    variants: int = 1
+    image_format: str = "png"
+    quality: int = 90
+    webhook_url: Optional[str] = None
+    status: str = "queued"  # queued | running | succeeded | failed
+    created_at: float = field(default_factory=time.time)
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    images: List[str] = field(default_factory=list)
+    error: Optional[Dict[str, Any]] = None  # {"status": <http status>, "detail": ...}
+
+    @property
+    def done(self) -> bool:
+        return self.status in ("succeeded", "failed")
+
+    def public(self) -> Dict[str, Any]:
+        """Job state as returned to clients (and posted to webhooks)."""
+        out: Dict[str, Any] = {
+            "id": self.id,
+            "status": self.status,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+        if self.status == "succeeded":
+            out["images_base64"] = self.images
+        elif self.status == "failed":
+            out["error"] = self.error
+        return out
+
+
+@dataclass
+class JobInputs:
+    user_image: bytes
+    clothing_image: Optional[bytes] = None
+    garment: Optional[bytes] = None  # registered garment cut-out (PNG), used instead of clothing_image
+
+    @property
+    def nbytes(self) -> int:
+        return len(self.user_image) + len(self.clothing_image or b"") + len(self.garment or b"")
+
+
+class QueueFull(Exception):
+    pass
+
+
+def new_job_id() -> str:
+    return "j_" + uuid.uuid4().hex
+
+
+def _public_address(ip: Union[ipaddress.IPv4Address, ipaddress.IPv6Address]) -> bool:
+    if isinstance(ip, ipaddress.IPv6Address) and ip.ipv4_mapped is not None:
+        ip = ip.ipv4_mapped
+    # is_global is False for loopback, private, link-local, shared (CGNAT) and reserved ranges
+    return ip.is_global and not ip.is_multicast
+
+
+async def resolve_webhook_url(url: str) -> Tuple[str, Optional[str]]:
+    """Check a webhook target and resolve it. Returns (url, address to connect to), the
+    address being None for allowlisted hosts (connect by name). Raises ValueError.
+    """
+    parts = urlsplit(url)
+    if parts.scheme not in ("http", "https") or not parts.hostname:
+        raise ValueError("webhook_url must be an absolute http(s) URL")
+    host = parts.hostname.lower()
+    if host in _webhook_hosts:
+        return url, None
+    if _webhook_hosts:
+        raise ValueError("webhook_url host is not allowed")
+    try:
+        port = parts.port or (443 if parts.scheme == "https" else 80)
+        infos = await asyncio.get_running_loop().getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    except (OSError, ValueError):
+        raise ValueError("webhook_url host does not resolve")
+    addresses = [ipaddress.ip_address(info[4][0].split("%", 1)[0]) for info in infos]
+    # Every answer must be public: a client may connect to any of them
+    if not addresses or not all(_public_address(ip) for ip in addresses):
+        raise ValueError("webhook_url must not point to a private or reserved address")
+    return url, str(addresses[0])
+
+
+async def validate_webhook_url(url: str) -> str:
+    """The URL if it is an acceptable webhook target right now; raises ValueError."""
+    await resolve_webhook_url(url)
+    return url
+
+
+def _pinned_request(url: str, address: str) -> Tuple[str, Dict[str, str], Dict[str, Any]]:
+    """URL, headers and httpx extensions that reach ``address`` while presenting the original
+    host (Host header, TLS SNI and certificate check), so no second DNS lookup happens.
+    """
+    parts = urlsplit(url)
+    netloc = f"[{address}]" if ":" in address else address
+    if parts.port:
+        netloc = f"{netloc}:{parts.port}"
+    host_header = parts.hostname + (f":{parts.port}" if parts.port else "")
+    extensions = {"sni_hostname": parts.hostname} if parts.scheme == "https" else {}
+    return urlunsplit(parts._replace(netloc=netloc)), {"Host": host_header}, extensions
+
+
+def _summary(samples: List[float]) -> Dict[str, float]:
+    if not samples:
+        return {"count": 0}
+    ordered = sorted(samples)
+
+    def pct(p: float) -> float:
+        return ordered[min(len(ordered) - 1, int(round(p / 100.0 * (len(ordered) - 1))))]
+
+    return {
+        "count": len(ordered),
+        "mean_s": sum(ordered) / len(ordered),
+        "p50_s": pct(50),
+        "p95_s": pct(95),
+        "max_s": ordered[-1],
+    }
+
+
+class JobQueue:
+    """Queue backend interface. Wait/run times are sampled over the last 1000 jobs."""
+
+    backend = "base"
+
+    async def submit(self, job: Job, inputs: JobInputs) -> None:
+        """Store and enqueue a job; raises QueueFull past JOB_MAX_QUEUE."""
+        raise NotImplementedError
+
+    async def claim(self, timeout: float) -> Optional[Tuple[Job, JobInputs]]:
+        """Next queued job, marked running, or None after ``timeout`` seconds."""
+        raise NotImplementedError
+
+    async def get(self, job_id: str) -> Optional[Job]:
+        raise NotImplementedError
+
+    async def finish(self, job: Job) -> None:
+        """Store the final state, drop the inputs and record metrics."""
+        raise NotImplementedError
+
+    async def stats(self) -> Dict[str, Any]:
+        raise NotImplementedError
+
+    async def close(self) -> None:
+        pass
+
+
+class MemoryJobQueue(JobQueue):
+    backend = "memory"
+
+    def __init__(self, ttl: int = _job_ttl, max_queue: int = _max_queue, max_bytes: int = _max_queue_bytes) -> None:
+        self.ttl = ttl
+        self.max_queue = max_queue
+        self.max_bytes = max_bytes
+        self._jobs: Dict[str, Job] = {}
+        self._inputs: Dict[str, JobInputs] = {}
+        self._pending: Deque[str] = deque()
+        self._pending_bytes = 0
+        self._ready: Optional[asyncio.Condition] = None
+        self._running = 0
+        self._counts = {"submitted": 0, "succeeded": 0, "failed": 0}
+        self._waits: Deque[float] = deque(maxlen=_SAMPLE_WINDOW)
+        self._runs: Deque[float] = deque(maxlen=_SAMPLE_WINDOW)
+        self._last_prune = 0.0
+
+    def _condition(self) -> asyncio.Condition:
+        # Created on first use so it binds to the serving event loop
+        if self._ready is None:
+            self._ready = asyncio.Condition()
+        return self._ready
+
+    def _prune(self) -> None:
+        now = time.time()
+        if now - self._last_prune < 30:
+            return
+        self._last_prune = now
+        for job_id, job in list(self._jobs.items()):
+            if job.done and (job.finished_at or 0) + self.ttl < now:
+                del self._jobs[job_id]
+
+    async def submit(self, job: Job, inputs: JobInputs) -> None:
+        self._prune()
+        # The waiting uploads live in this process: bound them by size as well as count
+        if len(self._pending) >= self.max_queue or self._pending_bytes + inputs.nbytes > self.max_bytes:
+            raise QueueFull()
+        ready = self._condition()
+        async with ready:
+            self._jobs[job.id] = job
+            self._inputs[job.id] = inputs
+            self._pending.append(job.id)
+            self._pending_bytes += inputs.nbytes
+            self._counts["submitted"] += 1
+            ready.notify()
+
+    async def claim(self, timeout: float) -> Optional[Tuple[Job, JobInputs]]:
+        ready = self._condition()
+        async with ready:
+            if not self._pending:
+                try:
+                    await asyncio.wait_for(ready.wait_for(lambda: bool(self._pending)), timeout)
+                except asyncio.TimeoutError:
+                    return None
+            job_id = self._pending.popleft()
+        job = self._jobs[job_id]
+        job.status = "running"
+        job.started_at = time.time()
+        self._running += 1
+        self._waits.append(job.started_at - job.created_at)
+        inputs = self._inputs.pop(job_id)
+        self._pending_bytes -= inputs.nbytes
+        return job, inputs
+
+    async def get(self, job_id: str) -> Optional[Job]:
+        return self._jobs.get(job_id)
+
+    async def finish(self, job: Job) -> None:
+        self._jobs[job.id] = job
+        self._inputs.pop(job.id, None)
+        self._running = max(0, self._running - 1)
+        self._counts[job.status] = self._counts.get(job.status, 0) + 1
+        if job.started_at is not None and job.finished_at is not None:
+            self._runs.append(job.finished_at - job.started_at)
+
+    async def stats(self) -> Dict[str, Any]:
+        return {
+            "backend": self.backend,
+            "depth": len(self._pending),
+            "depth_bytes": self._pending_bytes,
+            "running": self._running,
+            **self._counts,
+            "wait": _summary(list(self._waits)),
+            "run": _summary(list(self._runs)),
+        }
+
+
+class RedisJobQueue(JobQueue):
+    """Jobs in a Redis-compatible server, shared by the web tier and worker processes.
+
+    Job state is a JSON string per job, inputs a hash of raw image bytes, and the queue
+    a list of job IDs. Counters and the wait/run samples live in Redis too, so
+    ``stats`` covers every process.
+
+    Claiming moves the ID atomically (BLMOVE, Redis 6.2+) into this worker's processing
+    list, and ``finish`` removes it from there. Each claiming worker renews a lease key
+    while it runs. The processing lists of workers whose lease has expired (crashed or
+    killed mid-job) are moved back to the head of the queue, so no claimed job is lost.
+    """
+
+    backend = "redis"
+
+    def __init__(self, url: str, ttl: int = _job_ttl, max_queue: int = _max_queue, prefix: str = "tryon:jobs") -> None:
+        try:
+            import redis.asyncio as aioredis
+        except ImportError:
+            raise RuntimeError("JOB_QUEUE=redis requires the 'redis' package")
+        self._redis = aioredis.from_url(url)
+        self.ttl = ttl
+        self.max_queue = max_queue
+        self.prefix = prefix
+        self.worker_id = uuid.uuid4().hex
+        self.lease_s = _lease_s
+        self._lease_task: Optional["asyncio.Task[None]"] = None
+        self._last_requeue = 0.0
+
+    def _key(self, *parts: str) -> str:
+        return ":".join((self.prefix,) + parts)
+
+    def _save(self, pipe, job: Job) -> None:
+        pipe.set(self._key("job", job.id), json.dumps(asdict(job)), ex=self.ttl)
+
+    async def submit(self, job: Job, inputs: JobInputs) -> None:
+        if await self._redis.llen(self._key("queue")) >= self.max_queue:
+            raise QueueFull()
+        fields = {k: v for k, v in asdict(inputs).items() if v is not None}
+        async with self._redis.pipeline(transaction=True) as pipe:
+            self._save(pipe, job)
+            pipe.hset(self._key("inputs", job.id), mapping=fields)
+            pipe.expire(self._key("inputs", job.id), self.ttl)
+            pipe.lpush(self._key("queue"), job.id)
+            pipe.incr(self._key("count", "submitted"))
+            await pipe.execute()
+
+    async def _renew_lease(self) -> None:
+        while True:
+            await self._redis.set(self._key("lease", self.worker_id), 1, ex=self.lease_s)
+            await asyncio.sleep(self.lease_s / 3.0)
+
+    async def requeue_stale(self) -> int:
+        """Move the jobs of workers whose lease expired back to the queue. Returns how many."""
+        moved = 0
+        async for key in self._redis.scan_iter(match=self._key("processing", "*")):
+            worker_id = key.decode("utf-8").rsplit(":", 1)[-1]
+            if worker_id == self.worker_id or await self._redis.exists(self._key("lease", worker_id)):
+                continue
+            # RIGHT -> RIGHT: requeued jobs are the next ones claimed
+            while await self._redis.lmove(key, self._key("queue"), "RIGHT", "RIGHT") is not None:
+                moved += 1
+                await self._redis.decr(self._key("running"))
+        if moved:
+            logger.warning("requeued %d jobs from expired workers", moved)
+        return moved
+
+    async def claim(self, timeout: float) -> Optional[Tuple[Job, JobInputs]]:
+        if self._lease_task is None or self._lease_task.done():
+            self._lease_task = asyncio.ensure_future(self._renew_lease())
+        now = time.monotonic()
+        if now - self._last_requeue >= self.lease_s / 2.0:
+            self._last_requeue = now
+            await self.requeue_stale()
+        processing = self._key("processing", self.worker_id)
+        popped = await self._redis.blmove(self._key("queue"), processing, max(1, int(timeout)), "RIGHT", "LEFT")
+        if popped is None:
+            return None
+        job_id = popped.decode("utf-8")
+        job = await self.get(job_id)
+        raw = await self._redis.hgetall(self._key("inputs", job_id))
+        if job is None or not raw:
+            # Expired while queued
+            await self._redis.lrem(processing, 0, job_id)
+            return None
+        inputs = JobInputs(**{k.decode("utf-8"): v for k, v in raw.items()})
+        job.status = "running"
+        job.started_at = time.time()
+        async with self._redis.pipeline(transaction=True) as pipe:
+            self._save(pipe, job)
+            pipe.incr(self._key("running"))
+            pipe.lpush(self._key("waits"), job.started_at - job.created_at)
+            pipe.ltrim(self._key("waits"), 0, _SAMPLE_WINDOW - 1)
+            await pipe.execute()
+        return job, inputs
+
+    async def get(self, job_id: str) -> Optional[Job]:
+        raw = await self._redis.get(self._key("job", job_id))
+        return Job(**json.loads(raw)) if raw else None
+
+    async def finish(self, job: Job) -> None:
+        async with self._redis.pipeline(transaction=True) as pipe:
+            self._save(pipe, job)
+            pipe.delete(self._key("inputs", job.id))
+            pipe.lrem(self._key("processing", self.worker_id), 0, job.id)
+            pipe.decr(self._key("running"))
+            pipe.incr(self._key("count", job.status))
+            if job.started_at is not None and job.finished_at is not None:
+                pipe.lpush(self._key("runs"), job.finished_at - job.started_at)
+                pipe.ltrim(self._key("runs"), 0, _SAMPLE_WINDOW - 1)
+            await pipe.execute()
+
+    async def stats(self) -> Dict[str, Any]:
+        async with self._redis.pipeline(transaction=False) as pipe:
+            pipe.llen(self._key("queue"))
+            pipe.get(self._key("running"))
+            for name in ("submitted", "succeeded", "failed"):
+                pipe.get(self._key("count", name))
+            pipe.lrange(self._key("waits"), 0, -1)
+            pipe.lrange(self._key("runs"), 0, -1)
+            depth, running, submitted, succeeded, failed, waits, runs = await pipe.execute()
+        return {
+            "backend": self.backend,
+            "depth": int(depth),
+            "running": max(0, int(running or 0)),
+            "submitted": int(submitted or 0),
+            "succeeded": int(succeeded or 0),
+            "failed": int(failed or 0),
+            "wait": _summary([float(v) for v in waits]),
+            "run": _summary([float(v) for v in runs]),
+        }
+
+    async def close(self) -> None:
+        if self._lease_task is not None:
+            self._lease_task.cancel()
+            try:
+                await self._lease_task
+            except (asyncio.CancelledError, Exception):
+                pass
+            # Jobs still claimed by this worker are requeued by the next requeue_stale
+            await self._redis.delete(self._key("lease", self.worker_id))
+        await self._redis.close()
+
+
+def create_queue() -> JobQueue:
+    """Queue backend selected by ``JOB_QUEUE`` (memory | redis)."""
+    kind = os.getenv("JOB_QUEUE", "memory").lower()
+    if kind == "redis":
+        return RedisJobQueue(os.getenv("REDIS_URL", "redis://localhost:6379/0"))
+    if kind != "memory":
+        raise RuntimeError(f"Unknown JOB_QUEUE {kind!r}")
+    return MemoryJobQueue()
+
+
+def default_worker_count(queue: JobQueue) -> int:
+    """In-process workers for the web tier: JOB_WORKERS, else 2 for memory queues and 0 for Redis."""
+    try:
+        return max(0, int(os.getenv("JOB_WORKERS", "")))
+    except ValueError:
+        return 2 if queue.backend == "memory" else 0
+
+
+async def deliver_webhook(job: Job) -> bool:
+    """POST the final job state to its webhook, retrying with backoff. Returns True on a 2xx."""
+    if not job.webhook_url:
+        return False
+    async with httpx.AsyncClient(timeout=10.0) as client:
+        for attempt in range(_webhook_attempts):
+            try:
+                # Checked again now: the host may resolve elsewhere than at submission
+                url, address = await resolve_webhook_url(job.webhook_url)
+            except ValueError as err:
+                logger.warning("webhook for job %s refused: %s", job.id, err)
+                return False
+            headers: Dict[str, str] = {}
+            extensions: Dict[str, Any] = {}
+            if address is not None:
+                url, headers, extensions = _pinned_request(url, address)
+            try:
+                resp = await client.post(url, json=job.public(), headers=headers, extensions=extensions)
+                if resp.status_code < 300:
+                    return True
+                if 400 <= resp.status_code < 500 and resp.status_code != 429:
+                    break
+            except httpx.HTTPError:
+                pass
+            if attempt + 1 < _webhook_attempts:
+                await asyncio.sleep(2 ** attempt)
+    logger.warning("webhook delivery failed for job %s", job.id)
+    return False
+
+
+async def run_job(queue: JobQueue, job: Job, inputs: JobInputs) -> None:
+    try:
+        user_png, clothing = await pipeline.prepare(inputs.user_image, inputs.clothing_image, inputs.garment)
+        images, timed_out = await pipeline.generate_variants(
+            user_png, clothing, job.background, job.variants, job.image_format, job.quality, timeout=_job_timeout
+        )
+        if not images:
+            raise pipeline.generation_failed(timed_out)
+        job.images = images
+        job.status = "succeeded"
+    except pipeline.PipelineError as err:
+        job.status = "failed"
+        job.error = {"status": err.status_code, "detail": err.detail}
+    except Exception:
+        logger.exception("job %s failed", job.id)
+        job.status = "failed"
+        job.error = {"status": 500, "detail": "Generation failed"}
+    job.finished_at = time.time()
+    await queue.finish(job)
+    if job.webhook_url:
+        await deliver_webhook(job)
+
+
+async def _worker(queue: JobQueue, stop: asyncio.Event) -> None:
+    while not stop.is_set():
+        try:
+            claimed = await queue.claim(timeout=1.0)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("job queue claim failed")
+            await asyncio.sleep(1.0)
+            continue
+        if claimed is not None:
+            job, inputs = claimed
+            claimed = None
+            await run_job(queue, job, inputs)
+
+
+def start_workers(queue: JobQueue, count: int, stop: asyncio.Event) -> List["asyncio.Task[None]"]:
+    """Start ``count`` worker tasks on the running loop; they exit after their current job once ``stop`` is set."""
+    return [asyncio.ensure_future(_worker(queue, stop)) for _ in range(count)]
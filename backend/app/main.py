@@ -1,244 +1,109 @@
-import io
-import gc
-from typing import Literal, Optional, Tuple
+import asyncio
+import logging
+import time
+from typing import Any, AsyncIterator, Dict, List, Literal, Optional, Tuple, Union
 
-from fastapi import FastAPI, File, UploadFile, Form, HTTPException
-from fastapi.staticfiles import StaticFiles
+from fastapi import FastAPI, File, UploadFile, Form, Header, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse, FileResponse
-from dotenv import load_dotenv
-from PIL import Image
-from rembg import remove, new_session
-import base64
-import numpy as np
-import cv2
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 import os
 
-from .schemas import TryOnResponse, TryOnMultiResponse
-from .gemini import generate_tryon_image
+from .schemas import TryOnMultiResponse, GarmentResponse
+from .gemini import aclose_client
+from . import assets
+from . import executor
+from .executor import run_stage
+from . import preprocess
+from .catalog import CatalogFull, Garment, GarmentCatalog
+from . import postprocess
+from .uploads import (
+    BodySizeLimitMiddleware, UploadError, max_batch_request_bytes, max_mask_bytes, max_tryon_request_bytes,
+    max_upload_bytes, probe_image, read_upload,
+)
+from .memtrack import MemoryTrackingMiddleware
+from . import streaming
+from . import pipeline
+from . import jobs
+from . import upstream
+from . import metrics
 
-app = FastAPI(title="Virtual Try-On API")
+logger = logging.getLogger(__name__)
 
-# Load env vars from .env when running locally
-load_dotenv()
+app = FastAPI(title="Virtual Try-On API")
 
-# Configurable model and image size (override via env)
-_rembg_model_name = os.getenv("REMBG_MODEL", "u2net")
-_max_dim_str = os.getenv("MAX_DIM", "1536")
-_face_blend_enabled = os.getenv("FACE_BLEND", "1").lower() not in ("0", "false", "no")
 try:
-    _max_variants = max(1, min(3, int(os.getenv("MAX_VARIANTS", "1"))))
+    _catalog_loaded_bytes = max(1, int(os.getenv("CATALOG_CACHE_MB", "256"))) * 1024 * 1024
 except Exception:
-    _max_variants = 1
-try:
-    _max_attempts = max(1, min(3, int(os.getenv("RETRIES", "1"))))
-except Exception:
-    _max_attempts = 1
-try:
-    _max_dim = max(256, min(4096, int(_max_dim_str)))
-except Exception:
-    _max_dim = 1536
-
-# Create background removal session and warm it up on startup
-_rembg_session = new_session(_rembg_model_name)
-
-@app.on_event("startup")
-async def _warmup_model() -> None:
-    # Run a tiny warmup so first request is faster (and triggers model download)
+    _catalog_loaded_bytes = 256 * 1024 * 1024
+_catalog = GarmentCatalog(os.getenv("CATALOG_DIR") or None, _catalog_loaded_bytes)
+# Async job mode: in-process queue by default, Redis (JOB_QUEUE=redis) with app.worker processes
+_job_queue = jobs.create_queue()
+_job_workers_stop = asyncio.Event()
+_job_workers: List["asyncio.Task[None]"] = []
+
+# Model load at startup: "background" (default) serves liveness at once and reports
+# readiness when the model is warm; "startup" blocks startup until then; "lazy" loads
+# on the first request that needs it
+_model_load = os.getenv("MODEL_LOAD", "background").lower()
+_import_started = time.monotonic()
+_startup: Dict[str, Optional[float]] = {"startup_s": None, "ready_s": None}
+_model_task: Optional["asyncio.Task[None]"] = None
+
+
+async def _load_model() -> None:
     try:
-        tiny = Image.new("RGBA", (2, 2), (0, 0, 0, 0))
-        _ = remove(tiny, session=_rembg_session)
+        await run_stage("rembg", preprocess.warmup)
     except Exception:
-        pass
+        logger.exception("rembg model load failed")
+    else:
+        _startup["ready_s"] = time.monotonic() - _import_started
 
 
-def _downscale_max_dim(img: Image.Image, max_dim: int = 1024) -> Image.Image:
-    w, h = img.size
-    if max(w, h) <= max_dim:
-        return img
-    scale = max_dim / float(max(w, h))
-    new_size = (max(1, int(w * scale)), max(1, int(h * scale)))
-    return img.resize(new_size, Image.LANCZOS)
+def _startup_samples():
+    yield "tryon_model_ready", "gauge", "1 once the rembg model is loaded and warm", {}, int(preprocess.model_status()["state"] == "ready")
+    for key, value in _startup.items():
+        if value is not None:
+            yield f"tryon_{key[:-2]}_seconds", "gauge", "Seconds from app import to this startup milestone", {}, value
 
 
-def _detect_face_bbox(bgr_image: np.ndarray) -> Optional[Tuple[int, int, int, int]]:
-    gray = cv2.cvtColor(bgr_image, cv2.COLOR_BGR2GRAY)
-    face_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + "haarcascade_frontalface_default.xml")
-    faces = face_cascade.detectMultiScale(gray, scaleFactor=1.1, minNeighbors=5, minSize=(60, 60))
-    if len(faces) == 0:
-        return None
-    # Choose largest face
-    x, y, w, h = max(faces, key=lambda r: r[2] * r[3])
-    return int(x), int(y), int(w), int(h)
-
-
-def _preserve_face_with_poisson(user_png: bytes, generated_png: bytes) -> bytes:
-    try:
-        # Decode to BGR
-        user_arr = np.frombuffer(user_png, dtype=np.uint8)
-        gen_arr = np.frombuffer(generated_png, dtype=np.uint8)
-        user_bgr = cv2.imdecode(user_arr, cv2.IMREAD_COLOR)
-        gen_bgr = cv2.imdecode(gen_arr, cv2.IMREAD_COLOR)
-        if user_bgr is None or gen_bgr is None:
-            return generated_png
-
-        src_box = _detect_face_bbox(user_bgr)
-        dst_box = _detect_face_bbox(gen_bgr)
-        if src_box is None or dst_box is None:
-            return generated_png
-
-        sx, sy, sw, sh = src_box
-        dx, dy, dw, dh = dst_box
-
-        # Sanity checks to avoid blending a tiny/huge or misplaced face (prevents "face pasted" look)
-        H, W = gen_bgr.shape[:2]
-        if dw <= 0 or dh <= 0 or W <= 0 or H <= 0:
-            return generated_png
-        # Face should be within frame and not cover unrealistic area
-        if dx < 0 or dy < 0 or dx + dw > W or dy + dh > H:
-            return generated_png
-        face_area = dw * dh
-        frame_area = W * H
-        if face_area < 0.01 * frame_area or face_area > 0.25 * frame_area:
-            # Too small or too large → skip blending
-            return generated_png
-
-        # Crop and resize user face to destination size
-        user_face = user_bgr[max(sy, 0): sy + sh, max(sx, 0): sx + sw]
-        if user_face.size == 0:
-            return generated_png
-        user_face_resized = cv2.resize(user_face, (dw, dh), interpolation=cv2.INTER_CUBIC)
-
-        # Elliptical mask for smoother boundaries
-        mask = np.zeros((dh, dw), dtype=np.uint8)
-        cv2.ellipse(
-            mask,
-            (dw // 2, dh // 2),
-            (int(dw * 0.45), int(dh * 0.55)),
-            0,
-            0,
-            360,
-            255,
-            -1,
-        )
+metrics.add_collector(_startup_samples)
 
-        center = (dx + dw // 2, dy + dh // 2)
-        blended = cv2.seamlessClone(user_face_resized, gen_bgr, mask, center, cv2.NORMAL_CLONE)
 
-        # Encode back to PNG bytes
-        ok, out_buf = cv2.imencode('.png', blended)
-        if not ok:
-            return generated_png
-        return out_buf.tobytes()
-    except Exception:
-        # Fallback on any error
-        return generated_png
-
-
-def _reject_generated_if_collage(generated_png: bytes) -> bool:
-    """Heuristic filter to catch collage/inset-face artifacts.
-    Reject when: more than one detected face, or the only detected face sits unusually low
-    (e.g., embedded on clothing) relative to image height.
-    """
-    try:
-        arr = np.frombuffer(generated_png, dtype=np.uint8)
-        bgr = cv2.imdecode(arr, cv2.IMREAD_COLOR)
-        if bgr is None:
-            return False
-        gray = cv2.cvtColor(bgr, cv2.COLOR_BGR2GRAY)
-        face_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + "haarcascade_frontalface_default.xml")
-        faces = face_cascade.detectMultiScale(gray, scaleFactor=1.1, minNeighbors=5, minSize=(50, 50))
-        if len(faces) == 0:
-            # Sometimes the face detector misses valid faces; don't over-reject
-            return False
-        if len(faces) > 1:
-            return True
-        (x, y, w, h) = faces[0]
-        H, W = bgr.shape[:2]
-        # Reject if face center is below ~70% height (more lenient for pose/composition changes)
-        cy = y + h / 2.0
-        if cy > 0.7 * H:
-            return True
-        # Reject if face area is implausibly small/large
-        area_ratio = (w * h) / float(max(1, W * H))
-        if area_ratio < 0.008 or area_ratio > 0.40:
-            return True
-        return False
-    except Exception:
-        return False
+@app.on_event("startup")
+async def _warmup_model() -> None:
+    global _model_task
+    if _model_load == "startup":
+        await _load_model()
+    elif _model_load != "lazy":
+        _model_task = asyncio.ensure_future(_load_model())
+    _startup["startup_s"] = time.monotonic() - _import_started
 
 
-def _auto_crop_letterbox(generated_png: bytes) -> bytes:
-    """Remove uniform near-black letterbox bars from edges (left/right/top/bottom).
-    Crops only when large contiguous edge strips are >98% near-black and
-    total crop per edge is <=20% of dimension.
-    """
-    try:
-        arr = np.frombuffer(generated_png, dtype=np.uint8)
-        bgr = cv2.imdecode(arr, cv2.IMREAD_COLOR)
-        if bgr is None:
-            return generated_png
-        H, W = bgr.shape[:2]
-        if H < 10 or W < 10:
-            return generated_png
-
-        gray = cv2.cvtColor(bgr, cv2.COLOR_BGR2GRAY)
-        black_thresh = 14  # very dark
-        max_frac = 0.20
-        min_run = 6
-
-        def count_black_cols_from_edge(img_gray: np.ndarray, from_left: bool) -> int:
-            h, w = img_gray.shape
-            limit = int(w * max_frac)
-            run = 0
-            rng = range(w) if from_left else range(w - 1, -1, -1)
-            for xi, x in enumerate(rng):
-                if xi >= limit:
-                    break
-                col = img_gray[:, x]
-                black_ratio = float((col <= black_thresh).sum()) / float(h)
-                if black_ratio >= 0.98:
-                    run += 1
-                else:
-                    break
-            return run if run >= min_run else 0
-
-        def count_black_rows_from_edge(img_gray: np.ndarray, from_top: bool) -> int:
-            h, w = img_gray.shape
-            limit = int(h * max_frac)
-            run = 0
-            rng = range(h) if from_top else range(h - 1, -1, -1)
-            for yi, y in enumerate(rng):
-                if yi >= limit:
-                    break
-                row = img_gray[y, :]
-                black_ratio = float((row <= black_thresh).sum()) / float(w)
-                if black_ratio >= 0.98:
-                    run += 1
-                else:
-                    break
-            return run if run >= min_run else 0
-
-        left = count_black_cols_from_edge(gray, True)
-        right = count_black_cols_from_edge(gray, False)
-        top = count_black_rows_from_edge(gray, True)
-        bottom = count_black_rows_from_edge(gray, False)
-
-        x0 = left
-        x1 = W - right
-        y0 = top
-        y1 = H - bottom
-        # Validate crop box
-        if x0 < 0 or y0 < 0 or x1 <= x0 + 10 or y1 <= y0 + 10:
-            return generated_png
-
-        cropped = bgr[y0:y1, x0:x1]
-        ok, out = cv2.imencode('.png', cropped)
-        if not ok:
-            return generated_png
-        return out.tobytes()
-    except Exception:
-        return generated_png
+@app.on_event("startup")
+async def _start_job_workers() -> None:
+    _job_workers.extend(jobs.start_workers(_job_queue, jobs.default_worker_count(_job_queue), _job_workers_stop))
+
+
+@app.on_event("shutdown")
+async def _shutdown_pools() -> None:
+    if _model_task is not None:
+        _model_task.cancel()
+    _job_workers_stop.set()
+    for task in _job_workers:
+        task.cancel()
+    await _job_queue.close()
+    await aclose_client()
+    executor.shutdown()
+
+
+# Refuse oversized request bodies before multipart parsing spools them
+app.add_middleware(BodySizeLimitMiddleware, path_limits={
+    "/tryon": max_tryon_request_bytes,
+    "/api/tryon": max_tryon_request_bytes,
+    "/api/tryon/batch": max_batch_request_bytes,
+})
+# Per-request peak memory / RSS headers when MEMORY_TRACKING=1 (no-op otherwise)
+app.add_middleware(MemoryTrackingMiddleware)
 
 # CORS allowlist for our domains and localhost
 app.add_middleware(
@@ -261,10 +126,50 @@ app.add_middleware(
 # (Temporarily removed; we'll mount the SPA at "/" after API routes)
 
 @app.get("/health")
+@app.get("/health/live")
 def health():
     return {"status": "ok"}
 
 
+@app.get("/health/ready")
+def readiness():
+    """Ready once the rembg model is loaded and warm (always, in MODEL_LOAD=lazy mode)."""
+    model = preprocess.model_status()
+    ready = model["state"] == "ready" or _model_load == "lazy"
+    status = "ready" if ready else ("failed" if model["state"] == "failed" else "starting")
+    body = {"status": status, "model": model, "startup": _startup}
+    return JSONResponse(status_code=200 if ready else 503, content=body)
+
+
+@app.get("/cache/stats")
+def cache_stats():
+    return {"cutout": preprocess.cutout_cache.stats(), "result": pipeline.result_cache_stats()}
+
+
+@app.get("/upstream/stats")
+def upstream_stats():
+    return upstream.stats()
+
+
+@app.get("/metrics")
+def prometheus_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+@app.get("/postprocess/stats")
+def postprocess_stats():
+    return postprocess.stage_stats()
+
+
+@app.get("/api/upload-config")
+def upload_config():
+    """Target size and format for client-side resizing before /api/tryon uploads."""
+    return JSONResponse(
+        {**preprocess.upload_target(), "max_upload_bytes": max_upload_bytes, "max_mask_bytes": max_mask_bytes},
+        headers={"Cache-Control": "public, max-age=300"},
+    )
+
+
 # Expose Firebase web config from server env so the frontend can initialize in production
 @app.get("/firebase-config.json")
 def firebase_config():
@@ -304,117 +209,286 @@ def auth_signin():
     return {"token": "mock-token", "user": {"id": "mock-user", "email": "user@example.com", "name": "Mock User"}}
 
 
+@app.post("/api/garments", response_model=GarmentResponse)
+async def register_garment(image: UploadFile = File(...)):
+    """Ingest a garment once; pass the returned id as ``clothing_id`` to /api/tryon."""
+    try:
+        raw = await read_upload(image)
+        probe_image(raw)
+    except UploadError as err:
+        return JSONResponse(status_code=err.status_code, content={"detail": err.detail})
+    try:
+        garment = await run_stage("rembg", _catalog.register, raw)
+    except CatalogFull:
+        return JSONResponse(status_code=507, content={"detail": "Garment catalog is full"})
+    except preprocess.CutoutFailed:
+        # Transient (e.g. the model is still loading); nothing was stored
+        return JSONResponse(status_code=503, content={"detail": "Background removal failed"}, headers={"Retry-After": "5"})
+    except Exception:
+        return JSONResponse(status_code=400, content={"detail": "Invalid clothing image"})
+    return {"id": garment.id, "width": garment.width, "height": garment.height}
+
+
+@app.get("/api/garments/{garment_id}", response_model=GarmentResponse)
+async def get_garment(garment_id: str):
+    garment = await _catalog.aget(garment_id)
+    if garment is None:
+        raise HTTPException(status_code=404, detail="Unknown garment")
+    return {"id": garment.id, "width": garment.width, "height": garment.height}
+
+
+Background = Literal[
+    "Plain White", "Library", "Party", "Beach", "Office",
+    "Street", "Bedroom", "Living Room", "Cafe", "Park", "Studio Gray",
+    "Gym", "Beach Party", "Destination Wedding", "Photoshoot"
+]
+
+
+async def _read_mask(upload: Optional[UploadFile], what: str) -> Optional[bytes]:
+    """Bounded, header-checked bytes of an optional client-computed mask."""
+    if upload is None:
+        return None
+    try:
+        raw = await read_upload(upload, max_mask_bytes)
+        probe_image(raw)
+    except UploadError as err:
+        raise pipeline.PipelineError(err.status_code, f"{what}: {err.detail}")
+    finally:
+        await upload.close()
+    return raw
+
+
+async def _read_inputs(
+    user_image: UploadFile, clothing_image: Optional[UploadFile], clothing_id: Optional[str]
+) -> Tuple[bytes, bytes, Optional[Garment]]:
+    """Bounded, header-checked upload bytes plus the registered garment for ``clothing_id``.
+    Raises PipelineError with the status to return.
+    """
+    # Registered garments are already cut out and base64-encoded
+    garment: Optional[Garment] = None
+    if clothing_id:
+        garment = await _catalog.aget(clothing_id)
+        if garment is None:
+            raise pipeline.PipelineError(404, "Unknown clothing_id")
+    elif clothing_image is None:
+        raise pipeline.PipelineError(400, "clothing_image or clothing_id is required")
+
+    # Read files (bounded), checking format and dimensions from the headers before any decode
+    try:
+        with metrics.stage("upload_read"):
+            user_bytes = await read_upload(user_image)
+            probe_image(user_bytes)
+    except UploadError as err:
+        raise pipeline.PipelineError(err.status_code, f"user_image: {err.detail}")
+    clothing_bytes = b""
+    if garment is None:
+        try:
+            with metrics.stage("upload_read"):
+                clothing_bytes = await read_upload(clothing_image)
+                probe_image(clothing_bytes)
+        except UploadError as err:
+            raise pipeline.PipelineError(err.status_code, f"clothing_image: {err.detail}")
+
+    # Release the spooled multipart parts; only the bytes read above are kept
+    await user_image.close()
+    if clothing_image is not None:
+        await clothing_image.close()
+    return user_bytes, clothing_bytes, garment
+
+
 @app.post("/tryon", response_model=TryOnMultiResponse)
 @app.post("/api/tryon", response_model=TryOnMultiResponse)
 async def tryon(
     user_image: UploadFile = File(...),
-    clothing_image: UploadFile = File(...),
-    background: Literal[
-        "Plain White", "Library", "Party", "Beach", "Office",
-        "Street", "Bedroom", "Living Room", "Cafe", "Park", "Studio Gray",
-        "Gym", "Beach Party", "Destination Wedding", "Photoshoot"
-    ] = Form(...),
+    clothing_image: Optional[UploadFile] = File(None),
+    background: Background = Form(...),
     variants: int = Form(1),
+    clothing_id: Optional[str] = Form(None),
+    response_mode: Optional[str] = Form(None),
+    image_format: Literal["png", "webp", "jpeg"] = Form("png"),
+    quality: int = Form(90),
+    cache: bool = Form(True),
+    face_blend: Optional[Literal["auto", "poisson", "feather", "laplacian"]] = Form(None),
+    user_mask: Optional[UploadFile] = File(None),
+    clothing_mask: Optional[UploadFile] = File(None),
+    accept: Optional[str] = Header(None),
 ):
-    # Read files
-    user_bytes = await user_image.read()
-    clothing_bytes = await clothing_image.read()
+    # JSON/base64 by default; "multipart" or "ndjson" (or the matching Accept) stream raw bytes
+    mode = streaming.negotiate_mode(response_mode, accept)
+    if mode is None:
+        return JSONResponse(status_code=400, content={"detail": f"response_mode must be one of {', '.join(streaming.RESPONSE_MODES)}"})
+    quality = max(1, min(100, int(quality)))
 
-    # Background removal on user image
     try:
-        user_img = Image.open(io.BytesIO(user_bytes)).convert("RGBA")
-        user_img = _downscale_max_dim(user_img, _max_dim)
-    except Exception:
-        return JSONResponse(status_code=400, content={"detail": "Invalid user image"})
+        user_bytes, clothing_bytes, garment = await _read_inputs(user_image, clothing_image, clothing_id)
+        # Clients that segment locally send the masks; those inputs skip the server rembg pass
+        user_mask_bytes = await _read_mask(user_mask, "user_mask")
+        clothing_mask_bytes = await _read_mask(clothing_mask, "clothing_mask")
+    except pipeline.PipelineError as err:
+        return JSONResponse(status_code=err.status_code, content={"detail": err.detail})
+
+    # Cut-outs, then N variants concurrently under a single request-level deadline
+    try:
+        user_png, clothing = await pipeline.prepare(
+            user_bytes, clothing_bytes, garment.b64 if garment else None, user_mask_bytes, clothing_mask_bytes
+        )
+    except pipeline.PipelineError as err:
+        return JSONResponse(status_code=err.status_code, content={"detail": err.detail})
+    # Raw uploads are not needed during the (long) generation phase
+    del user_bytes, clothing_bytes, user_mask_bytes, clothing_mask_bytes
+
+    count = pipeline.variant_count(variants)
+    if mode == "json":
+        images, timed_out = await pipeline.generate_variants(
+            user_png, clothing, background, count, image_format, quality, use_cache=cache, blend_mode=face_blend
+        )
+        if not images:
+            _raise_generation_failed(timed_out)
+        # Already-valid payload: skip response_model re-validation/copy of multi-MB strings
+        return JSONResponse({"images_base64": images})
+
+    # Streaming: hold the response until the first image so failures keep their status codes
+    events = pipeline.iter_variants(
+        user_png, clothing, background, count, image_format, quality, use_cache=cache, blend_mode=face_blend
+    )
+    first = await events.__anext__()
+    if first.image_b64 is None:
+        _raise_generation_failed(first.timed_out)
+
+    # Labelled with the format each image is actually in: encoding can fall back to PNG
+    async def images_iter() -> AsyncIterator[Tuple[str, str]]:
+        yield first.image_b64, streaming.content_type(first.fmt or image_format)
+        async for event in events:
+            if event.image_b64 is not None:
+                yield event.image_b64, streaming.content_type(event.fmt or image_format)
+
+    if mode == "ndjson":
+        return StreamingResponse(streaming.ndjson_stream(images_iter()), media_type="application/x-ndjson")
+    boundary = streaming.multipart_boundary()
+    return StreamingResponse(
+        streaming.multipart_stream(images_iter(), boundary),
+        media_type=f"multipart/mixed; boundary={boundary}",
+    )
+
+
+def _raise_generation_failed(timed_out: bool) -> None:
+    err = pipeline.generation_failed(timed_out)
+    headers = {"Retry-After": str(int(err.retry_after + 0.5))} if err.retry_after is not None else None
+    raise HTTPException(status_code=err.status_code, detail=err.detail, headers=headers)
+
+
+@app.post("/api/tryon/batch")
+async def tryon_batch(
+    user_images: List[UploadFile] = File(...),
+    clothing_images: Optional[List[UploadFile]] = File(None),
+    clothing_ids: Optional[List[str]] = Form(None),
+    background: Background = Form(...),
+    variants: int = Form(1),
+    response_mode: Literal["ndjson", "json"] = Form("ndjson"),
+    image_format: Literal["png", "webp", "jpeg"] = Form("png"),
+    quality: int = Form(90),
+):
+    """Every user x garment pair in one request, e.g. one photo against a whole rack.
 
+    Garments are ``clothing_ids`` (registered garments) followed by ``clothing_images``.
+    Each input is preprocessed once however many items use it. Results stream per item
+    as NDJSON (see app.streaming), and a failed item does not fail the batch.
+    """
+    clothing_images = clothing_images or []
+    clothing_ids = clothing_ids or []
+    n_items = len(user_images) * (len(clothing_ids) + len(clothing_images))
+    if n_items == 0:
+        return JSONResponse(status_code=400, content={"detail": "at least one clothing_images or clothing_ids entry is required"})
+    if n_items > pipeline.max_batch_items:
+        return JSONResponse(status_code=400, content={"detail": f"Batch too large ({n_items} items, max {pipeline.max_batch_items})"})
+    quality = max(1, min(100, int(quality)))
+
+    garments: List[Union[bytes, str]] = []
+    for cid in clothing_ids:
+        garment = await _catalog.aget(cid)
+        if garment is None:
+            return JSONResponse(status_code=404, content={"detail": f"Unknown clothing_id {cid}"})
+        garments.append(garment.b64)
+    users: List[bytes] = []
+    for field, uploads, out in (("user_images", user_images, users), ("clothing_images", clothing_images, garments)):
+        for i, upload in enumerate(uploads):
+            try:
+                with metrics.stage("upload_read"):
+                    raw = await read_upload(upload)
+                    probe_image(raw)
+            except UploadError as err:
+                return JSONResponse(status_code=err.status_code, content={"detail": f"{field}[{i}]: {err.detail}"})
+            await upload.close()
+            out.append(raw)
+
+    items = [{"item": u * len(garments) + g, "user": u, "garment": g} for u in range(len(users)) for g in range(len(garments))]
+    events = pipeline.iter_batch(users, garments, background, variants, image_format, quality)
+    del users, garments
+    if response_mode == "ndjson":
+        return StreamingResponse(streaming.batch_ndjson_stream(events, image_format, items), media_type="application/x-ndjson")
+
+    results: List[Dict[str, Any]] = [dict(item, images_base64=[]) for item in items]
+    async for event in events:
+        if event.image_b64 is not None:
+            results[event.item]["images_base64"].append(event.image_b64)
+        if event.error is not None:
+            results[event.item]["error"] = {"status": event.error.status_code, "detail": event.error.detail}
+    return JSONResponse({"items": results})
+
+
+@app.post("/api/jobs", status_code=202)
+async def submit_job(
+    user_image: UploadFile = File(...),
+    clothing_image: Optional[UploadFile] = File(None),
+    background: Background = Form(...),
+    variants: int = Form(1),
+    clothing_id: Optional[str] = Form(None),
+    image_format: Literal["png", "webp", "jpeg"] = Form("png"),
+    quality: int = Form(90),
+    webhook_url: Optional[str] = Form(None),
+):
+    """Queue a try-on; poll ``GET /api/jobs/{id}`` or receive the result at ``webhook_url``."""
+    if webhook_url:
+        try:
+            await jobs.validate_webhook_url(webhook_url)
+        except ValueError as err:
+            return JSONResponse(status_code=400, content={"detail": str(err)})
     try:
-        user_no_bg = remove(user_img, session=_rembg_session)
-    except Exception:
-        # If background removal fails, fallback to original
-        user_no_bg = user_img
-
-    # Ensure PNG bytes
-    out_buf = io.BytesIO()
-    user_no_bg.save(out_buf, format="PNG")
-    user_png = out_buf.getvalue()
-    # Free PIL objects early
+        user_bytes, clothing_bytes, garment = await _read_inputs(user_image, clothing_image, clothing_id)
+    except pipeline.PipelineError as err:
+        return JSONResponse(status_code=err.status_code, content={"detail": err.detail})
+
+    job = jobs.Job(
+        id=jobs.new_job_id(),
+        background=background,
+        variants=pipeline.variant_count(variants),
+        image_format=image_format,
+        quality=max(1, min(100, int(quality))),
+        webhook_url=webhook_url or None,
+    )
+    inputs = jobs.JobInputs(
+        user_image=user_bytes,
+        clothing_image=clothing_bytes if garment is None else None,
+        garment=garment.png if garment is not None else None,
+    )
     try:
-        user_img.close()
-        user_no_bg.close()
-    except Exception:
-        pass
-    del out_buf
-    gc.collect()
+        await _job_queue.submit(job, inputs)
+    except jobs.QueueFull:
+        return JSONResponse(status_code=503, content={"detail": "Job queue is full"}, headers={"Retry-After": "10"})
+    return {"id": job.id, "status": job.status, "poll_url": f"/api/jobs/{job.id}"}
 
-    # Ensure clothing is PNG bytes (and remove its background to avoid overlay/mannequin artifacts)
-    try:
-        cloth_img = Image.open(io.BytesIO(clothing_bytes)).convert("RGBA")
-        cloth_img = _downscale_max_dim(cloth_img, _max_dim)
-        try:
-            cloth_no_bg = remove(cloth_img, session=_rembg_session)
-        except Exception:
-            cloth_no_bg = cloth_img
-        out_cloth = io.BytesIO()
-        cloth_no_bg.save(out_cloth, format="PNG")
-        clothing_png = out_cloth.getvalue()
-        try:
-            cloth_img.close()
-            cloth_no_bg.close()
-        except Exception:
-            pass
-        del out_cloth
-    except Exception:
-        return JSONResponse(status_code=400, content={"detail": "Invalid clothing image"})
 
-    # Call Gemini for N variants (default 2)
-    images: list[str] = []
-    count = max(1, min(_max_variants, int(variants)))
-    for _ in range(count):
-        attempts = 0
-        accepted = False
-        last_b64: str | None = None
-        while attempts < _max_attempts and not accepted:
-            attempts += 1
-            try:
-                img_b64 = generate_tryon_image(
-                    user_png,
-                    clothing_png,
-                    background,
-                    strict=(attempts > 1),
-                    profile=os.getenv("PROMPT_PROFILE", "sep10"),
-                    retry_note=(
-                        "No overlays/collages/inset portraits. Do not place any faces on clothing. "
-                        "If any extra face is produced, discard and regenerate."
-                    ) if attempts > 1 else None,
-                )
-                generated_png = base64.b64decode(img_b64)
-                # Reject if collage/inset-face artifact is detected
-                if _reject_generated_if_collage(generated_png):
-                    last_b64 = img_b64
-                    continue
-                if _face_blend_enabled and attempts > 1:
-                    merged_png = _preserve_face_with_poisson(user_png, generated_png)
-                    if merged_png != generated_png:
-                        img_b64 = base64.b64encode(merged_png).decode('utf-8')
-                # Auto-crop letterbox if present
-                cropped_png = _auto_crop_letterbox(base64.b64decode(img_b64))
-                if cropped_png:
-                    img_b64 = base64.b64encode(cropped_png).decode('utf-8')
-                images.append(img_b64)
-                accepted = True
-            except Exception:
-                continue
-
-        # If all attempts were rejected by guards but we have a last image, return it instead of 500
-        if not accepted and last_b64:
-            images.append(last_b64)
-
-    if not images:
-        raise HTTPException(status_code=500, detail="Generation failed")
-
-    # Encourage memory release
-    gc.collect()
-    return {"images_base64": images}
+@app.get("/api/jobs/{job_id}")
+async def get_job(job_id: str):
+    job = await _job_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown job")
+    return JSONResponse(job.public())
+
+
+@app.get("/jobs/stats")
+async def job_stats():
+    return await _job_queue.stats()
 
 
 # Explicit CORS preflight handlers for browsers
@@ -423,23 +497,27 @@ async def tryon(
 def tryon_options():
     return JSONResponse({})
 
-# Serve built static files first (for assets like CSS, JS, images)
-try:
-    app.mount("/static", StaticFiles(directory="static"), name="static")
-except Exception:
-    pass
+# Built frontend: precompressed variants, ETags and cache policy (see app.assets). The
+# handlers only pick a file or an in-memory body, so they run on the event loop
+# and never wait for the thread pools that the try-on stages use
+_assets = assets.AssetFiles(assets.static_dir)
+
+
+@app.api_route("/static/{path:path}", methods=["GET", "HEAD"], include_in_schema=False)
+async def static_files(path: str, request: Request):
+    return _assets.response(path, request.headers)
 
-# SPA routes: serve index.html for client-side routes
+
+# SPA routes: serve index.html (held in memory) for client-side routes
 @app.get("/app", include_in_schema=False)
 @app.get("/signin", include_in_schema=False)
 @app.get("/signup", include_in_schema=False)
 @app.get("/auth", include_in_schema=False)
 @app.get("/account", include_in_schema=False)
-def spa_pages():
-    return FileResponse("static/index.html")
+async def spa_pages(request: Request):
+    return _assets.response(assets.INDEX, request.headers)
 
 # Also serve index.html for root path
 @app.get("/", include_in_schema=False)
-def spa_index():
-    return FileResponse("static/index.html")
-
+async def spa_index(request: Request):
+    return _assets.response(assets.INDEX, request.headers)
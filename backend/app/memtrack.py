@@ -0,0 +1,73 @@
+"""Opt-in per-request memory instrumentation (``MEMORY_TRACKING=1``).
+
+When enabled, tracemalloc runs for the life of the process and every HTTP response
+carries:
+
+- ``X-Mem-Py-Peak-MB``: peak Python-tracked allocation (including numpy arrays)
+  above the level at request start
+- ``X-Mem-RSS-MB``: process RSS when the response starts, and ``X-Mem-RSS-Delta-MB``
+
+Peaks are process-wide, so with concurrent requests they bound rather than isolate
+one request's usage; run at concurrency 1 for exact attribution. tracemalloc costs
+real CPU, so this stays off in production unless needed.
+"""
+import logging
+import os
+import threading
+import tracemalloc
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+enabled = os.getenv("MEMORY_TRACKING", "0").lower() in ("1", "true", "yes")
+
+_PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+_peak_lock = threading.Lock()
+
+
+def rss_bytes() -> Optional[int]:
+    """Current resident set size (Linux /proc), or None where unavailable."""
+    try:
+        with open("/proc/self/statm") as fh:
+            return int(fh.read().split()[1]) * _PAGE_SIZE
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def _mb(n: float) -> str:
+    return f"{n / (1024 * 1024):.1f}"
+
+
+class MemoryTrackingMiddleware:
+    def __init__(self, app) -> None:
+        self.app = app
+        if enabled and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    async def __call__(self, scope, receive, send):
+        if not enabled or scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        with _peak_lock:
+            start_py, _ = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+        start_rss = rss_bytes()
+
+        async def instrumented_send(message):
+            if message["type"] == "http.response.start":
+                _, peak_py = tracemalloc.get_traced_memory()
+                rss = rss_bytes()
+                headers = list(message.get("headers", []))
+                headers.append((b"x-mem-py-peak-mb", _mb(max(0, peak_py - start_py)).encode()))
+                if rss is not None and start_rss is not None:
+                    headers.append((b"x-mem-rss-mb", _mb(rss).encode()))
+                    headers.append((b"x-mem-rss-delta-mb", _mb(rss - start_rss).encode()))
+                message = {**message, "headers": headers}
+                logger.info(
+                    "memory %s %s: py_peak=+%sMB rss=%sMB",
+                    scope.get("method"), scope.get("path"), _mb(max(0, peak_py - start_py)),
+                    _mb(rss) if rss is not None else "?",
+                )
+            await send(message)
+
+        await self.app(scope, receive, instrumented_send)
@@ -0,0 +1,189 @@
+"""Prometheus metrics and optional OpenTelemetry spans for the try-on pipeline.
+
+``GET /metrics`` serves the Prometheus text format (no client library needed):
+
+- ``tryon_stage_seconds{stage}``: a histogram per pipeline stage. The stages are
+  ``upload_read``, ``decode``, ``rembg_user`` / ``rembg_clothing`` (plus
+  ``rembg_garment`` for catalog ingestion), ``png_encode``, ``base64`` (Gemini
+  request body), ``gemini`` (one per call, whatever the model) and the
+  post-processing stages ``postprocess_decode``, ``postprocess_detect`` (collage
+  guard), ``postprocess_blend`` (Poisson), ``postprocess_crop`` (letterbox) and
+  ``postprocess_encode``.
+- ``tryon_stage_queue_seconds{stage}``: time a blocking stage waited for its
+  concurrency slot and a pool thread. If this grows while CPU is idle, the
+  CPU_WORKERS / ``<STAGE>_CONCURRENCY`` limits are too small.
+- ``tryon_gemini_request_seconds{model,status}``: one sample per Gemini HTTP call.
+  ``status`` is the HTTP status, or ``error`` for network failures.
+- Counters: ``tryon_retries_total{reason}``, ``tryon_collage_rejections_total``,
+  ``tryon_model_fallbacks_total{model}``, ``tryon_coalesced_total``, and
+  ``tryon_cache_events_total{cache,event}`` for every ByteCache (hits, misses,
+  evictions, ...).
+- Gauges from the upstream limiter and circuit breakers.
+
+When ``opentelemetry-api`` is installed, every stage also opens a span named
+``tryon.<stage>``. Without an SDK configured (for example via
+``opentelemetry-instrument``) these spans are no-ops. Set ``OTEL_TRACING=0`` to
+skip them entirely.
+"""
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+try:
+    if os.getenv("OTEL_TRACING", "1").lower() in ("0", "false", "no"):
+        raise ImportError("disabled")
+    from opentelemetry import trace as _otel_trace
+
+    _tracer: Any = _otel_trace.get_tracer("tryon")
+except ImportError:
+    _tracer = None
+
+# Seconds; covers sub-millisecond encodes up to slow Gemini calls
+_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 40.0, 80.0)
+
+# name, type, help, labels, value
+Sample = Tuple[str, str, str, Dict[str, str], float]
+
+
+def _labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: Optional[Dict[str, str]] = None) -> str:
+    pairs = list(zip(names, values)) + list((extra or {}).items())
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+
+def _number(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str, label_names: Tuple[str, ...] = ()) -> None:
+        self.name = name
+        self.help = help_text
+        self.label_names = label_names
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def inc(self, n: float = 1, **labels: str) -> None:
+        key = tuple(str(labels.get(name, "")) for name in self.label_names)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + n
+
+    def value(self, **labels: str) -> float:
+        key = tuple(str(labels.get(name, "")) for name in self.label_names)
+        with self._lock:
+            return self._values.get(key, 0.0)
+
+    def render(self) -> List[str]:
+        with self._lock:
+            values = dict(self._values)
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        lines += [f"{self.name}{_labels(self.label_names, key)} {_number(v)}" for key, v in sorted(values.items())]
+        return lines
+
+
+class Histogram:
+    def __init__(
+        self, name: str, help_text: str, label_names: Tuple[str, ...] = (), buckets: Tuple[float, ...] = _BUCKETS
+    ) -> None:
+        self.name = name
+        self.help = help_text
+        self.label_names = label_names
+        self.buckets = buckets
+        self._series: Dict[Tuple[str, ...], List[float]] = {}  # bucket counts..., sum, count
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = tuple(str(labels.get(name, "")) for name in self.label_names)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0.0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+                    break
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self) -> List[str]:
+        with self._lock:
+            series = {key: list(s) for key, s in self._series.items()}
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for key, s in sorted(series.items()):
+            cumulative = 0.0
+            for bound, n in zip(self.buckets + (math.inf,), s[:-2] + [s[-1] - sum(s[:-2])]):
+                cumulative += n
+                lines.append(f"{self.name}_bucket{_labels(self.label_names, key, {'le': _number(bound)})} {_number(cumulative)}")
+            lines.append(f"{self.name}_sum{_labels(self.label_names, key)} {_number(s[-2])}")
+            lines.append(f"{self.name}_count{_labels(self.label_names, key)} {_number(s[-1])}")
+        return lines
+
+
+_registry: List[Any] = []
+_collectors: List[Callable[[], Iterable[Sample]]] = []
+
+stage_seconds = Histogram("tryon_stage_seconds", "Time spent in each try-on pipeline stage", ("stage",))
+stage_queue_seconds = Histogram(
+    "tryon_stage_queue_seconds", "Wait for a stage concurrency slot and pool thread", ("stage",)
+)
+gemini_seconds = Histogram("tryon_gemini_request_seconds", "Gemini HTTP calls by model and status", ("model", "status"))
+retries = Counter("tryon_retries_total", "Generation attempts repeated, by reason", ("reason",))
+collage_rejections = Counter("tryon_collage_rejections_total", "Generated images rejected by the collage guard")
+model_fallbacks = Counter("tryon_model_fallbacks_total", "Gemini calls sent to a fallback model", ("model",))
+coalesced = Counter("tryon_coalesced_total", "Requests served by joining an identical in-flight generation")
+cutout_failures = Counter("tryon_cutout_failures_total", "rembg failures, by role (nothing is cached for them)", ("role",))
+hedges = Counter("tryon_hedges_total", "Hedged (duplicate) generation attempts: started, and won the race", ("event",))
+
+
+def add_collector(collect: Callable[[], Iterable[Sample]]) -> None:
+    """Register a callable producing samples at scrape time (cache and upstream state)."""
+    _collectors.append(collect)
+
+
+@contextmanager
+def span(name: str, **attributes: Any) -> Iterator[Any]:
+    """OpenTelemetry span (None when tracing is unavailable)."""
+    if _tracer is None:
+        yield None
+        return
+    with _tracer.start_as_current_span(name, attributes=attributes or None) as current:
+        yield current
+
+
+@contextmanager
+def stage(name: str, **attributes: Any) -> Iterator[Any]:
+    """Time a pipeline stage into ``tryon_stage_seconds`` and trace it as ``tryon.<name>``."""
+    t0 = time.perf_counter()
+    try:
+        with span(f"tryon.{name}", **attributes) as current:
+            yield current
+    finally:
+        stage_seconds.observe(time.perf_counter() - t0, stage=name)
+
+
+def render() -> str:
+    lines: List[str] = []
+    for metric in _registry:
+        lines += metric.render()
+    grouped: Dict[str, Tuple[str, str, List[str]]] = {}
+    for collect in list(_collectors):
+        try:
+            samples = list(collect())
+        except Exception:
+            continue
+        for name, kind, help_text, labels, value in samples:
+            entry = grouped.setdefault(name, (kind, help_text, []))
+            names = tuple(labels)
+            entry[2].append(f"{name}{_labels(names, tuple(labels[k] for k in names))} {_number(value)}")
+    for name, (kind, help_text, samples) in grouped.items():
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"] + samples
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,559 @@
+"""Try-on generation pipeline, shared by the request handlers and the job workers.
+
+Inputs are background-removed once (``prepare``); then N variants are generated
+concurrently under one deadline (``iter_variants`` / ``generate_variants``), each
+retried up to RETRIES times through the collage guard, face blend and letterbox crop.
+``iter_batch`` runs the user x garment cross product of a batch. Each distinct input
+is cut out and encoded for Gemini once, and items are fanned out under a per-batch cap.
+Within a request the encoded images and request bodies are shared by every attempt,
+variant and model fallback (``gemini.EncodedInputs``).
+
+With GEMINI_HEDGE=1 a slow attempt is raced against a duplicate call, on
+GEMINI_HEDGE_MODEL if set and on the same model otherwise, within a per-request
+budget (``_generate_hedged``, app.upstream).
+
+Complete results are cached (``result_cache``). The key hashes the cut-out inputs
+together with everything else that shapes the output: background, prompt profile,
+model, variant count and output format. Concurrent identical requests share one
+generation that is already in flight instead of starting their own.
+"""
+import asyncio
+import base64
+import hashlib
+import os
+from typing import AsyncIterator, Dict, List, NamedTuple, Optional, Tuple, Union
+
+from . import executor
+from . import metrics
+from . import postprocess
+from . import preprocess
+from . import upstream
+from .cache import ByteCache, content_key
+from .executor import run_stage
+from .gemini import (
+    DEFAULT_MODEL, EncodedInputs, InlineImage, encode_inline, generate_tryon_image_async,
+)
+
+# Configurable generation behaviour (override via env)
+_face_blend_enabled = os.getenv("FACE_BLEND", "1").lower() not in ("0", "false", "no")
+try:
+    _max_variants = max(1, min(3, int(os.getenv("MAX_VARIANTS", "1"))))
+except Exception:
+    _max_variants = 1
+try:
+    _max_attempts = max(1, min(3, int(os.getenv("RETRIES", "1"))))
+except Exception:
+    _max_attempts = 1
+# Whole-request budget for generation (kept under Heroku's 30 s router timeout), and how
+# long to keep waiting for the remaining variants once the first one is accepted
+try:
+    _request_timeout = max(1.0, float(os.getenv("TRYON_TIMEOUT", "25")))
+except Exception:
+    _request_timeout = 25.0
+try:
+    _variant_grace = max(0.0, float(os.getenv("VARIANT_GRACE", "5")))
+except Exception:
+    _variant_grace = 5.0
+
+# Batch requests: at most BATCH_MAX_ITEMS user x garment pairs, BATCH_CONCURRENCY generating at once
+try:
+    max_batch_items = max(1, int(os.getenv("BATCH_MAX_ITEMS", "20")))
+except Exception:
+    max_batch_items = 20
+try:
+    _batch_concurrency = max(1, int(os.getenv("BATCH_CONCURRENCY", "4")))
+except Exception:
+    _batch_concurrency = 4
+
+# Result cache: byte-bounded LRU with TTL plus optional disk tier (RESULT_CACHE_MB=0 and no dir disables it)
+try:
+    _result_cache_bytes = max(0, int(os.getenv("RESULT_CACHE_MB", "128"))) * 1024 * 1024
+except Exception:
+    _result_cache_bytes = 128 * 1024 * 1024
+try:
+    _result_cache_disk_bytes = max(0, int(os.getenv("RESULT_CACHE_DISK_MB", "1024"))) * 1024 * 1024
+except Exception:
+    _result_cache_disk_bytes = 1024 * 1024 * 1024
+try:
+    _result_cache_ttl = max(1.0, float(os.getenv("RESULT_CACHE_TTL", "3600")))
+except Exception:
+    _result_cache_ttl = 3600.0
+result_cache = ByteCache(
+    "result",
+    _result_cache_bytes,
+    disk_dir=os.getenv("RESULT_CACHE_DIR") or None,
+    disk_max_bytes=_result_cache_disk_bytes,
+    ttl=_result_cache_ttl,
+)
+_result_cache_enabled = _result_cache_bytes > 0 or bool(os.getenv("RESULT_CACHE_DIR"))
+
+# result key -> images of the generation in flight for it (None if it was abandoned)
+_inflight: Dict[str, "asyncio.Future[Optional[Tuple[List[str], bool]]]"] = {}
+_coalesced = {"joined": 0}
+
+
+class PipelineError(Exception):
+    def __init__(self, status_code: int, detail: str, retry_after: Optional[float] = None) -> None:
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+        self.retry_after = retry_after
+
+
+def generation_failed(timed_out: bool) -> PipelineError:
+    unavailable = upstream.unavailable_for()
+    if unavailable is not None:
+        # Every model's circuit breaker is open: shed load instead of reporting a 500
+        return PipelineError(503, "Generation temporarily unavailable", retry_after=max(1.0, unavailable))
+    if timed_out:
+        return PipelineError(504, "Generation timed out")
+    return PipelineError(500, "Generation failed")
+
+
+def variant_count(requested: int) -> int:
+    return max(1, min(_max_variants, int(requested)))
+
+
+async def prepare(
+    user_bytes: bytes, clothing_bytes: Optional[bytes] = None, garment: Union[bytes, str, None] = None,
+    user_mask: Optional[bytes] = None, clothing_mask: Optional[bytes] = None,
+) -> Tuple[bytes, Union[bytes, str]]:
+    """Background-removed user PNG and clothing. A registered ``garment`` (already cut out,
+    PNG bytes or base64) is used as is; otherwise ``clothing_bytes`` is cut out too.
+    ``user_mask`` / ``clothing_mask`` are client-computed masks that replace the rembg pass.
+    """
+    # Background removal on user image
+    user_png = await _cutout(user_bytes, user_mask, "user")
+    if garment is not None:
+        return user_png, garment
+    # Remove the clothing background as well to avoid overlay/mannequin artifacts
+    clothing_png = await _cutout(clothing_bytes or b"", clothing_mask, "clothing")
+    return user_png, clothing_png
+
+
+async def _cutout(raw: bytes, mask: Optional[bytes], role: str) -> bytes:
+    if mask is None:
+        try:
+            return await preprocess.cutout_png(raw, role)
+        except Exception:
+            raise PipelineError(400, f"Invalid {role} image")
+    try:
+        return await run_stage("decode", preprocess.apply_mask_png, raw, mask)
+    except preprocess.MaskError as err:
+        raise PipelineError(400, f"{role}_mask: {err}")
+    except Exception:
+        raise PipelineError(400, f"Invalid {role} image")
+
+
+def _postprocess_generated(
+    user: Union[bytes, postprocess.FaceSource], img_b64: str, attempt: int, fmt: str, quality: int
+) -> Optional[Tuple[str, str]]:
+    """Collage guard, face blend and letterbox crop for one generated image.
+    Returns the final base64 image and its format (``fmt``, or PNG when it could not be
+    encoded as ``fmt``), or None when the image is rejected as a collage.
+    """
+    result = postprocess.run(user, img_b64, blend=_face_blend_enabled and attempt > 1, fmt=fmt, quality=quality)
+    return (result.image_b64, result.fmt) if result.image_b64 is not None else None
+
+
+_RETRY_NOTE = (
+    "No overlays/collages/inset portraits. Do not place any faces on clothing. "
+    "If any extra face is produced, discard and regenerate."
+)
+
+
+async def _attempt(
+    user_png: bytes, clothing_png: Union[bytes, str], background: str, fmt: str, quality: int,
+    inputs: Optional[EncodedInputs], attempt: int, model: str = DEFAULT_MODEL,
+    answered: Optional[asyncio.Event] = None, face: Optional[postprocess.FaceSource] = None,
+) -> Tuple[Optional[Tuple[str, str]], str]:
+    """One Gemini call and its post-processing. Attempts after the first use the strict prompt.
+    ``answered`` is set once Gemini has returned an image. ``face`` is the request's user
+    face for the blend (shared by its variants).
+    Returns ((accepted_b64, format) or None when rejected, raw model output).
+    """
+    async with executor.limit("gemini"):
+        img_b64 = await generate_tryon_image_async(
+            user_png,
+            clothing_png,
+            background,
+            model=model,
+            strict=(attempt > 1),
+            profile=os.getenv("PROMPT_PROFILE", "sep10"),
+            retry_note=_RETRY_NOTE if attempt > 1 else None,
+            inputs=inputs,
+        )
+    if answered is not None:
+        answered.set()
+    final = await run_stage("postprocess", _postprocess_generated, face or user_png, img_b64, attempt, fmt, quality)
+    return final, img_b64
+
+
+class _HedgeBudget:
+    """Duplicate attempts a request may still start (GEMINI_HEDGE_BUDGET, shared by its variants)."""
+
+    def __init__(self, budget: int) -> None:
+        self.remaining = budget
+
+    def take(self) -> bool:
+        if self.remaining <= 0:
+            return False
+        self.remaining -= 1
+        return True
+
+
+async def _generate_variant(
+    user_png: bytes, clothing_png: Union[bytes, str], background: str, fmt: str, quality: int,
+    inputs: Optional[EncodedInputs] = None, hedge: Optional[_HedgeBudget] = None,
+    face: Optional[postprocess.FaceSource] = None,
+) -> Tuple[Optional[Tuple[str, str]], Optional[str]]:
+    """Generate one variant, retrying up to RETRIES times. ``inputs`` (the request's
+    encoded images) skips re-encoding them for every Gemini call. With a ``hedge``
+    budget, slow attempts are hedged (``_generate_hedged``).
+    Returns ((accepted_b64, format), None) or (None, last_rejected_b64); the rejected
+    image is still raw model output.
+    """
+    if hedge is not None and upstream.hedge_delay() is not None:
+        return await _generate_hedged(user_png, clothing_png, background, fmt, quality, inputs, hedge, face)
+    last_b64: Optional[str] = None
+    for attempts in range(1, _max_attempts + 1):
+        try:
+            final, img_b64 = await _attempt(
+                user_png, clothing_png, background, fmt, quality, inputs, attempts, face=face
+            )
+            if final is None:
+                # Rejected as collage/inset-face artifact
+                last_b64 = img_b64
+                if attempts < _max_attempts:
+                    metrics.retries.inc(reason="collage")
+                continue
+            return final, None
+        except (upstream.UpstreamBusy, upstream.UpstreamUnavailable):
+            # Shedding load; further attempts would only add to it
+            break
+        except Exception:
+            if attempts < _max_attempts:
+                metrics.retries.inc(reason="error")
+            continue
+    return None, last_b64
+
+
+async def _generate_hedged(
+    user_png: bytes, clothing_png: Union[bytes, str], background: str, fmt: str, quality: int,
+    inputs: Optional[EncodedInputs], hedge: _HedgeBudget, face: Optional[postprocess.FaceSource] = None,
+) -> Tuple[Optional[Tuple[str, str]], Optional[str]]:
+    """``_generate_variant`` with hedging. When Gemini has not answered any running
+    attempt within ``upstream.hedge_delay()``, a duplicate of the newest attempt starts on
+    ``upstream.hedge_model`` (the same model when unset), if the budget and the limiter
+    allow it. Only the Gemini
+    call is hedged: an attempt already in post-processing is not duplicated. The first
+    image that passes the collage guard wins and the attempts still running are
+    cancelled. A failed or rejected attempt is retried (up to RETRIES) once nothing
+    else is running.
+    """
+    running: Dict["asyncio.Future[Tuple[Optional[Tuple[str, str]], str]]", Tuple[int, bool, asyncio.Event]] = {}
+    attempts = 1
+    last_b64: Optional[str] = None
+    shedding = False
+    reason = "error"
+
+    def launch(attempt: int, hedged: bool) -> None:
+        model = (upstream.hedge_model or DEFAULT_MODEL) if hedged else DEFAULT_MODEL
+        answered = asyncio.Event()
+        task = asyncio.ensure_future(
+            _attempt(user_png, clothing_png, background, fmt, quality, inputs, attempt, model, answered, face)
+        )
+        running[task] = (attempt, hedged, answered)
+
+    launch(1, False)
+    try:
+        while running:
+            delay = None if shedding or hedge.remaining <= 0 else upstream.hedge_delay()
+            done, _ = await asyncio.wait(list(running), timeout=delay, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                waiting = not any(answered.is_set() for _, _, answered in running.values())
+                if waiting and upstream.can_hedge() and hedge.take():
+                    metrics.hedges.inc(event="started")
+                    launch(max(attempt for attempt, _, _ in running.values()), True)
+                continue
+            for task in done:
+                _, hedged, _ = running.pop(task)
+                err = task.exception()
+                if err is not None:
+                    # Shedding load: let what is running finish, but start nothing new
+                    shedding = shedding or isinstance(err, (upstream.UpstreamBusy, upstream.UpstreamUnavailable))
+                    reason = "error"
+                    continue
+                final, img_b64 = task.result()
+                if final is not None:
+                    if hedged:
+                        metrics.hedges.inc(event="won")
+                    return final, None
+                last_b64 = img_b64
+                reason = "collage"
+            if not running and not shedding and attempts < _max_attempts:
+                metrics.retries.inc(reason=reason)
+                attempts += 1
+                launch(attempts, False)
+    finally:
+        for task in running:
+            task.cancel()
+    return None, last_b64
+
+
+class VariantEvent(NamedTuple):
+    image_b64: Optional[str]  # None on the final event
+    timed_out: bool = False
+    fallback: bool = False  # a rejected image returned for want of an accepted one
+    fmt: Optional[str] = None  # format image_b64 is actually in (see OUTPUT_FORMATS)
+
+
+def result_key(
+    user_png: bytes, clothing_png: Union[bytes, str], background: str, count: int, fmt: str, quality: int,
+    blend_mode: Optional[str] = None,
+) -> str:
+    """Result cache key over the cut-out inputs and every parameter that shapes the output."""
+    clothing = base64.b64decode(clothing_png) if isinstance(clothing_png, str) else clothing_png
+    # A blend mode chosen per request joins the key; the default keeps existing keys valid
+    extra = (blend_mode,) if blend_mode else ()
+    return content_key(
+        user_png,
+        hashlib.sha256(clothing).hexdigest(),
+        background,
+        os.getenv("PROMPT_PROFILE", "sep10"),
+        DEFAULT_MODEL,
+        count,
+        fmt,
+        quality if fmt != "png" else 0,
+        _face_blend_enabled,
+        *extra,
+    )
+
+
+def _pack(images: List[Tuple[str, str]]) -> bytes:
+    return "\n".join(f"{fmt}:{b64}" for b64, fmt in images).encode("ascii")
+
+
+def _unpack(data: bytes, fmt: str) -> List[Tuple[str, str]]:
+    images = []
+    for line in data.decode("ascii").split("\n"):
+        # Entries written before formats were stored hold bare base64 in the requested format
+        image_fmt, sep, b64 = line.partition(":")
+        images.append((b64, image_fmt) if sep else (line, fmt))
+    return images
+
+
+async def iter_variants(
+    user_png: bytes, clothing_png: Union[bytes, str], background: str, count: int,
+    fmt: str = "png", quality: int = 90, timeout: Optional[float] = None,
+    user_inline: Optional[InlineImage] = None, clothing_inline: Optional[InlineImage] = None, use_cache: bool = True,
+    blend_mode: Optional[str] = None,
+) -> AsyncIterator[VariantEvent]:
+    """``_iter_generated`` behind the result cache. A hit (or an identical generation
+    already in flight) replays its images; only complete sets of accepted images
+    are stored. ``use_cache=False`` always generates anew.
+    """
+    if not (use_cache and _result_cache_enabled):
+        async for event in _iter_generated(
+            user_png, clothing_png, background, count, fmt, quality, timeout, user_inline, clothing_inline, blend_mode
+        ):
+            yield event
+        return
+    key = await run_stage("encode", result_key, user_png, clothing_png, background, count, fmt, quality, blend_mode)
+    cached = await result_cache.aget(key)
+    if cached is not None:
+        for image, image_fmt in _unpack(cached, fmt):
+            yield VariantEvent(image, fmt=image_fmt)
+        yield VariantEvent(None)
+        return
+
+    loop = asyncio.get_running_loop()
+    shared = _inflight.get(key)
+    if shared is not None and shared.get_loop() is loop:
+        _coalesced["joined"] += 1
+        metrics.coalesced.inc()
+        # Shielded: a waiter going away must not cancel the owner's future
+        outcome = await asyncio.shield(shared)
+        if outcome is not None:
+            images, timed_out = outcome
+            for image, image_fmt in images:
+                yield VariantEvent(image, fmt=image_fmt)
+            yield VariantEvent(None, timed_out=timed_out)
+            return
+        # The owner was abandoned mid-way; generate here instead
+
+    future: "asyncio.Future[Optional[Tuple[List[Tuple[str, str]], bool]]]" = loop.create_future()
+    _inflight[key] = future
+    images: List[Tuple[str, str]] = []
+    accepted = 0
+    try:
+        async for event in _iter_generated(
+            user_png, clothing_png, background, count, fmt, quality, timeout, user_inline, clothing_inline, blend_mode
+        ):
+            if event.image_b64 is None:
+                # Settle before the final event: consumers may stop iterating right after it
+                future.set_result((images, event.timed_out))
+                if accepted == count:
+                    await result_cache.aput(key, _pack(images))
+            else:
+                images.append((event.image_b64, event.fmt or fmt))
+                accepted += 0 if event.fallback else 1
+            yield event
+    finally:
+        if _inflight.get(key) is future:
+            del _inflight[key]
+        if not future.done():
+            future.set_result(None)
+
+
+async def _iter_generated(
+    user_png: bytes, clothing_png: Union[bytes, str], background: str, count: int,
+    fmt: str = "png", quality: int = 90, timeout: Optional[float] = None,
+    user_inline: Optional[InlineImage] = None, clothing_inline: Optional[InlineImage] = None,
+    blend_mode: Optional[str] = None,
+) -> AsyncIterator[VariantEvent]:
+    """Run ``count`` variants concurrently within ``timeout`` (default TRYON_TIMEOUT),
+    yielding each accepted image as soon as it is ready.
+
+    Once the first variant is accepted the others get at most VARIANT_GRACE more
+    seconds. Variants still running at the deadline (or when the consumer goes away)
+    are cancelled. Variants that never passed the guards contribute their last
+    rejected image at the end, instead of a 500. The last event carries no image and
+    says whether the deadline was hit. ``user_inline`` / ``clothing_inline`` are the
+    inputs already encoded for Gemini (batches encode each distinct input once).
+    ``blend_mode`` overrides FACE_BLEND_MODE; the user face crop is computed once for
+    all variants.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + (timeout or _request_timeout)
+    inputs = await run_stage("encode", EncodedInputs, user_inline or user_png, clothing_inline or clothing_png)
+    hedge = _HedgeBudget(upstream.hedge_budget)
+    face = postprocess.FaceSource(user_png, blend_mode)
+    tasks = [
+        asyncio.ensure_future(_generate_variant(user_png, clothing_png, background, fmt, quality, inputs, hedge, face))
+        for _ in range(count)
+    ]
+    fallbacks: List[str] = []
+    pending = set(tasks)
+    grace_started = False
+    try:
+        while pending:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            done, pending = await asyncio.wait(pending, timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.cancelled() or task.exception() is not None:
+                    continue
+                ok, rejected_b64 = task.result()
+                if ok:
+                    if not grace_started:
+                        grace_started = True
+                        deadline = min(deadline, loop.time() + _variant_grace)
+                    yield VariantEvent(ok[0], fmt=ok[1])
+                elif rejected_b64:
+                    fallbacks.append(rejected_b64)
+    finally:
+        for task in pending:
+            task.cancel()
+    for rejected_b64 in fallbacks:
+        image, image_fmt = await run_stage("postprocess", postprocess.transcode, rejected_b64, fmt, quality)
+        yield VariantEvent(image, fallback=True, fmt=image_fmt)
+    yield VariantEvent(None, timed_out=bool(pending) and not grace_started)
+
+
+async def generate_variants(
+    user_png: bytes, clothing_png: Union[bytes, str], background: str, count: int,
+    fmt: str = "png", quality: int = 90, timeout: Optional[float] = None, use_cache: bool = True,
+    blend_mode: Optional[str] = None,
+) -> Tuple[List[str], bool]:
+    """All images from ``iter_variants`` and whether the deadline was hit."""
+    images: List[str] = []
+    async for event in iter_variants(
+        user_png, clothing_png, background, count, fmt, quality, timeout, use_cache=use_cache, blend_mode=blend_mode
+    ):
+        if event.image_b64 is None:
+            return images, event.timed_out
+        images.append(event.image_b64)
+    return images, False
+
+
+class BatchEvent(NamedTuple):
+    item: int  # index into the user x garment product (user-major)
+    image_b64: Optional[str] = None  # one image of the item
+    fmt: Optional[str] = None  # format image_b64 is actually in
+    error: Optional[PipelineError] = None  # set on the item's final event when it failed
+    done: bool = False  # the item's final event
+
+
+async def _cutout_inline(raw: Union[bytes, str], what: str) -> Tuple[Union[bytes, str], InlineImage]:
+    """Cut-out of an upload (a registered garment, as str, already is one) and its inline part."""
+    if isinstance(raw, str):
+        return raw, await run_stage("encode", encode_inline, raw)
+    try:
+        png = await preprocess.cutout_png(raw, what)
+    except Exception:
+        raise PipelineError(400, f"Invalid {what} image")
+    return png, await run_stage("encode", encode_inline, png)
+
+
+async def iter_batch(
+    users: List[bytes], garments: List[Union[bytes, str]], background: str, variants: int = 1,
+    fmt: str = "png", quality: int = 90, concurrency: Optional[int] = None,
+) -> AsyncIterator[BatchEvent]:
+    """Generate every user x garment pair, yielding images as they are accepted.
+
+    ``users`` are raw uploads. ``garments`` are raw uploads (bytes) or registered
+    garment cut-outs (base64 str). Every distinct input is cut out and encoded once,
+    as soon as the batch starts, and each item starts as soon as its two inputs are
+    ready. Items run ``concurrency`` at a time, and each gets its own
+    TRYON_TIMEOUT. A failed item ends with an error event; the other items go on.
+    """
+    count = variant_count(variants)
+    user_inputs = [asyncio.ensure_future(_cutout_inline(raw, "user")) for raw in users]
+    garment_inputs = [asyncio.ensure_future(_cutout_inline(g, "clothing")) for g in garments]
+    limit = asyncio.Semaphore(concurrency or _batch_concurrency)
+    events: "asyncio.Queue[BatchEvent]" = asyncio.Queue()
+
+    async def run_item(item: int, user: int, garment: int) -> None:
+        produced = 0
+        try:
+            user_png, user_inline = await user_inputs[user]
+            clothing, clothing_inline = await garment_inputs[garment]
+            async with limit:
+                async for event in iter_variants(
+                    user_png, clothing, background, count, fmt, quality,
+                    user_inline=user_inline, clothing_inline=clothing_inline,
+                ):
+                    if event.image_b64 is None:
+                        if not produced:
+                            raise generation_failed(event.timed_out)
+                        break
+                    produced += 1
+                    events.put_nowait(BatchEvent(item, image_b64=event.image_b64, fmt=event.fmt))
+            events.put_nowait(BatchEvent(item, done=True))
+        except PipelineError as err:
+            events.put_nowait(BatchEvent(item, error=err, done=True))
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            events.put_nowait(BatchEvent(item, error=PipelineError(500, "Generation failed"), done=True))
+
+    tasks = [
+        asyncio.ensure_future(run_item(u * len(garments) + g, u, g))
+        for u in range(len(users)) for g in range(len(garments))
+    ]
+    remaining = len(tasks)
+    try:
+        while remaining:
+            event = await events.get()
+            if event.done:
+                remaining -= 1
+            yield event
+    finally:
+        for task in tasks + user_inputs + garment_inputs:
+            task.cancel()
+
+
+def result_cache_stats() -> Dict[str, object]:
+    return {**result_cache.stats(), "enabled": _result_cache_enabled, "inflight": len(_inflight), **_coalesced}
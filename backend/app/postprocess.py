@@ -0,0 +1,506 @@
+"""Post-processing of generated images.
+
+Gemini's output is decoded exactly once into a BGR ndarray; the collage guard, the
+face-preservation blend (bounded to a region around the face, see ``blend_face``)
+and the letterbox crop then run as stages on that array, and the result is encoded
+once at the end, as PNG or as WebP/JPEG when the client asked for a lossy format
+(or not at all when no stage changed the pixels and PNG was requested). Every run
+records a per-stage timing breakdown, returned with the result, aggregated
+process-wide in ``stage_stats()`` and exported as Prometheus histograms (see
+app.metrics).
+"""
+import base64
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, NamedTuple, Optional, Tuple, Union
+
+import cv2
+import numpy as np
+
+from . import metrics
+from .faces import Box, detect_faces, largest_face
+
+logger = logging.getLogger(__name__)
+
+_totals: Dict[str, List[float]] = {}  # stage -> [count, total seconds]
+_totals_lock = threading.Lock()
+
+
+class PostprocessResult(NamedTuple):
+    image_b64: Optional[str]  # None when rejected as a collage
+    timings: Dict[str, float]  # seconds per stage
+    fmt: str = "png"  # format image_b64 is actually in (PNG when encoding as requested failed)
+
+
+@contextmanager
+def _timed(timings: Dict[str, float], stage: str) -> Iterator[None]:
+    t0 = time.perf_counter()
+    try:
+        with metrics.span(f"tryon.postprocess_{stage}"):
+            yield
+    finally:
+        timings[stage] = timings.get(stage, 0.0) + (time.perf_counter() - t0)
+
+
+def _record(timings: Dict[str, float]) -> None:
+    with _totals_lock:
+        for stage, seconds in timings.items():
+            entry = _totals.setdefault(stage, [0, 0.0])
+            entry[0] += 1
+            entry[1] += seconds
+    for stage, seconds in timings.items():
+        metrics.stage_seconds.observe(seconds, stage=f"postprocess_{stage}")
+
+
+def stage_stats() -> Dict[str, Dict[str, float]]:
+    with _totals_lock:
+        return {
+            stage: {"count": int(count), "total_s": total, "mean_ms": (total / count * 1000) if count else 0.0}
+            for stage, (count, total) in _totals.items()
+        }
+
+
+def decode_png(data: bytes) -> Optional[np.ndarray]:
+    return cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+
+
+# Output format -> (cv2 extension, MIME type)
+OUTPUT_FORMATS: Dict[str, Tuple[str, str]] = {
+    "png": (".png", "image/png"),
+    "webp": (".webp", "image/webp"),
+    "jpeg": (".jpg", "image/jpeg"),
+}
+
+
+def encode_image(bgr: np.ndarray, fmt: str = "png", quality: int = 90) -> Optional[bytes]:
+    """Encode a BGR image as ``fmt`` (see OUTPUT_FORMATS); ``quality`` applies to WebP/JPEG."""
+    ext, _ = OUTPUT_FORMATS[fmt]
+    params: List[int] = []
+    if fmt == "jpeg":
+        params = [cv2.IMWRITE_JPEG_QUALITY, int(quality)]
+    elif fmt == "webp":
+        params = [cv2.IMWRITE_WEBP_QUALITY, int(quality)]
+    ok, buf = cv2.imencode(ext, bgr, params)
+    return buf.tobytes() if ok else None
+
+
+def transcode(img_b64: str, fmt: str = "png", quality: int = 90) -> Tuple[str, str]:
+    """Re-encode a base64 PNG as ``fmt``. Returns (image, its actual format): the input
+    is returned untouched, as PNG, for PNG or when it cannot be re-encoded.
+    """
+    if fmt == "png":
+        return img_b64, "png"
+    bgr = decode_png(base64.b64decode(img_b64))
+    data = encode_image(bgr, fmt, quality) if bgr is not None else None
+    if data is None:
+        return img_b64, "png"
+    return base64.b64encode(data).decode("utf-8"), fmt
+
+
+def is_collage(faces: List[Box], shape: Tuple[int, int]) -> bool:
+    """Heuristic filter to catch collage/inset-face artifacts.
+    Reject when: more than one detected face, or the only detected face sits unusually low
+    (e.g., embedded on clothing) relative to image height. ``faces`` come from
+    detect_faces(min_size=50) on an image of ``shape`` (H, W).
+    """
+    if len(faces) == 0:
+        # Sometimes the face detector misses valid faces; don't over-reject
+        return False
+    if len(faces) > 1:
+        return True
+    (x, y, w, h) = faces[0]
+    H, W = shape
+    # Reject if face center is below ~70% height (more lenient for pose/composition changes)
+    cy = y + h / 2.0
+    if cy > 0.7 * H:
+        return True
+    # Reject if face area is implausibly small/large
+    area_ratio = (w * h) / float(max(1, W * H))
+    if area_ratio < 0.008 or area_ratio > 0.40:
+        return True
+    return False
+
+
+def reject_if_collage(bgr: np.ndarray) -> bool:
+    try:
+        return is_collage(detect_faces(bgr, min_size=50), bgr.shape[:2])
+    except Exception:
+        return False
+
+
+# Face blend engine (FACE_BLEND_MODE, or per request): poisson, feather (color-matched
+# alpha feathering), laplacian (color-matched multi-band) or auto, which uses Poisson up
+# to FACE_BLEND_POISSON_MAX_PX region pixels and Laplacian above. Every mode works on
+# the face box padded by _FACE_ROI_PAD on each side, not on the whole frame.
+BLEND_MODES = ("auto", "poisson", "feather", "laplacian")
+_blend_mode = os.getenv("FACE_BLEND_MODE", "auto").lower()
+if _blend_mode not in BLEND_MODES:
+    _blend_mode = "auto"
+try:
+    _poisson_max_px = max(0, int(os.getenv("FACE_BLEND_POISSON_MAX_PX", "250000")))
+except Exception:
+    _poisson_max_px = 250000
+_FACE_ROI_PAD = 0.25
+
+
+def user_face_crop(user_bgr: np.ndarray) -> Optional[np.ndarray]:
+    """The largest face in the user image, cropped (None when there is none)."""
+    src_box = largest_face(detect_faces(user_bgr, min_size=60))
+    if src_box is None:
+        return None
+    sx, sy, sw, sh = src_box
+    crop = user_bgr[max(sy, 0): sy + sh, max(sx, 0): sx + sw]
+    return crop if crop.size else None
+
+
+class FaceSource:
+    """The user side of the face blend for one request: the user image, its face crop
+    (decoded, detected and cropped on first use, then shared by every variant and
+    attempt) and the blend mode (None: FACE_BLEND_MODE).
+    """
+
+    def __init__(self, user_png: bytes, mode: Optional[str] = None) -> None:
+        self.user_png = user_png
+        self.mode = mode
+        self._crop: Optional[np.ndarray] = None
+        self._done = False
+        self._lock = threading.Lock()
+
+    def face(self) -> Optional[np.ndarray]:
+        with self._lock:
+            if not self._done:
+                try:
+                    user_bgr = decode_png(self.user_png)
+                    self._crop = user_face_crop(user_bgr) if user_bgr is not None else None
+                except Exception:
+                    self._crop = None
+                self._done = True
+            return self._crop
+
+
+def _match_color(src: np.ndarray, dst: np.ndarray, mask: np.ndarray) -> np.ndarray:
+    """``src`` with per-channel mean and spread moved to those of ``dst`` under ``mask``."""
+    inside = mask > 0
+    if not inside.any():
+        return src
+    s = src.astype(np.float32)
+    s_pix, d_pix = s[inside], dst[inside].astype(np.float32)
+    s_mean, s_std = s_pix.mean(axis=0), s_pix.std(axis=0) + 1e-3
+    d_mean, d_std = d_pix.mean(axis=0), d_pix.std(axis=0)
+    gain = np.clip(d_std / s_std, 0.5, 2.0)
+    return np.clip((s - s_mean) * gain + d_mean, 0, 255).astype(np.uint8)
+
+
+def _feather_blend(src: np.ndarray, dst: np.ndarray, mask: np.ndarray, sigma: float) -> np.ndarray:
+    alpha = cv2.GaussianBlur(mask.astype(np.float32) * (1.0 / 255.0), (0, 0), sigma)[..., None]
+    return (src * alpha + dst * (1.0 - alpha) + 0.5).astype(np.uint8)
+
+
+def _laplacian_blend(src: np.ndarray, dst: np.ndarray, mask: np.ndarray, levels: int) -> np.ndarray:
+    """Multi-band blend: each Laplacian pyramid band is mixed with a matching blur of the mask."""
+    ga, gb = [src.astype(np.float32)], [dst.astype(np.float32)]
+    gm = [mask.astype(np.float32) * (1.0 / 255.0)]
+    for _ in range(levels):
+        ga.append(cv2.pyrDown(ga[-1]))
+        gb.append(cv2.pyrDown(gb[-1]))
+        gm.append(cv2.pyrDown(gm[-1]))
+    m = gm[-1][..., None]
+    out = ga[-1] * m + gb[-1] * (1.0 - m)
+    for i in range(levels - 1, -1, -1):
+        size = (ga[i].shape[1], ga[i].shape[0])
+        m = gm[i][..., None]
+        band_a = ga[i] - cv2.pyrUp(ga[i + 1], dstsize=size)
+        band_b = gb[i] - cv2.pyrUp(gb[i + 1], dstsize=size)
+        out = cv2.pyrUp(out, dstsize=size) + band_a * m + band_b * (1.0 - m)
+    return np.clip(out + 0.5, 0, 255).astype(np.uint8)
+
+
+def blend_face(
+    user_face: Optional[np.ndarray], gen_bgr: np.ndarray, generated_faces: Optional[List[Box]] = None,
+    mode: Optional[str] = None,
+) -> Optional[np.ndarray]:
+    """Blend the user's face crop over the generated face within a padded region around it.
+    ``generated_faces`` lets the caller reuse a detection already run on ``gen_bgr``.
+    Returns the blended image, or None when blending is skipped.
+    """
+    try:
+        if user_face is None or user_face.size == 0:
+            return None
+        if generated_faces is None:
+            generated_faces = detect_faces(gen_bgr, min_size=60)
+        dst_box = largest_face(generated_faces, min_size=60)
+        if dst_box is None:
+            return None
+        dx, dy, dw, dh = dst_box
+
+        # Sanity checks to avoid blending a tiny/huge or misplaced face (prevents "face pasted" look)
+        H, W = gen_bgr.shape[:2]
+        if dw <= 0 or dh <= 0 or W <= 0 or H <= 0:
+            return None
+        # Face should be within frame and not cover unrealistic area
+        if dx < 0 or dy < 0 or dx + dw > W or dy + dh > H:
+            return None
+        face_area = dw * dh
+        frame_area = W * H
+        if face_area < 0.01 * frame_area or face_area > 0.25 * frame_area:
+            # Too small or too large → skip blending
+            return None
+
+        shrink = user_face.shape[1] > dw
+        src = cv2.resize(user_face, (dw, dh), interpolation=cv2.INTER_AREA if shrink else cv2.INTER_CUBIC)
+
+        # Elliptical mask for smoother boundaries
+        mask = np.zeros((dh, dw), dtype=np.uint8)
+        cv2.ellipse(mask, (dw // 2, dh // 2), (int(dw * 0.45), int(dh * 0.55)), 0, 0, 360, 255, -1)
+
+        # Region of interest: the face box padded on every side, clipped to the frame
+        pad_x, pad_y = int(dw * _FACE_ROI_PAD) + 2, int(dh * _FACE_ROI_PAD) + 2
+        x0, y0 = max(0, dx - pad_x), max(0, dy - pad_y)
+        x1, y1 = min(W, dx + dw + pad_x), min(H, dy + dh + pad_y)
+        roi = gen_bgr[y0:y1, x0:x1]
+        ox, oy = dx - x0, dy - y0
+
+        mode = mode or _blend_mode
+        if mode == "auto":
+            mode = "poisson" if roi.shape[0] * roi.shape[1] <= _poisson_max_px else "laplacian"
+        if mode == "poisson":
+            blended = cv2.seamlessClone(src, roi, mask, (ox + dw // 2, oy + dh // 2), cv2.NORMAL_CLONE)
+        else:
+            # The soft edge must fade out inside the face box, where the pasted crop ends:
+            # shrink the ellipse by the width of the transition
+            spread = max(2, int(dw * 0.1))
+            roi_mask = np.zeros(roi.shape[:2], dtype=np.uint8)
+            cv2.ellipse(roi_mask, (ox + dw // 2, oy + dh // 2),
+                        (max(1, int(dw * 0.45) - spread), max(1, dh // 2 - spread)), 0, 0, 360, 255, -1)
+            canvas = roi.copy()
+            canvas[oy:oy + dh, ox:ox + dw] = _match_color(src, roi[oy:oy + dh, ox:ox + dw], mask)
+            if mode == "feather":
+                blended = _feather_blend(canvas, roi, roi_mask, spread / 2.0)
+            else:
+                blended = _laplacian_blend(canvas, roi, roi_mask, int(np.clip(np.log2(spread), 1, 5)))
+        out = gen_bgr.copy()
+        out[y0:y1, x0:x1] = blended
+        return out
+    except Exception:
+        # Fallback on any error
+        return None
+
+
+def preserve_face_with_poisson(
+    user_bgr: np.ndarray, gen_bgr: np.ndarray, generated_faces: Optional[List[Box]] = None
+) -> Optional[np.ndarray]:
+    """Poisson-blend the user's face over the generated face (``blend_face`` in Poisson mode,
+    detecting the user face on the spot). Returns the blended image, or None when skipped.
+    """
+    try:
+        user_face = user_face_crop(user_bgr)
+    except Exception:
+        return None
+    return blend_face(user_face, gen_bgr, generated_faces, mode="poisson")
+
+
+# Letterbox detection parameters
+_BAR_BLACK_THRESH = 14  # very dark
+_BAR_MAX_FRAC = 0.20  # at most this fraction of a dimension is cropped per edge
+_BAR_MIN_RUN = 6  # thinner strips are not bars
+_BAR_RATIO = 0.98  # fraction of a line that must match the bar color
+_BAR_COLOR_TOL = 12  # max per-channel distance from the bar color (non-black bars)
+# A non-black bar must end at real content: the first line past it matches the bar color
+# on less than this fraction, so a plain studio/white background is never cropped
+_BAR_EDGE_CONTRAST = 0.5
+
+
+def _leading_run(line_ok: np.ndarray) -> int:
+    """Length of the leading run of True values."""
+    if line_ok.size == 0:
+        return 0
+    if line_ok.all():
+        return int(line_ok.size)
+    return int(np.argmin(line_ok))
+
+
+def _scan_run(ratios_for: Callable[[int], np.ndarray], limit: int) -> Tuple[int, np.ndarray]:
+    """Leading run of bar lines within ``limit`` lines of an edge. The vectorized window
+    grows geometrically, so the cost tracks the actual bar width rather than ``limit``.
+    Returns the run and the ratios of the last window (which covers the run's end).
+    """
+    n = min(limit, 4 * _BAR_MIN_RUN)
+    while True:
+        ratios = ratios_for(n)
+        run = _leading_run(ratios >= _BAR_RATIO)
+        if run < n or n >= limit:
+            return run, ratios
+        n = min(limit, n * 4)
+
+
+def _edge_strip(img: np.ndarray, edge: str, n: int) -> np.ndarray:
+    H, W = img.shape[:2]
+    if edge == "left":
+        return img[:, :n]
+    if edge == "right":
+        return img[:, W - n:]
+    if edge == "top":
+        return img[:n]
+    return img[H - n:]
+
+
+def _line_ratios(mask: np.ndarray, edge: str, on_value: int = 1) -> np.ndarray:
+    """Fraction of ``on_value`` pixels per line of an edge-strip mask, ordered from the
+    edge inward. Counts stay integers so ratios match ``count / float(n)`` exactly.
+    """
+    axis = 0 if edge in ("left", "right") else 1
+    counts = mask.sum(axis=axis, dtype=np.int64)
+    if on_value != 1:
+        counts = counts // on_value
+    ratios = counts / float(mask.shape[axis])
+    return ratios if edge in ("left", "top") else ratios[::-1]
+
+
+def _gray(img: np.ndarray) -> np.ndarray:
+    return img if img.ndim == 2 else cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+
+
+def _black_run(img: np.ndarray, edge: str, limit: int) -> int:
+    """Near-black bar length along one edge."""
+    if limit < _BAR_MIN_RUN:
+        return 0
+
+    def black_ratios(n: int) -> np.ndarray:
+        # 1 where gray <= _BAR_BLACK_THRESH
+        _, dark = cv2.threshold(_gray(_edge_strip(img, edge, n)), _BAR_BLACK_THRESH, 1, cv2.THRESH_BINARY_INV)
+        return _line_ratios(dark, edge)
+
+    # Most images have no bars: settle that from the outermost line alone
+    if black_ratios(1)[0] < _BAR_RATIO:
+        return 0
+    run, _ = _scan_run(black_ratios, limit)
+    return run if run >= _BAR_MIN_RUN else 0
+
+
+def _solid_run(bgr: np.ndarray, edge: str, limit: int) -> int:
+    """Bar of any uniform color (e.g. near-white) along one edge of a BGR image."""
+    # One line past the crop limit is inspected for the edge-contrast check
+    size = bgr.shape[1] if edge in ("left", "right") else bgr.shape[0]
+    depth = min(size, limit + 1)
+    if depth <= _BAR_MIN_RUN:
+        return 0
+    color = np.median(_edge_strip(bgr, edge, 1).reshape(-1, 3), axis=0).astype(np.int16)
+    lower = np.clip(color - _BAR_COLOR_TOL, 0, 255).astype(np.uint8)
+    upper = np.clip(color + _BAR_COLOR_TOL, 0, 255).astype(np.uint8)
+
+    def solid_ratios(n: int) -> np.ndarray:
+        return _line_ratios(cv2.inRange(_edge_strip(bgr, edge, n), lower, upper), edge, 255)
+
+    if not (solid_ratios(_BAR_MIN_RUN) >= _BAR_RATIO).all():
+        return 0
+    run, ratio = _scan_run(solid_ratios, depth)
+    if run >= depth or run < _BAR_MIN_RUN or ratio[run] >= _BAR_EDGE_CONTRAST:
+        return 0
+    return run
+
+
+def letterbox_box(bgr: np.ndarray) -> Optional[Tuple[int, int, int, int]]:
+    """Crop box (y0, y1, x0, x1) removing uniform letterbox bars from the edges, or None
+    when there is nothing to crop. Crops only when large contiguous edge strips are >98%
+    near-black (or >98% one solid color ending at real content, e.g. white bars) and
+    total crop per edge is <=20% of dimension.
+
+    Each edge strip's per-line bar ratios are computed in one vectorized pass and the
+    run is found with array operations; edges whose outermost line is not a bar
+    candidate (the common case) cost a single line.
+    """
+    H, W = bgr.shape[:2]
+    if H < 10 or W < 10:
+        return None
+    limit_x = int(W * _BAR_MAX_FRAC)
+    limit_y = int(H * _BAR_MAX_FRAC)
+
+    runs = {}
+    for edge in ("left", "right", "top", "bottom"):
+        limit = limit_x if edge in ("left", "right") else limit_y
+        runs[edge] = _black_run(bgr, edge, limit)
+        if runs[edge] == 0 and bgr.ndim == 3:
+            runs[edge] = _solid_run(bgr, edge, limit)
+
+    x0 = runs["left"]
+    x1 = W - runs["right"]
+    y0 = runs["top"]
+    y1 = H - runs["bottom"]
+    # Validate crop box
+    if x0 < 0 or y0 < 0 or x1 <= x0 + 10 or y1 <= y0 + 10:
+        return None
+    if (y0, y1, x0, x1) == (0, H, 0, W):
+        return None
+    return y0, y1, x0, x1
+
+
+def auto_crop_letterbox(bgr: np.ndarray) -> np.ndarray:
+    """Letterbox-cropped view of ``bgr`` (the array itself when there is nothing to crop)."""
+    box = letterbox_box(bgr)
+    if box is None:
+        return bgr
+    y0, y1, x0, x1 = box
+    return bgr[y0:y1, x0:x1]
+
+
+def run(
+    user: Union[bytes, FaceSource], img_b64: str, blend: bool, fmt: str = "png", quality: int = 90
+) -> PostprocessResult:
+    """Collage guard, optional face blend and letterbox crop for one generated image.
+
+    ``user`` is the user PNG or a request's ``FaceSource``, which also carries the blend
+    mode and computes the user face crop only once for all variants.
+    The base64 input is decoded once; the output is encoded as ``fmt`` (see
+    OUTPUT_FORMATS). For PNG it is re-encoded only if a stage changed the pixels,
+    otherwise the input string is returned untouched. When it cannot be encoded as
+    ``fmt`` the input PNG is returned instead; ``fmt`` on the result says which.
+    """
+    timings: Dict[str, float] = {}
+    try:
+        with _timed(timings, "decode"):
+            gen_bgr = decode_png(base64.b64decode(img_b64))
+        if gen_bgr is None:
+            return PostprocessResult(img_b64, timings)
+
+        # One face detection on the generated image serves both the collage guard and the blend
+        faces: Optional[List[Box]] = None
+        with _timed(timings, "detect"):
+            try:
+                faces = detect_faces(gen_bgr, min_size=50)
+            except Exception:
+                faces = None
+        # Reject if collage/inset-face artifact is detected
+        if faces is not None and is_collage(faces, gen_bgr.shape[:2]):
+            metrics.collage_rejections.inc()
+            return PostprocessResult(None, timings)
+
+        out = gen_bgr
+        if blend:
+            source = user if isinstance(user, FaceSource) else FaceSource(user)
+            with _timed(timings, "face"):
+                user_face = source.face()
+            with _timed(timings, "blend"):
+                merged = blend_face(user_face, out, faces, source.mode)
+                if merged is not None:
+                    out = merged
+
+        # Auto-crop letterbox if present
+        with _timed(timings, "crop"):
+            try:
+                out = auto_crop_letterbox(out)
+            except Exception:
+                pass
+
+        if out is gen_bgr and fmt == "png":
+            return PostprocessResult(img_b64, timings)
+        with _timed(timings, "encode"):
+            data = encode_image(out, fmt, quality)
+            if data is None:
+                return PostprocessResult(img_b64, timings)
+            return PostprocessResult(base64.b64encode(data).decode("utf-8"), timings, fmt)
+    finally:
+        _record(timings)
+        logger.debug("postprocess timings: %s", {k: round(v * 1000, 1) for k, v in timings.items()})
@@ -0,0 +1,308 @@
+"""Input preprocessing: decode, downscale and background removal.
+
+Shared by the try-on endpoint and the garment catalog (including its offline bulk
+ingestion), so it lives outside the web app module.
+"""
+import argparse
+import io
+import logging
+import os
+import time
+from typing import Any, Dict, Tuple
+
+from PIL import Image, ImageChops
+from rembg import remove
+
+from . import metrics, segment, sessions
+from .cache import ByteCache, content_key
+from .executor import run_stage
+
+logger = logging.getLogger(__name__)
+
+# Configurable model and image size (override via env)
+rembg_model_name = sessions.default_model
+try:
+    max_dim = max(256, min(4096, int(os.getenv("MAX_DIM", "1536"))))
+except Exception:
+    max_dim = 1536
+
+# What clients should resize and re-encode uploads to before sending (GET /api/upload-config).
+# JPEG keeps the reduced-size DCT decode path; clients flatten transparency onto white.
+UPLOAD_FORMATS = {"jpeg": "image/jpeg", "webp": "image/webp"}
+upload_format = os.getenv("UPLOAD_FORMAT", "jpeg").lower()
+if upload_format not in UPLOAD_FORMATS:
+    upload_format = "jpeg"
+try:
+    upload_quality = max(1, min(100, int(os.getenv("UPLOAD_QUALITY", "90"))))
+except Exception:
+    upload_quality = 90
+# Client-computed masks (user_mask / clothing_mask): foreground share accepted as plausible
+try:
+    _mask_min_coverage = max(0.0, min(1.0, float(os.getenv("CLIENT_MASK_MIN_COVERAGE", "0.01"))))
+except Exception:
+    _mask_min_coverage = 0.01
+try:
+    _mask_max_coverage = max(0.0, min(1.0, float(os.getenv("CLIENT_MASK_MAX_COVERAGE", "0.99"))))
+except Exception:
+    _mask_max_coverage = 0.99
+_MASK_ASPECT_TOLERANCE = 0.02
+
+# Cut-out cache: rembg output keyed by upload content + model + MAX_DIM (+ segmentation
+# mode and quantized weights when set). Catalog garments and repeat selfies are common,
+# so a hit skips decode and rembg entirely.
+try:
+    _cutout_cache_bytes = max(0, int(os.getenv("CUTOUT_CACHE_MB", "256"))) * 1024 * 1024
+except Exception:
+    _cutout_cache_bytes = 256 * 1024 * 1024
+try:
+    _cutout_cache_disk_bytes = max(0, int(os.getenv("CUTOUT_CACHE_DISK_MB", "2048"))) * 1024 * 1024
+except Exception:
+    _cutout_cache_disk_bytes = 2048 * 1024 * 1024
+cutout_cache = ByteCache(
+    "cutout",
+    _cutout_cache_bytes,
+    disk_dir=os.getenv("CUTOUT_CACHE_DIR") or None,
+    disk_max_bytes=_cutout_cache_disk_bytes,
+)
+
+_model_status: Dict[str, Any] = {"state": "not_loaded", "warmup_s": None}
+
+
+def model_path() -> str:
+    return sessions.model_path(rembg_model_name)
+
+
+def warmup() -> None:
+    """Create the first rembg session of each model (see app.sessions) and run a tiny
+    inference on it, so the first requests are fast. Further sessions are created on
+    demand; each one holds a copy of the weights. Raises if a model cannot load.
+    """
+    t0 = time.perf_counter()
+    tiny = Image.new("RGBA", (2, 2), (0, 0, 0, 0))
+    try:
+        for model in sorted(set(sessions.ROLE_MODELS.values())):
+            with sessions.pool(model).session() as session:
+                remove(tiny, session=session)
+    except Exception:
+        _model_status["state"] = "failed"
+        raise
+    _model_status.update(state="ready", warmup_s=time.perf_counter() - t0)
+
+
+def model_status() -> Dict[str, Any]:
+    status = dict(_model_status)
+    if status["state"] != "ready":
+        error = sessions.first_error()
+        status.update(state="failed" if error else status["state"], error=error)
+    return {"model": rembg_model_name, "path": model_path(), "cached": os.path.exists(model_path()),
+            "segmentation": segment.mode_key(), **status, **sessions.stats()}
+
+
+def downscale_max_dim(img: Image.Image, max_dim: int = 1024) -> Image.Image:
+    w, h = img.size
+    if max(w, h) <= max_dim:
+        return img
+    scale = max_dim / float(max(w, h))
+    new_size = (max(1, int(w * scale)), max(1, int(h * scale)))
+    return img.resize(new_size, Image.LANCZOS)
+
+
+def decode_image(raw: bytes) -> Image.Image:
+    """Decode an upload to RGBA and downscale it to MAX_DIM. Raises on invalid input.
+
+    Large JPEGs are decoded at reduced size (DCT scaling via ``draft``, never below
+    MAX_DIM), and RGB/L images are resized before the RGBA conversion, so a 48 MP
+    photo never materializes as a full-resolution RGBA buffer.
+    """
+    with metrics.stage("decode"):
+        return _decode_image(raw)
+
+
+def _decode_image(raw: bytes) -> Image.Image:
+    img = Image.open(io.BytesIO(raw))
+    w, h = img.size
+    if img.format in ("JPEG", "MPO") and max(w, h) > max_dim:
+        scale = max_dim / float(max(w, h))
+        img.draft("RGB", (max(1, int(w * scale)), max(1, int(h * scale))))
+    if img.mode in ("RGB", "RGBA", "L"):
+        # LANCZOS works in these modes; resizing first keeps the RGBA buffer small
+        small = downscale_max_dim(img, max_dim)
+        rgba = small.convert("RGBA")
+        if small is not img:
+            small.close()
+        img.close()
+        return rgba
+    rgba = img.convert("RGBA")
+    img.close()
+    return downscale_max_dim(rgba, max_dim)
+
+
+class CutoutFailed(RuntimeError):
+    """rembg failed on an image. ``png`` is the uncut image, for callers that can go on
+    without a cut-out; it must not be cached or persisted as one.
+    """
+
+    def __init__(self, png: bytes, cause: BaseException) -> None:
+        super().__init__(f"background removal failed: {type(cause).__name__}: {cause}")
+        self.png = png
+
+
+def _encode_png(img: Image.Image) -> bytes:
+    out_buf = io.BytesIO()
+    with metrics.stage("png_encode"):
+        img.save(out_buf, format="PNG")
+    return out_buf.getvalue()
+
+
+def remove_background_png(img: Image.Image, role: str = "user") -> bytes:
+    """Cut out the background with rembg and return PNG bytes. Raises CutoutFailed (carrying
+    the uncut image) when rembg fails, e.g. on a transient ONNX error.
+    ``role`` (user, clothing, garment) selects the model (see app.sessions) and labels the metrics.
+    With REMBG_MASK_DIM set the mask is predicted at reduced resolution (see app.segment).
+    """
+    try:
+        with sessions.pool_for(role).session() as session, metrics.stage(f"rembg_{role}"):
+            no_bg = segment.cutout(img, session) if segment.mask_dim else remove(img, session=session)
+    except Exception as err:
+        metrics.cutout_failures.inc(role=role)
+        try:
+            png = _encode_png(img)
+        finally:
+            img.close()
+        raise CutoutFailed(png, err) from err
+    png = _encode_png(no_bg)
+    # Free PIL objects early
+    try:
+        img.close()
+        no_bg.close()
+    except Exception:
+        pass
+    return png
+
+
+class MaskError(ValueError):
+    """A client-supplied mask that does not fit its image or is implausible."""
+
+
+def upload_target() -> Dict[str, Any]:
+    """How clients should prepare uploads: longest side, format and quality (0..1, as
+    canvas encoders take it), and whether precomputed masks are accepted.
+    """
+    return {
+        "max_dim": max_dim,
+        "format": UPLOAD_FORMATS[upload_format],
+        "quality": upload_quality / 100.0,
+        "mask_format": "image/png",
+        "accepts_masks": True,
+    }
+
+
+def _mask_alpha(mask_raw: bytes) -> Image.Image:
+    try:
+        mask = Image.open(io.BytesIO(mask_raw))
+        mask.load()
+    except Exception:
+        raise MaskError("not a decodable image")
+    # An RGBA cut-out carries the mask in its alpha; a plain mask is its luminance
+    if mask.mode in ("RGBA", "LA", "PA") or (mask.mode == "P" and "transparency" in mask.info):
+        alpha = mask.convert("RGBA").getchannel("A")
+    else:
+        alpha = mask.convert("L")
+    mask.close()
+    return alpha
+
+
+def _check_mask(alpha: Image.Image, size: Tuple[int, int]) -> Image.Image:
+    """Cheap plausibility checks, then ``alpha`` at ``size``. Raises MaskError."""
+    (mw, mh), (w, h) = alpha.size, size
+    if abs(mw / float(mh) - w / float(h)) > _MASK_ASPECT_TOLERANCE * (w / float(h)):
+        raise MaskError(f"{mw}x{mh} does not match the image aspect ratio")
+    if alpha.size != size:
+        alpha = alpha.resize(size, Image.BILINEAR)
+    hist = alpha.histogram()
+    coverage = sum(hist[128:]) / float(w * h)
+    if not _mask_min_coverage <= coverage <= _mask_max_coverage:
+        raise MaskError(f"foreground covers {coverage:.1%} of the image")
+    return alpha
+
+
+def apply_mask_png(raw: bytes, mask_raw: bytes) -> bytes:
+    """Cut-out PNG from an upload and a client-computed mask, without rembg.
+
+    ``mask_raw`` is a grayscale mask or an RGBA cut-out (its alpha is used) with the
+    image's aspect ratio, at any resolution. Raises MaskError for an unusable mask,
+    and on undecodable input like ``decode_image``.
+    """
+    img = decode_image(raw)
+    with metrics.stage("client_mask"):
+        alpha = _check_mask(_mask_alpha(mask_raw), img.size)
+        # Keep any transparency the upload already had
+        img.putalpha(ImageChops.darker(img.getchannel("A"), alpha))
+    png = _encode_png(img)
+    img.close()
+    return png
+
+
+def cutout_key(raw: bytes, role: str = "user") -> str:
+    params = [sessions.model_for(role), max_dim]
+    # Only non-default settings join the key, so existing cache entries and garment IDs stay valid
+    if segment.mask_dim:
+        params.append(segment.mode_key())
+    if sessions.quantized:
+        params.append("int8")
+    return content_key(raw, *params)
+
+
+def cutout_png_sync(raw: bytes, role: str = "garment") -> bytes:
+    """Blocking variant of ``cutout_png`` for worker threads and offline tools. Raises
+    CutoutFailed instead of falling back, since its callers persist the result.
+    """
+    key = cutout_key(raw, role)
+    cached = cutout_cache.get(key)
+    if cached is not None:
+        return cached
+    png = remove_background_png(decode_image(raw), role)
+    cutout_cache.put(key, png)
+    return png
+
+
+async def cutout_png(raw: bytes, role: str = "user") -> bytes:
+    """Decoded, downscaled, background-removed PNG for an upload, served from the cut-out
+    cache when the same content was processed before. Raises on undecodable input.
+    ``role`` (user or clothing) labels the rembg timing metric. If rembg fails, the uncut
+    image is returned for this request only: it is not cached.
+    """
+    key = cutout_key(raw, role)
+    cached = await cutout_cache.aget(key)
+    if cached is not None:
+        return cached
+    img = await run_stage("decode", decode_image, raw)
+    try:
+        png = await run_stage("rembg", remove_background_png, img, role)
+    except CutoutFailed as err:
+        logger.warning("%s; continuing with the uncut %s image", err, role)
+        return err.png
+    await cutout_cache.aput(key, png)
+    return png
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="rembg model maintenance")
+    parser.add_argument("--fetch-model", action="store_true",
+                        help="download the configured models (REMBG_MODEL and the per-role ones) into "
+                             "$U2NET_HOME, for baking into images")
+    parser.add_argument("--quantize", action="store_true",
+                        help="write INT8 copies of the configured models for REMBG_QUANTIZED=1 (needs onnx)")
+    args = parser.parse_args()
+    if args.fetch_model:
+        sessions.set_offline(False)
+        sessions.quantized = False  # the float files are what gets downloaded (and quantized)
+        warmup()
+        print(f"{rembg_model_name}: {model_path()}")
+    if args.quantize:
+        for model in sorted(set(sessions.ROLE_MODELS.values())):
+            print(f"{model}: {sessions.quantize(model)}")
+
+
+if __name__ == "__main__":
+    main()
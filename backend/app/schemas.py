@@ -10,3 +10,7 @@ class TryOnMultiResponse(BaseModel):
     images_base64: List[str]
 
 
+class GarmentResponse(BaseModel):
+    id: str
+    width: int
+    height: int
@@ -0,0 +1,116 @@
+"""Reduced-resolution segmentation for cut-outs (``REMBG_MASK_DIM``).
+
+rembg's u2net-family sessions always infer at 320x320. At MAX_DIM, most of the
+time in ``remove()`` goes to full-resolution LANCZOS resizes around that
+inference and to the composite. With ``REMBG_MASK_DIM`` set (for example 512),
+the mask is predicted on a copy no larger than that. The soft mask is upsampled
+to full size. Only the edge band is then refined with a fast guided filter,
+guided by the full-resolution luminance, so hair and garment outlines follow the
+real image instead of the upsampling blur. The mask becomes the alpha channel of
+the full-resolution image, and RGB is left untouched.
+
+``REMBG_MASK_REFINE=none`` skips the guided filter. ``REMBG_QUANTIZED=1`` loads an
+INT8 model (``$U2NET_HOME/<model>.int8.onnx``, see ``python -m app.preprocess
+--quantize``) in place of the float one. ``bench/segmentation.py`` compares quality
+and latency against ``remove()``.
+"""
+import os
+from typing import Any, Optional
+
+import cv2
+import numpy as np
+from PIL import Image
+
+
+def _env_int(name: str, default: int, lo: int, hi: int) -> int:
+    try:
+        return max(lo, min(hi, int(os.getenv(name, str(default)))))
+    except Exception:
+        return default
+
+
+mask_dim = _env_int("REMBG_MASK_DIM", 0, 0, 4096)  # 0: full-resolution rembg.remove()
+if 0 < mask_dim < 320:
+    mask_dim = 320  # the models infer at 320 anyway
+refine = os.getenv("REMBG_MASK_REFINE", "guided").lower()
+if refine not in ("guided", "none"):
+    refine = "guided"
+
+_EPS = 1e-3  # guided filter regularization (on 0..1 intensities)
+_RADIUS = 4  # guided filter window radius, in mask-resolution pixels
+
+
+def mode_key() -> str:
+    """Distinguishes cut-outs produced by different segmentation settings (cache keys)."""
+    return f"mask{mask_dim}-{refine}" if mask_dim else "full"
+
+
+def _shrink(img: Image.Image, max_side: int) -> Image.Image:
+    w, h = img.size
+    if max(w, h) <= max_side:
+        return img
+    scale = max_side / float(max(w, h))
+    # reduce() box-averages by an integer factor first; far cheaper than LANCZOS from full size
+    factor = int(1.0 / scale)
+    small = img.reduce(factor) if factor >= 2 else img
+    size = (max(1, int(round(w * scale))), max(1, int(round(h * scale))))
+    return small.resize(size, Image.BILINEAR) if small.size != size else small
+
+
+def _box(x: np.ndarray, r: int) -> np.ndarray:
+    return cv2.boxFilter(x, -1, (2 * r + 1, 2 * r + 1), normalize=True, borderType=cv2.BORDER_REFLECT)
+
+
+def guided_upsample(mask_small: np.ndarray, guide_small: np.ndarray, guide_full: np.ndarray,
+                    radius: int = _RADIUS, eps: float = _EPS) -> np.ndarray:
+    """Fast guided filter (He & Sun, 2015). Linear coefficients are fitted at mask resolution,
+    upsampled, and applied to the full-resolution guide. Inputs are float32 in 0..1.
+    """
+    mean_i = _box(guide_small, radius)
+    mean_p = _box(mask_small, radius)
+    cov_ip = _box(guide_small * mask_small, radius) - mean_i * mean_p
+    var_i = _box(guide_small * guide_small, radius) - mean_i * mean_i
+    a = cov_ip / (var_i + eps)
+    b = mean_p - a * mean_i
+    h, w = guide_full.shape[:2]
+    mean_a = cv2.resize(_box(a, radius), (w, h), interpolation=cv2.INTER_LINEAR)
+    mean_b = cv2.resize(_box(b, radius), (w, h), interpolation=cv2.INTER_LINEAR)
+    return mean_a * guide_full + mean_b
+
+
+def refine_mask(mask_small: np.ndarray, small_rgb: np.ndarray, full_rgb: np.ndarray, method: str = "guided") -> np.ndarray:
+    """Full-resolution uint8 alpha from a uint8 mask predicted on ``small_rgb``."""
+    h, w = full_rgb.shape[:2]
+    p_small = mask_small.astype(np.float32) * (1.0 / 255.0)
+    p_full = cv2.resize(p_small, (w, h), interpolation=cv2.INTER_LINEAR)
+    if method == "guided":
+        guide_full = cv2.cvtColor(full_rgb, cv2.COLOR_RGB2GRAY).astype(np.float32) * (1.0 / 255.0)
+        guide_small = cv2.cvtColor(small_rgb, cv2.COLOR_RGB2GRAY).astype(np.float32) * (1.0 / 255.0)
+        # Edge band: where the upsampled mask is neither clearly in nor out, widened by the
+        # upsampling factor. Interiors and background keep the plain upsampled values.
+        scale = max(1, int(round(w / float(mask_small.shape[1]))))
+        band = ((p_full > 0.02) & (p_full < 0.98)).astype(np.uint8)
+        band = cv2.dilate(band, np.ones((2 * scale + 1, 2 * scale + 1), np.uint8)).astype(bool)
+        if band.any():
+            np.copyto(p_full, guided_upsample(p_small, guide_small, guide_full), where=band)
+    np.clip(p_full, 0.0, 1.0, out=p_full)
+    return cv2.convertScaleAbs(p_full, alpha=255.0)
+
+
+def cutout(img: Image.Image, session: Any, max_side: Optional[int] = None, method: Optional[str] = None) -> Image.Image:
+    """RGBA cut-out of ``img`` with the mask predicted at ``max_side`` (default REMBG_MASK_DIM)."""
+    max_side = max_side or mask_dim or 512
+    method = method or refine
+    rgb_img = img.convert("RGB")
+    small = _shrink(rgb_img, max_side)
+    mask = session.predict(small)[0]
+    if mask.size != small.size:
+        mask = mask.resize(small.size, Image.BILINEAR)
+    alpha = refine_mask(np.asarray(mask.convert("L")), np.asarray(small), np.asarray(rgb_img), method)
+    if img.mode == "RGBA":
+        # Keep any transparency the upload already had
+        alpha = np.minimum(alpha, np.asarray(img.getchannel("A")))
+    if small is not rgb_img:
+        small.close()
+    rgb_img.putalpha(Image.fromarray(alpha, "L"))  # rgb_img is our own copy: becomes RGBA in place
+    return rgb_img
@@ -0,0 +1,131 @@
+"""Preload-then-fork server: several workers sharing one loaded model.
+
+    cd backend && python -m app.serve --workers 4 --port 8080
+
+``uvicorn --workers N`` starts fresh interpreters, and each one loads its own copy
+of the rembg model. This supervisor loads and warms the model once, binds the
+listening socket and then forks the workers. The workers accept on the shared
+socket and share the model's read-only pages copy-on-write. The app itself is only
+imported in the workers, inside their event loops.
+
+onnxruntime thread pools do not survive fork. With more than one worker, the
+preloaded sessions are therefore created single-threaded (``REMBG_INTRA_THREADS=1``
+unless already set; see app.sessions), and parallelism comes from the worker
+processes and their session pools. A single worker is not forked at all: it runs
+in this process, after the warm-up, with multi-threaded sessions.
+
+A worker that exits unexpectedly is replaced. SIGTERM/SIGINT are passed on to the
+workers, which finish in-flight requests before exiting.
+"""
+import argparse
+import logging
+import os
+import signal
+import socket
+import sys
+import time
+from typing import Dict
+
+logger = logging.getLogger("app.serve")
+
+
+def _bind(host: str, port: int) -> socket.socket:
+    sock = socket.socket(socket.AF_INET6 if ":" in host else socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+    return sock
+
+
+def _run_worker(sock: socket.socket, args: argparse.Namespace) -> None:
+    import uvicorn
+
+    # Handlers inherited from the supervisor; uvicorn installs its own
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    config = uvicorn.Config("app.main:app", log_level=args.log_level, proxy_headers=True, forwarded_allow_ips="*")
+    uvicorn.Server(config).run(sockets=[sock])
+
+
+def _spawn(sock: socket.socket, args: argparse.Namespace) -> int:
+    pid = os.fork()
+    if pid == 0:
+        code = 0
+        try:
+            _run_worker(sock, args)
+        except BaseException:
+            logger.exception("worker %d crashed", os.getpid())
+            code = 1
+        finally:
+            os._exit(code)
+    return pid
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Serve the API from pre-forked workers sharing one loaded model")
+    parser.add_argument("--workers", type=int, default=int(os.getenv("WEB_CONCURRENCY", "1")),
+                        help="worker processes (default: $WEB_CONCURRENCY or 1)")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=int(os.getenv("PORT", "8080")))
+    parser.add_argument("--log-level", default="info")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    logging.getLogger("httpx").setLevel(logging.WARNING)  # request lines include the API key
+    workers = max(1, args.workers)
+
+    if workers > 1:
+        os.environ.setdefault("REMBG_INTRA_THREADS", "1")
+        os.environ.setdefault("OMP_NUM_THREADS", "1")
+    t0 = time.monotonic()
+    from . import preprocess, sessions
+
+    # Called directly, not through run_stage: no pool threads may exist at fork time
+    preprocess.warmup()
+    logger.info("rembg sessions %s preloaded in %.2fs", sessions.ROLE_MODELS, time.monotonic() - t0)
+
+    sock = _bind(args.host, args.port)
+    if workers == 1:
+        # Nothing to share: serve here, keeping the warmed sessions' thread pools
+        logger.info("serving on %s:%d in-process", args.host, args.port)
+        _run_worker(sock, args)
+        sock.close()
+        return
+    children: Dict[int, float] = {}
+    stopping = False
+
+    def stop(signum, frame) -> None:
+        nonlocal stopping
+        stopping = True
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for _ in range(workers):
+        children[_spawn(sock, args)] = time.monotonic()
+    logger.info("serving on %s:%d with %d workers", args.host, args.port, workers)
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        started = children.pop(pid, None)
+        if stopping or started is None:
+            continue
+        logger.warning("worker %d exited (status %d); restarting", pid, status)
+        if time.monotonic() - started < 5:
+            time.sleep(1)  # don't spin on a worker that dies at startup
+        children[_spawn(sock, args)] = time.monotonic()
+    sock.close()
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
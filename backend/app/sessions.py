@@ -0,0 +1,240 @@
+"""onnxruntime sessions for rembg: per-input models, pooled sessions, explicit threading.
+
+One default-configured session shared by every thread either oversubscribes the
+cores (each concurrent ``remove()`` spins up a full intra-op pool) or serializes
+on it. Instead each model gets a pool of up to ``REMBG_SESSIONS`` sessions (default
+2), and the rembg stage limit defaults to the same number, so every call admitted by
+``run_stage("rembg")`` finds an idle session. Each session runs with
+``REMBG_INTRA_THREADS`` intra-op threads (default: cores / sessions, so the pool
+together uses every core) and ``REMBG_INTER_THREADS`` inter-op threads, at graph
+optimization level ``REMBG_GRAPH_OPT`` (disable, basic, extended or all).
+
+Memory: every session holds its own copy of the weights, about 170 MB for u2net and
+u2net_human_seg and 5 MB for u2netp, plus its arena. Peak model memory per process
+is roughly sessions x distinct models x model size, times the number of worker
+processes (``app.serve`` shares only what was loaded before the fork). Warmup
+creates one session per model; further ones are created when concurrent calls need
+them. Raise REMBG_SESSIONS only with the memory to match.
+
+The model is chosen per input: ``REMBG_USER_MODEL`` for people (``u2net_human_seg``
+is a light, person-specific choice) and ``REMBG_CLOTHING_MODEL`` for garments.
+Both default to ``REMBG_MODEL``. ``u2net_cloth_seg`` is not a drop-in choice: it
+returns one stacked cut-out per garment class.
+
+Model files live in $U2NET_HOME (rembg's own setting). Images bake them in with
+``python -m app.preprocess --fetch-model`` so nothing is downloaded at boot. With
+REMBG_OFFLINE=1 a missing file fails the load instead of downloading it.
+
+With REMBG_QUANTIZED=1 every model is loaded from ``<model>.int8.onnx`` next to the
+float file, a dynamically quantized (INT8 weights) copy written by ``python -m
+app.preprocess --quantize``. It is smaller and usually faster on CPUs with VNNI;
+``bench/segmentation.py`` measures what it costs in mask quality.
+"""
+import os
+import queue
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional
+
+import onnxruntime as ort
+from rembg import new_session
+
+from .executor import rembg_sessions
+
+default_model = os.getenv("REMBG_MODEL", "u2net")
+ROLE_MODELS: Dict[str, str] = {
+    "user": os.getenv("REMBG_USER_MODEL") or default_model,
+    "clothing": os.getenv("REMBG_CLOTHING_MODEL") or default_model,
+}
+ROLE_MODELS["garment"] = ROLE_MODELS["clothing"]
+
+
+def _env_int(name: str, default: int, lo: int, hi: int) -> int:
+    try:
+        return max(lo, min(hi, int(os.getenv(name, str(default)))))
+    except Exception:
+        return default
+
+
+pool_size = rembg_sessions
+intra_threads = _env_int("REMBG_INTRA_THREADS", max(1, (os.cpu_count() or 1) // pool_size), 1, 256)
+inter_threads = _env_int("REMBG_INTER_THREADS", 1, 1, 256)
+_GRAPH_OPT = {
+    "disable": ort.GraphOptimizationLevel.ORT_DISABLE_ALL,
+    "basic": ort.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+    "extended": ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+    "all": ort.GraphOptimizationLevel.ORT_ENABLE_ALL,
+}
+graph_opt = os.getenv("REMBG_GRAPH_OPT", "all").lower()
+if graph_opt not in _GRAPH_OPT:
+    graph_opt = "all"
+_offline = os.getenv("REMBG_OFFLINE", "0").lower() in ("1", "true", "yes")
+quantized = os.getenv("REMBG_QUANTIZED", "0").lower() in ("1", "true", "yes")
+
+
+def model_path(model: str) -> str:
+    home = os.getenv("U2NET_HOME", os.path.join(os.getenv("XDG_DATA_HOME", "~"), ".u2net"))
+    return os.path.join(os.path.expanduser(home), f"{model}.onnx")
+
+
+def quantized_path(model: str) -> str:
+    return model_path(f"{model}.int8")
+
+
+def load_path(model: str) -> str:
+    """The ONNX file a pool for ``model`` loads under the current settings."""
+    return quantized_path(model) if quantized else model_path(model)
+
+
+def quantize(model: str) -> str:
+    """Write a dynamically quantized (INT8 weights) copy of ``model`` next to it; returns its path.
+    Needs the float model on disk and the ``onnx`` package (only for this step, not at runtime).
+    """
+    try:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+    except ImportError as err:
+        raise RuntimeError(f"quantization needs the onnx package ({err})") from err
+    src, dst = model_path(model), quantized_path(model)
+    if not os.path.exists(src):
+        raise FileNotFoundError(f"{src} missing; run --fetch-model first")
+    quantize_dynamic(src, dst, weight_type=QuantType.QUInt8)
+    return dst
+
+
+def session_options() -> ort.SessionOptions:
+    opts = ort.SessionOptions()
+    opts.intra_op_num_threads = intra_threads
+    opts.inter_op_num_threads = inter_threads
+    opts.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL if inter_threads == 1 else ort.ExecutionMode.ORT_PARALLEL
+    opts.graph_optimization_level = _GRAPH_OPT[graph_opt]
+    return opts
+
+
+def _new_rembg_session(model: str) -> Any:
+    try:
+        from rembg.sessions import sessions_class
+    except ImportError:
+        sessions_class = []
+    if quantized:
+        # rembg only knows its float files; the u2net_custom session loads any u2net-style file
+        for session_class in sessions_class:
+            if session_class.name() == "u2net_custom":
+                return session_class(model, session_options(), model_path=quantized_path(model))
+        raise RuntimeError("REMBG_QUANTIZED needs a rembg version with the u2net_custom session")
+    for session_class in sessions_class:
+        if session_class.name() == model:
+            return session_class(model, session_options())
+    # Unknown to this rembg version's registry: let rembg resolve it with its defaults
+    return new_session(model)
+
+
+class SessionPool:
+    """Up to ``size`` sessions of one model, created on demand and checked out per call."""
+
+    def __init__(self, model: str, size: int) -> None:
+        self.model = model
+        self.size = size
+        self._idle: "queue.LifoQueue[Any]" = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+        self.status: Dict[str, Any] = {"state": "not_loaded", "error": None, "load_s": None}
+
+    def _create(self) -> Any:
+        t0 = time.perf_counter()
+        self.status.update(state="loading", error=None)
+        try:
+            path = load_path(self.model)
+            if quantized and not os.path.exists(path):
+                raise FileNotFoundError(f"{path} missing; create it with python -m app.preprocess --quantize")
+            if _offline and not os.path.exists(path):
+                raise FileNotFoundError(f"{path} missing and REMBG_OFFLINE is set")
+            session = _new_rembg_session(self.model)
+        except Exception as err:
+            self.status.update(state="failed", error=f"{type(err).__name__}: {err}")
+            raise
+        self.status.update(state="loaded", load_s=time.perf_counter() - t0)
+        return session
+
+    def _take(self) -> Any:
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            create = self._created < self.size
+            if create:
+                self._created += 1
+        if not create:
+            return self._idle.get()
+        try:
+            return self._create()
+        except Exception:
+            with self._lock:
+                self._created -= 1
+            raise
+
+    @contextmanager
+    def session(self) -> Iterator[Any]:
+        """Exclusive use of one session (blocks while all ``size`` are busy)."""
+        session = self._take()
+        try:
+            yield session
+        finally:
+            self._idle.put(session)
+
+    def fill(self) -> List[Any]:
+        """Create every session now (benchmarks that need them all). Returns them checked out."""
+        return [self._take() for _ in range(self.size)]
+
+    def release(self, sessions: List[Any]) -> None:
+        for session in sessions:
+            self._idle.put(session)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"model": self.model, "size": self.size, "created": self._created, "idle": self._idle.qsize(), **self.status}
+
+
+_pools: Dict[str, SessionPool] = {}
+_pools_lock = threading.Lock()
+
+
+def pool(model: str) -> SessionPool:
+    with _pools_lock:
+        p = _pools.get(model)
+        if p is None:
+            p = _pools[model] = SessionPool(model, pool_size)
+        return p
+
+
+def model_for(role: str) -> str:
+    return ROLE_MODELS.get(role, default_model)
+
+
+def pool_for(role: str) -> SessionPool:
+    return pool(model_for(role))
+
+
+def stats() -> Dict[str, Any]:
+    return {
+        "roles": dict(ROLE_MODELS),
+        "sessions_per_model": pool_size,
+        "intra_op_threads": intra_threads,
+        "inter_op_threads": inter_threads,
+        "graph_optimization": graph_opt,
+        "quantized": quantized,
+        "pools": {model: pool(model).stats() for model in sorted(set(ROLE_MODELS.values()))},
+    }
+
+
+def set_offline(offline: bool) -> None:
+    global _offline
+    _offline = offline
+
+
+def first_error() -> Optional[str]:
+    for model in sorted(set(ROLE_MODELS.values())):
+        error = pool(model).status["error"]
+        if error:
+            return error
+    return None
@@ -0,0 +1,116 @@
+"""Binary response modes for /api/tryon.
+
+The default response is ``{"images_base64": [...]}``. Clients can instead ask for
+raw image bytes streamed as each variant finishes (``response_mode`` form field,
+or the ``Accept`` header):
+
+- ``multipart``: ``multipart/mixed``. There is one part per image, with its own
+  ``Content-Type`` and an ``X-Variant-Index`` header, followed by a final
+  ``application/json`` part ``{"count": n}``.
+- ``ndjson``: ``application/x-ndjson`` events. Each image is announced by a line
+  ``{"event": "image", "index": i, "content_type": ..., "size": n}`` and followed
+  by exactly ``size`` raw bytes plus a newline. The stream ends with
+  ``{"event": "done", "count": n}``.
+
+Framing is written before any image bytes are sent, so a client can read the
+events without scanning binary data for delimiters.
+
+``/api/tryon/batch`` streams NDJSON by default. It opens with
+``{"event": "batch", "items": [{"item": i, "user": u, "garment": g}, ...]}``. Image
+events carry the ``item`` they belong to. Each item ends with
+``{"event": "item", "item": i, "status": 200, "count": n}``, or with the error
+``status`` and ``detail``. The stream closes with
+``{"event": "done", "items": n, "failed": f}``.
+"""
+import base64
+import json
+import secrets
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+from .postprocess import OUTPUT_FORMATS
+
+RESPONSE_MODES = ("json", "multipart", "ndjson")
+
+_ACCEPT_MODES = (("multipart/mixed", "multipart"), ("application/x-ndjson", "ndjson"))
+
+
+def negotiate_mode(requested: Optional[str], accept: Optional[str]) -> Optional[str]:
+    """Response mode from the explicit form field, else from ``Accept``. None if unsupported."""
+    if requested:
+        mode = requested.strip().lower()
+        return mode if mode in RESPONSE_MODES else None
+    accept = (accept or "").lower()
+    for media_type, mode in _ACCEPT_MODES:
+        if media_type in accept:
+            return mode
+    return "json"
+
+
+def _line(event: dict) -> bytes:
+    return json.dumps(event, separators=(",", ":")).encode("utf-8") + b"\n"
+
+
+def content_type(fmt: str) -> str:
+    """MIME type of an image in output format ``fmt``."""
+    return OUTPUT_FORMATS[fmt][1]
+
+
+async def ndjson_stream(images: AsyncIterator[Tuple[str, str]]) -> AsyncIterator[bytes]:
+    """Frame (base64 image, content type) pairs as NDJSON events."""
+    count = 0
+    async for img_b64, content_type in images:
+        data = base64.b64decode(img_b64)
+        yield _line({"event": "image", "index": count, "content_type": content_type, "size": len(data)})
+        yield data
+        yield b"\n"
+        count += 1
+    yield _line({"event": "done", "count": count})
+
+
+def multipart_boundary() -> str:
+    return "tryon-" + secrets.token_hex(16)
+
+
+async def multipart_stream(images: AsyncIterator[Tuple[str, str]], boundary: str) -> AsyncIterator[bytes]:
+    """Frame (base64 image, content type) pairs as ``multipart/mixed`` parts."""
+    delimiter = b"--" + boundary.encode("ascii")
+    count = 0
+    async for img_b64, content_type in images:
+        data = base64.b64decode(img_b64)
+        yield (
+            delimiter + b"\r\n"
+            + f"Content-Type: {content_type}\r\n".encode("ascii")
+            + f"Content-Length: {len(data)}\r\n".encode("ascii")
+            + f"X-Variant-Index: {count}\r\n\r\n".encode("ascii")
+        )
+        yield data
+        yield b"\r\n"
+        count += 1
+    summary = json.dumps({"count": count}).encode("utf-8")
+    yield delimiter + b"\r\nContent-Type: application/json\r\n\r\n" + summary + b"\r\n" + delimiter + b"--\r\n"
+
+
+async def batch_ndjson_stream(events: AsyncIterator[Any], fmt: str, items: List[Dict[str, Any]]) -> AsyncIterator[bytes]:
+    """Frame ``pipeline.iter_batch`` events; ``items`` describes each item up front.
+    ``fmt`` is the requested output format, for events that do not carry their own.
+    """
+    yield _line({"event": "batch", "items": items})
+    counts = [0] * len(items)
+    failed = 0
+    async for event in events:
+        if event.image_b64 is not None:
+            data = base64.b64decode(event.image_b64)
+            yield _line({
+                "event": "image", "item": event.item, "index": counts[event.item],
+                "content_type": content_type(event.fmt or fmt), "size": len(data),
+            })
+            yield data
+            yield b"\n"
+            counts[event.item] += 1
+        if event.done:
+            if event.error is not None:
+                failed += 1
+                yield _line({"event": "item", "item": event.item, "status": event.error.status_code, "detail": event.error.detail})
+            else:
+                yield _line({"event": "item", "item": event.item, "status": 200, "count": counts[event.item]})
+    yield _line({"event": "done", "items": len(items), "failed": failed})
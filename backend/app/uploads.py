@@ -0,0 +1,175 @@
+"""Bounded upload ingestion.
+
+Uploads are rejected as early and as cheaply as possible, so peak memory per request
+is bounded by configuration rather than by what clients send:
+
+1. ``BodySizeLimitMiddleware`` refuses request bodies over ``MAX_REQUEST_MB`` (or a
+   per-path limit: ``MAX_TRYON_REQUEST_MB`` for try-ons, which may carry masks, and
+   ``MAX_BATCH_REQUEST_MB`` for batches). It checks the Content-Length header, or
+   counts bytes while streaming when the body is chunked, before the multipart
+   parser spools anything.
+2. ``read_upload`` reads a part in chunks and stops at ``MAX_UPLOAD_MB`` (``MAX_MASK_MB``
+   for client-computed masks).
+3. ``probe_image`` parses only the image header to check format and dimensions
+   (``MAX_UPLOAD_PIXELS``) before any pixel data is decoded.
+"""
+import io
+import os
+from typing import Dict, List, Optional, Tuple
+
+from fastapi import UploadFile
+from PIL import Image
+
+try:
+    max_upload_bytes = max(1, int(os.getenv("MAX_UPLOAD_MB", "20"))) * 1024 * 1024
+except Exception:
+    max_upload_bytes = 20 * 1024 * 1024
+try:
+    max_mask_bytes = max(1, int(os.getenv("MAX_MASK_MB", "5"))) * 1024 * 1024
+except Exception:
+    max_mask_bytes = 5 * 1024 * 1024
+try:
+    max_request_bytes = int(os.getenv("MAX_REQUEST_MB", "0")) * 1024 * 1024
+except Exception:
+    max_request_bytes = 0
+if max_request_bytes <= 0:
+    # Two images plus form fields and multipart framing
+    max_request_bytes = 2 * max_upload_bytes + 1024 * 1024
+try:
+    max_tryon_request_bytes = int(os.getenv("MAX_TRYON_REQUEST_MB", "0")) * 1024 * 1024
+except Exception:
+    max_tryon_request_bytes = 0
+if max_tryon_request_bytes <= 0:
+    # /api/tryon may add a mask per image
+    max_tryon_request_bytes = max(max_request_bytes, 2 * max_upload_bytes + 2 * max_mask_bytes + 1024 * 1024)
+try:
+    max_batch_request_bytes = max(1, int(os.getenv("MAX_BATCH_REQUEST_MB", "64"))) * 1024 * 1024
+except Exception:
+    max_batch_request_bytes = 64 * 1024 * 1024
+try:
+    max_upload_pixels = max(1, int(os.getenv("MAX_UPLOAD_PIXELS", str(100_000_000))))
+except Exception:
+    max_upload_pixels = 100_000_000
+
+ALLOWED_FORMATS = ("JPEG", "MPO", "PNG", "WEBP", "BMP", "GIF")
+
+# PIL's decompression-bomb guard warns at MAX_IMAGE_PIXELS and errors at twice that
+Image.MAX_IMAGE_PIXELS = max_upload_pixels
+
+_CHUNK = 256 * 1024
+
+
+class UploadError(Exception):
+    def __init__(self, status_code: int, detail: str) -> None:
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+
+
+async def read_upload(upload: UploadFile, max_bytes: int = 0) -> bytes:
+    """Read an uploaded part in chunks, failing with 413 past ``max_bytes``."""
+    limit = max_bytes or max_upload_bytes
+    size = getattr(upload, "size", None)
+    if size is not None and size > limit:
+        raise UploadError(413, f"File too large (max {limit // (1024 * 1024)} MB)")
+    chunks: List[bytes] = []
+    total = 0
+    while True:
+        chunk = await upload.read(_CHUNK)
+        if not chunk:
+            break
+        total += len(chunk)
+        if total > limit:
+            raise UploadError(413, f"File too large (max {limit // (1024 * 1024)} MB)")
+        chunks.append(chunk)
+    return chunks[0] if len(chunks) == 1 else b"".join(chunks)
+
+
+def probe_image(raw: bytes) -> Tuple[str, int, int]:
+    """Format and size from the image header only (no pixel decode)."""
+    if not raw:
+        raise UploadError(400, "Empty file")
+    try:
+        with Image.open(io.BytesIO(raw)) as img:
+            fmt = img.format or ""
+            width, height = img.size
+    except Image.DecompressionBombError:
+        raise UploadError(413, "Image dimensions too large")
+    except Exception:
+        raise UploadError(400, "Unrecognized image format")
+    if fmt not in ALLOWED_FORMATS:
+        raise UploadError(415, f"Unsupported image format {fmt or 'unknown'}")
+    if width <= 0 or height <= 0:
+        raise UploadError(400, "Invalid image dimensions")
+    if width * height > max_upload_pixels:
+        raise UploadError(413, f"Image dimensions too large ({width}x{height})")
+    return fmt, width, height
+
+
+class BodySizeLimitMiddleware:
+    """ASGI middleware rejecting request bodies larger than ``max_bytes`` (or the
+    ``path_limits`` entry for the request path) with 413."""
+
+    def __init__(self, app, max_bytes: int = 0, path_limits: Optional[Dict[str, int]] = None) -> None:
+        self.app = app
+        self.max_bytes = max_bytes or max_request_bytes
+        self.path_limits = path_limits or {}
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] not in ("POST", "PUT", "PATCH"):
+            await self.app(scope, receive, send)
+            return
+        max_bytes = self.path_limits.get(scope.get("path", ""), self.max_bytes)
+        for name, value in scope.get("headers", []):
+            if name == b"content-length":
+                try:
+                    declared = int(value)
+                except ValueError:
+                    declared = 0
+                if declared > max_bytes:
+                    await self._reject(send)
+                    return
+
+        received = 0
+        response_started = False
+        rejected = False
+
+        async def limited_receive():
+            nonlocal received, rejected
+            if rejected:
+                return {"type": "http.disconnect"}
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > max_bytes:
+                    # Answer 413 ourselves and make the app see a disconnect; whatever
+                    # error response it then produces is dropped in guarded_send
+                    rejected = True
+                    if not response_started:
+                        await self._reject(send)
+                    return {"type": "http.disconnect"}
+            return message
+
+        async def guarded_send(message):
+            nonlocal response_started
+            if rejected:
+                return
+            if message["type"] == "http.response.start":
+                response_started = True
+            await send(message)
+
+        try:
+            await self.app(scope, limited_receive, guarded_send)
+        except Exception:
+            if not rejected:
+                raise
+
+    @staticmethod
+    async def _reject(send) -> None:
+        body = b'{"detail":"Request body too large"}'
+        await send({
+            "type": "http.response.start",
+            "status": 413,
+            "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())],
+        })
+        await send({"type": "http.response.body", "body": body})
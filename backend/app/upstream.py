@@ -0,0 +1,370 @@
+"""Protection for the Gemini upstream.
+
+Three parts, all process-wide:
+
+- ``limiter``: an AIMD concurrency limit on in-flight Gemini calls. The limit grows
+  by about one per window of successful calls. It halves (at most once per
+  cooldown) on 429/5xx, or when a successful call takes more than
+  ``GEMINI_LATENCY_TOLERANCE`` times their running average latency. Other failed
+  calls leave it unchanged. Callers wait up to ``GEMINI_LIMIT_WAIT``
+  seconds for a slot, then fail fast with ``UpstreamBusy``.
+- ``breaker(model)``: a circuit breaker per model. ``GEMINI_BREAKER_THRESHOLD``
+  consecutive failures (429/5xx/network) open it for ``GEMINI_BREAKER_COOLDOWN``
+  seconds, or longer when the upstream sent a longer Retry-After. Then a single
+  probe call is let through (half-open); if the probe fails, the cooldown doubles.
+- ``backoff_delay``: full-jitter exponential backoff between rounds over the
+  candidate models (``GEMINI_RETRIES`` extra rounds), never shorter than the
+  Retry-After the upstream asked for. A Retry-After beyond ``GEMINI_BACKOFF_MAX``
+  ends the call instead of sleeping while holding a pipeline slot.
+
+When every model's breaker is open, calls fail fast with ``UpstreamUnavailable``.
+With ``GEMINI_BREAKER_WAIT`` set, they first wait that long for a breaker to half-open.
+
+Hedging (opt-in with ``GEMINI_HEDGE=1``, run by app.pipeline): an attempt that has
+not finished after the ``GEMINI_HEDGE_PERCENTILE`` of recent successful call
+latencies (``latencies``; ``GEMINI_HEDGE_DELAY`` until enough calls were seen, never
+below ``GEMINI_HEDGE_MIN_DELAY``) gets a duplicate call. The duplicate goes to
+``GEMINI_HEDGE_MODEL`` when that is set to a different image model; unset, it re-sends
+the same request to the same model, which only helps against slow individual calls
+(not a slow model) and bills a second call each time. Each request may start at most
+``GEMINI_HEDGE_BUDGET`` duplicates, and none while the limiter has no free slot, so
+hedging cannot amplify an overload.
+"""
+import asyncio
+import os
+import random
+import threading
+import time
+from collections import deque
+from email.utils import parsedate_to_datetime
+from typing import Any, Deque, Dict, Iterator, List, Optional, Set
+
+from . import metrics
+
+
+def _env_float(name: str, default: float, lo: float, hi: float) -> float:
+    try:
+        return max(lo, min(hi, float(os.getenv(name, str(default)))))
+    except Exception:
+        return default
+
+
+_limit_initial = _env_float("GEMINI_AIMD_INITIAL", 8, 1, 1024)
+_limit_min = _env_float("GEMINI_AIMD_MIN", 1, 1, 1024)
+_limit_max = _env_float("GEMINI_AIMD_MAX", 64, 1, 1024)
+_latency_tolerance = _env_float("GEMINI_LATENCY_TOLERANCE", 2.0, 0, 100)
+_limit_wait = _env_float("GEMINI_LIMIT_WAIT", 10, 0, 600)
+_breaker_threshold = int(_env_float("GEMINI_BREAKER_THRESHOLD", 5, 1, 1000))
+_breaker_cooldown = _env_float("GEMINI_BREAKER_COOLDOWN", 30, 1, 3600)
+_breaker_wait = _env_float("GEMINI_BREAKER_WAIT", 0, 0, 600)
+upstream_retries = int(_env_float("GEMINI_RETRIES", 2, 0, 10))
+_backoff_base = _env_float("GEMINI_BACKOFF_BASE", 0.5, 0.01, 60)
+backoff_max = _env_float("GEMINI_BACKOFF_MAX", 8, 0.1, 300)
+hedge_enabled = os.getenv("GEMINI_HEDGE", "0").lower() in ("1", "true", "yes")
+_hedge_percentile = _env_float("GEMINI_HEDGE_PERCENTILE", 95, 50, 99.9)
+_hedge_delay = _env_float("GEMINI_HEDGE_DELAY", 8, 0, 600)
+_hedge_min_delay = _env_float("GEMINI_HEDGE_MIN_DELAY", 1, 0, 600)
+hedge_budget = int(_env_float("GEMINI_HEDGE_BUDGET", 1, 0, 10))
+# Model for hedged duplicates; None sends them to the same model as the original call
+hedge_model = os.getenv("GEMINI_HEDGE_MODEL", "").strip() or None
+
+# Statuses that indicate upstream trouble (as opposed to a bad request); the limiter
+# treats them as congestion
+TRANSIENT_STATUSES = (429, 500, 502, 503, 504)
+
+
+class UpstreamBusy(RuntimeError):
+    """No concurrency slot became free within GEMINI_LIMIT_WAIT."""
+
+
+class UpstreamUnavailable(RuntimeError):
+    """Every candidate model's circuit breaker is open."""
+
+    def __init__(self, retry_after: float) -> None:
+        super().__init__(f"Gemini upstream unavailable (retry in {retry_after:.0f}s)")
+        self.retry_after = retry_after
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Seconds from a Retry-After header (delta-seconds or HTTP date)."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt: int, retry_after: Optional[float] = None) -> float:
+    """Full-jitter exponential delay before retry ``attempt`` (0-based), at least ``retry_after``."""
+    delay = random.uniform(0, min(backoff_max, _backoff_base * (2 ** attempt)))
+    if retry_after is not None:
+        delay = max(delay, retry_after + random.uniform(0, _backoff_base))
+    return delay
+
+
+class AIMDLimiter:
+    def __init__(
+        self, initial: float = _limit_initial, min_limit: float = _limit_min, max_limit: float = _limit_max,
+        latency_tolerance: float = _latency_tolerance, cooldown: float = 1.0,
+    ) -> None:
+        self.min_limit = min_limit
+        self.max_limit = max(min_limit, max_limit)
+        self.limit = max(min_limit, min(self.max_limit, initial))
+        self.latency_tolerance = latency_tolerance
+        self.cooldown = cooldown
+        self.in_flight = 0
+        self._avg_latency: Optional[float] = None
+        self._last_decrease = 0.0
+        self._waiters: Deque["asyncio.Future[None]"] = deque()
+        self._granted: Set["asyncio.Future[None]"] = set()  # woken waiters that own a slot
+        self._lock = threading.Lock()
+        self._counters = {"acquired": 0, "rejected": 0, "decreases": 0}
+
+    async def acquire(self, timeout: float = _limit_wait) -> None:
+        with self._lock:
+            if self.in_flight < int(self.limit) and not self._waiters:
+                self.in_flight += 1
+                self._counters["acquired"] += 1
+                return
+            waiter: "asyncio.Future[None]" = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as err:
+            with self._lock:
+                if waiter in self._granted:
+                    # A slot was handed over just as we gave up; pass it on
+                    self._granted.discard(waiter)
+                    self.in_flight -= 1
+                    self._wake_locked()
+                else:
+                    waiter.cancel()
+                    try:
+                        self._waiters.remove(waiter)
+                    except ValueError:
+                        pass
+                if isinstance(err, asyncio.TimeoutError):
+                    self._counters["rejected"] += 1
+            if isinstance(err, asyncio.TimeoutError):
+                raise UpstreamBusy(f"no Gemini slot within {timeout:.0f}s (limit {int(self.limit)})")
+            raise
+        with self._lock:
+            self._granted.discard(waiter)
+
+    def _wake_locked(self) -> None:
+        while self._waiters and self.in_flight < int(self.limit):
+            waiter = self._waiters.popleft()
+            if waiter.done():
+                continue
+            self.in_flight += 1
+            self._counters["acquired"] += 1
+            self._granted.add(waiter)
+            waiter.get_loop().call_soon_threadsafe(_resolve, waiter)
+
+    def release(self, latency: Optional[float] = None, overloaded: bool = False, success: bool = False) -> None:
+        """Return a slot. ``latency`` is set for calls that got a response, ``success`` for
+        200s and ``overloaded`` for 429/5xx. Only successes grow the limit.
+        """
+        with self._lock:
+            self.in_flight = max(0, self.in_flight - 1)
+            congested = overloaded
+            if success and latency is not None:
+                avg = self._avg_latency
+                if avg is not None and self.latency_tolerance and latency > self.latency_tolerance * avg:
+                    congested = True
+                self._avg_latency = latency if avg is None else 0.9 * avg + 0.1 * latency
+            now = time.monotonic()
+            if congested:
+                if now - self._last_decrease >= self.cooldown:
+                    self.limit = max(self.min_limit, self.limit * 0.5)
+                    self._last_decrease = now
+                    self._counters["decreases"] += 1
+            elif success:
+                self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+            self._wake_locked()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "limit": round(self.limit, 2),
+                "in_flight": self.in_flight,
+                "queued": len(self._waiters),
+                "avg_latency_s": self._avg_latency,
+                **self._counters,
+            }
+
+
+def _resolve(waiter: "asyncio.Future[None]") -> None:
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+class CircuitBreaker:
+    def __init__(self, name: str, threshold: int = _breaker_threshold, cooldown: float = _breaker_cooldown) -> None:
+        self.name = name
+        self.threshold = threshold
+        self.base_cooldown = cooldown
+        self.cooldown = cooldown
+        self.state = "closed"  # closed | open | half_open
+        self.failures = 0
+        self.opened_until = 0.0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+        self._counters = {"opened": 0, "short_circuited": 0}
+
+    def allow(self) -> bool:
+        """Whether a call may go out now; in half-open state only one probe at a time."""
+        with self._lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open" and time.monotonic() >= self.opened_until:
+                self.state = "half_open"
+            if self.state == "half_open" and not self._probe_in_flight:
+                self._probe_in_flight = True
+                return True
+            self._counters["short_circuited"] += 1
+            return False
+
+    def retry_in(self) -> float:
+        with self._lock:
+            if self.state == "closed":
+                return 0.0
+            return max(0.0, self.opened_until - time.monotonic())
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.state = "closed"
+            self.failures = 0
+            self.cooldown = self.base_cooldown
+            self._probe_in_flight = False
+
+    def record_failure(self, retry_after: Optional[float] = None) -> None:
+        with self._lock:
+            self.failures += 1
+            if self.state == "half_open":
+                # Failed probe: back off harder
+                self.cooldown = min(self.cooldown * 2, self.base_cooldown * 16)
+            elif self.failures < self.threshold:
+                return
+            self.state = "open"
+            self.opened_until = time.monotonic() + max(self.cooldown, retry_after or 0.0)
+            self._probe_in_flight = False
+            self._counters["opened"] += 1
+
+    def release_probe(self) -> None:
+        """A call let through by ``allow`` ended without a health verdict (e.g. 404, bad request)."""
+        with self._lock:
+            self._probe_in_flight = False
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "state": self.state,
+                "consecutive_failures": self.failures,
+                "retry_in_s": max(0.0, self.opened_until - time.monotonic()) if self.state != "closed" else 0.0,
+                **self._counters,
+            }
+
+
+class LatencyWindow:
+    """Latencies of the last ``size`` successful calls, for percentile estimates."""
+
+    def __init__(self, size: int = 256, min_samples: int = 20) -> None:
+        self.min_samples = min_samples
+        self._samples: Deque[float] = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def observe(self, seconds: float) -> None:
+        with self._lock:
+            self._samples.append(seconds)
+
+    def percentile(self, p: float) -> Optional[float]:
+        """The ``p``-th percentile (0-100), or None until ``min_samples`` calls were seen."""
+        with self._lock:
+            samples: List[float] = sorted(self._samples)
+        if len(samples) < self.min_samples:
+            return None
+        return samples[min(len(samples) - 1, int(round(p / 100.0 * (len(samples) - 1))))]
+
+
+limiter = AIMDLimiter()
+latencies = LatencyWindow()
+_breakers: Dict[str, CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+
+
+def breaker(model: str) -> CircuitBreaker:
+    with _breakers_lock:
+        cb = _breakers.get(model)
+        if cb is None:
+            cb = _breakers[model] = CircuitBreaker(model)
+        return cb
+
+
+def breaker_wait() -> float:
+    return _breaker_wait
+
+
+def unavailable_for() -> Optional[float]:
+    """Seconds until some model's breaker half-opens, or None while any model is usable."""
+    with _breakers_lock:
+        breakers = list(_breakers.values())
+    if not breakers:
+        return None
+    waits = [cb.retry_in() for cb in breakers]
+    if any(cb.state == "closed" for cb in breakers):
+        return None
+    return min(waits)
+
+
+def hedge_delay() -> Optional[float]:
+    """Seconds an attempt may run before it is hedged, or None with hedging off."""
+    if not hedge_enabled or not hedge_budget:
+        return None
+    observed = latencies.percentile(_hedge_percentile)
+    return max(_hedge_min_delay, observed if observed is not None else _hedge_delay)
+
+
+def can_hedge() -> bool:
+    """Whether the limiter has a free slot for a duplicate call."""
+    stats = limiter.stats()
+    return stats["in_flight"] < int(stats["limit"]) and not stats["queued"]
+
+
+def stats() -> Dict[str, Any]:
+    with _breakers_lock:
+        breakers = dict(_breakers)
+    return {
+        "limiter": limiter.stats(),
+        "breakers": {name: cb.stats() for name, cb in breakers.items()},
+        "hedge": {
+            "enabled": hedge_enabled, "budget": hedge_budget, "delay_s": hedge_delay(), "model": hedge_model,
+        },
+    }
+
+
+_BREAKER_STATES = {"closed": 0, "half_open": 1, "open": 2}
+
+
+def _metric_samples() -> Iterator[metrics.Sample]:
+    limits = limiter.stats()
+    yield "tryon_gemini_concurrency_limit", "gauge", "Current adaptive Gemini concurrency limit", {}, limits["limit"]
+    yield "tryon_gemini_in_flight", "gauge", "Gemini calls in flight", {}, limits["in_flight"]
+    yield "tryon_gemini_limit_queued", "gauge", "Calls waiting for a Gemini slot", {}, limits["queued"]
+    yield "tryon_gemini_limit_rejected_total", "counter", "Calls rejected after GEMINI_LIMIT_WAIT", {}, limits["rejected"]
+    with _breakers_lock:
+        breakers = list(_breakers.values())
+    for cb in breakers:
+        state = cb.stats()
+        yield ("tryon_gemini_breaker_state", "gauge", "Circuit breaker state (0 closed, 1 half-open, 2 open)",
+               {"model": cb.name}, _BREAKER_STATES[state["state"]])
+        yield ("tryon_gemini_breaker_short_circuited_total", "counter", "Calls skipped by an open breaker",
+               {"model": cb.name}, state["short_circuited"])
+
+
+metrics.add_collector(_metric_samples)
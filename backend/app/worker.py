@@ -0,0 +1,52 @@
+"""Standalone try-on job worker for the Redis-backed queue (see app.jobs).
+
+    cd backend && JOB_QUEUE=redis REDIS_URL=redis://localhost:6379/0 python -m app.worker --concurrency 4
+
+Runs ``--concurrency`` jobs at a time (the per-stage limits still apply inside) and
+finishes the jobs in progress before exiting on SIGTERM/SIGINT.
+"""
+import argparse
+import asyncio
+import logging
+import os
+import signal
+
+from . import executor, jobs, preprocess
+from .executor import run_stage
+from .gemini import aclose_client
+
+logger = logging.getLogger(__name__)
+
+
+async def _run(concurrency: int) -> None:
+    queue = jobs.create_queue()
+    if queue.backend == "memory":
+        raise SystemExit("app.worker needs a shared queue; set JOB_QUEUE=redis")
+    await run_stage("rembg", preprocess.warmup)
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+    workers = jobs.start_workers(queue, concurrency, stop)
+    logger.info("worker started: %d concurrent jobs on %s queue", concurrency, queue.backend)
+    try:
+        await asyncio.gather(*workers)
+    finally:
+        await queue.close()
+        await aclose_client()
+        executor.shutdown()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Run try-on jobs from the shared job queue")
+    parser.add_argument("--concurrency", type=int, default=int(os.getenv("JOB_CONCURRENCY", "4")),
+                        help="jobs processed at once (default: $JOB_CONCURRENCY or 4)")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    logging.getLogger("httpx").setLevel(logging.WARNING)  # request lines include the API key
+    asyncio.run(_run(max(1, args.concurrency)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""Peak memory and time of decoding one large upload down to MAX_DIM.
+
+legacy  - Image.open(...).convert("RGBA") at full resolution, then LANCZOS resize
+current - app.preprocess.decode_image (JPEG draft decoding, resize before RGBA)
+
+Each measurement runs in a fresh subprocess so ru_maxrss reflects only that decode.
+
+    cd backend && python -m bench.decode_memory --megapixels 48
+"""
+import argparse
+import io
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+
+def _make_jpeg(megapixels: float) -> bytes:
+    import numpy as np
+    from PIL import Image
+
+    h = int((megapixels * 1e6 * 3 / 4) ** 0.5)
+    w = int(h * 4 / 3)
+    rng = np.random.default_rng(0)
+    small = rng.integers(0, 255, size=(h // 16, w // 16, 3), dtype=np.uint8)
+    img = Image.fromarray(small).resize((w, h), Image.BILINEAR)
+    buf = io.BytesIO()
+    img.save(buf, format="JPEG", quality=90)
+    return buf.getvalue()
+
+
+def _child(mode: str, path: str) -> None:
+    with open(path, "rb") as fh:
+        raw = fh.read()
+    from PIL import Image
+    from app import preprocess
+
+    base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    t0 = time.perf_counter()
+    if mode == "legacy":
+        img = Image.open(io.BytesIO(raw)).convert("RGBA")
+        out = preprocess.downscale_max_dim(img, preprocess.max_dim)
+    else:
+        out = preprocess.decode_image(raw)
+    elapsed = time.perf_counter() - t0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(json.dumps({"mode": mode, "size": list(out.size), "seconds": elapsed,
+                      "peak_rss_mb": peak / 1024.0, "decode_rss_mb": (peak - base) / 1024.0}))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Upload decode memory benchmark")
+    parser.add_argument("--megapixels", type=float, default=48.0)
+    parser.add_argument("--child", nargs=2, metavar=("MODE", "PATH"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        _child(*args.child)
+        return
+
+    path = f"/tmp/bench_decode_{int(args.megapixels)}mp.jpg"
+    if not os.path.exists(path):
+        with open(path, "wb") as fh:
+            fh.write(_make_jpeg(args.megapixels))
+    print(f"input: {path} ({os.path.getsize(path) / 1e6:.1f} MB JPEG)")
+    for mode in ("legacy", "current"):
+        out = subprocess.run([sys.executable, "-m", "bench.decode_memory", "--child", mode, path],
+                             capture_output=True, text=True, check=True)
+        r = json.loads(out.stdout.strip().splitlines()[-1])
+        print(f"{mode:>8}: {r['seconds'] * 1000:8.1f} ms  decode RSS +{r['decode_rss_mb']:7.1f} MB  "
+              f"peak {r['peak_rss_mb']:7.1f} MB  -> {r['size'][0]}x{r['size'][1]}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+"""Face-preservation blend: speed and visual diff of the engines in app.postprocess.
+
+For each fixture pair (user photo, recorded generation from ``frontend/public``),
+the legacy blend is the reference: full-frame ``seamlessClone``, with the user face
+detected and resized on every call. Each engine in ``postprocess.BLEND_MODES`` is
+then run on the region around the face, with the user face crop computed once as in
+a request. The report gives median latency, and PSNR against the legacy output over
+the face region.
+
+``--out-dir`` writes a visual diff per fixture and mode: the face region as
+[legacy | engine | |diff| x4]. ``--check DIR`` compares every engine output with the
+one saved in DIR by an earlier ``--out-dir`` run and exits 1 below ``--min-psnr``,
+so blend changes can be gated like benchmark regressions.
+
+    cd backend && python -m bench.face_blend --out-dir blend-main
+    cd backend && python -m bench.face_blend --check blend-main --min-psnr 40
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+from app import postprocess
+from app.faces import Box, detect_faces, largest_face
+
+from .suite import _decode, _fixture
+
+# (user photo, recorded generation)
+FIXTURES = [
+    ("step01.png", "gemini-result.png"),
+    ("step01.png", "tryitout-result.png"),
+    ("face01.png", "botika-result.png"),
+    ("founder-photo.png", "chatgpt-result.png"),
+]
+
+
+def legacy_blend(user_bgr: np.ndarray, gen_bgr: np.ndarray) -> Optional[np.ndarray]:
+    """The previous engine: Poisson over the full generated frame."""
+    src_box = largest_face(detect_faces(user_bgr, min_size=60))
+    dst_box = largest_face(detect_faces(gen_bgr, min_size=60), min_size=60)
+    if src_box is None or dst_box is None:
+        return None
+    sx, sy, sw, sh = src_box
+    dx, dy, dw, dh = dst_box
+    face = cv2.resize(user_bgr[max(sy, 0): sy + sh, max(sx, 0): sx + sw], (dw, dh), interpolation=cv2.INTER_CUBIC)
+    mask = np.zeros((dh, dw), dtype=np.uint8)
+    cv2.ellipse(mask, (dw // 2, dh // 2), (int(dw * 0.45), int(dh * 0.55)), 0, 0, 360, 255, -1)
+    return cv2.seamlessClone(face, gen_bgr, mask, (dx + dw // 2, dy + dh // 2), cv2.NORMAL_CLONE)
+
+
+def _median_ms(fn: Callable[[], Any], repeat: int) -> Tuple[float, Any]:
+    out = fn()
+    samples = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - t0)
+    return statistics.median(samples) * 1000, out
+
+
+def _face_region(box: Box, shape: Tuple[int, ...]) -> Tuple[slice, slice]:
+    x, y, w, h = box
+    pad_x, pad_y = w // 2, h // 2
+    return slice(max(0, y - pad_y), min(shape[0], y + h + pad_y)), slice(max(0, x - pad_x), min(shape[1], x + w + pad_x))
+
+
+def _diff_panel(ref: np.ndarray, out: np.ndarray) -> np.ndarray:
+    diff = cv2.absdiff(ref, out)
+    heat = cv2.applyColorMap(np.clip(diff.max(axis=2).astype(np.int32) * 4, 0, 255).astype(np.uint8), cv2.COLORMAP_JET)
+    return np.hstack((ref, out, heat))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--out-dir", help="write visual diffs and engine outputs here")
+    parser.add_argument("--check", help="compare engine outputs with those saved in this directory")
+    parser.add_argument("--min-psnr", type=float, default=40.0, help="--check fails below this PSNR (dB)")
+    parser.add_argument("--json", help="write results to this file")
+    args = parser.parse_args()
+    if args.out_dir:
+        os.makedirs(args.out_dir, exist_ok=True)
+
+    results: Dict[str, Dict[str, Any]] = {}
+    failures: List[str] = []
+    for user_name, gen_name in FIXTURES:
+        user_bgr, gen_bgr = _decode(_fixture(user_name, 1)), _decode(_fixture(gen_name, 2))
+        name = f"{os.path.splitext(user_name)[0]}__{os.path.splitext(gen_name)[0]}"
+        dst_box = largest_face(detect_faces(gen_bgr, min_size=60), min_size=60)
+        legacy_ms, reference = _median_ms(lambda: legacy_blend(user_bgr, gen_bgr), args.repeat)
+        if reference is None or dst_box is None:
+            results[name] = {"skipped": "no face pair detected"}
+            continue
+        region = _face_region(dst_box, gen_bgr.shape)
+        faces = detect_faces(gen_bgr, min_size=50)
+        entry: Dict[str, Any] = {"size": list(gen_bgr.shape[:2]), "face": list(dst_box), "legacy_ms": legacy_ms}
+        source = postprocess.FaceSource(cv2.imencode(".png", user_bgr)[1].tobytes())
+        crop_ms, user_face = _median_ms(source.face, 1)  # memoized: the first call is the real cost
+        entry["face_crop_ms"] = crop_ms
+        for mode in postprocess.BLEND_MODES:
+            ms, out = _median_ms(lambda: postprocess.blend_face(user_face, gen_bgr, faces, mode), args.repeat)
+            if out is None:
+                entry[mode] = {"skipped": "blend declined"}
+                continue
+            ref_region, out_region = reference[region], out[region]
+            entry[mode] = {"median_ms": ms, "psnr_vs_legacy": cv2.PSNR(ref_region, out_region)}
+            if args.out_dir:
+                cv2.imwrite(os.path.join(args.out_dir, f"{name}__{mode}.png"), out_region)
+                cv2.imwrite(os.path.join(args.out_dir, f"{name}__{mode}__diff.png"), _diff_panel(ref_region, out_region))
+            if args.check:
+                saved = cv2.imread(os.path.join(args.check, f"{name}__{mode}.png"))
+                if saved is None or saved.shape != out_region.shape:
+                    failures.append(f"{name} {mode}: no comparable saved output")
+                    continue
+                psnr = cv2.PSNR(saved, out_region)
+                entry[mode]["psnr_vs_saved"] = psnr
+                if psnr < args.min_psnr:
+                    failures.append(f"{name} {mode}: PSNR {psnr:.1f} dB < {args.min_psnr}")
+        results[name] = entry
+
+    print(f"{'fixture':<40} {'face':>9} {'legacy ms':>10} " + " ".join(f"{m + ' ms/dB':>18}" for m in postprocess.BLEND_MODES))
+    for name, entry in results.items():
+        if "skipped" in entry:
+            print(f"{name:<40} skipped: {entry['skipped']}")
+            continue
+        cols = []
+        for mode in postprocess.BLEND_MODES:
+            r = entry[mode]
+            cols.append(f"{r['median_ms']:>9.1f}/{min(r['psnr_vs_legacy'], 99):>6.1f}" if "median_ms" in r else f"{'-':>16}")
+        face = f"{entry['face'][2]}x{entry['face'][3]}"
+        print(f"{name:<40} {face:>9} {entry['legacy_ms']:>10.1f} " + " ".join(f"{c:>18}" for c in cols))
+    if args.json:
+        with open(args.json, "w") as fh:
+            json.dump(results, fh, indent=2)
+    if failures:
+        print("\nVISUAL DIFF FAILURES:\n  " + "\n  ".join(failures))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
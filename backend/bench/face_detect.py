@@ -0,0 +1,78 @@
+"""Microbenchmark: face detection as used by the post-processing of one accepted variant.
+
+legacy  - what the pipeline used to do: build a new CascadeClassifier (parsing the
+          XML) for each detection, full resolution, three detections per variant
+          (collage guard on the generated image, then user + generated in the blend)
+current - app.faces: cached per-thread classifier, downscaled detection, generated
+          image detected once and shared by collage guard and blend
+
+    cd backend && python -m bench.face_detect --repeat 10
+"""
+import argparse
+import os
+import statistics
+import time
+
+import cv2
+
+from app.faces import detect_faces, largest_face
+
+_PUBLIC = os.path.join(os.path.dirname(__file__), "..", "..", "frontend", "public")
+
+
+def _legacy_detect(bgr, min_size):
+    gray = cv2.cvtColor(bgr, cv2.COLOR_BGR2GRAY)
+    face_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + "haarcascade_frontalface_default.xml")
+    return face_cascade.detectMultiScale(gray, scaleFactor=1.1, minNeighbors=5, minSize=(min_size, min_size))
+
+
+def legacy(user_bgr, gen_bgr):
+    collage_faces = _legacy_detect(gen_bgr, 50)
+    src = _legacy_detect(user_bgr, 60)
+    dst = _legacy_detect(gen_bgr, 60)
+    return collage_faces, src, dst
+
+
+def current(user_bgr, gen_bgr):
+    gen_faces = detect_faces(gen_bgr, min_size=50)
+    src = largest_face(detect_faces(user_bgr, min_size=60))
+    dst = largest_face(gen_faces, min_size=60)
+    return gen_faces, src, dst
+
+
+def _time(fn, *args, repeat: int):
+    samples = []
+    result = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        result = fn(*args)
+        samples.append((time.perf_counter() - t0) * 1000)
+    return statistics.median(samples), result
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Face detection microbenchmark")
+    parser.add_argument("--user", default=os.path.join(_PUBLIC, "step01.png"))
+    parser.add_argument("--generated", default=os.path.join(_PUBLIC, "tryitout-result.png"))
+    parser.add_argument("--repeat", type=int, default=10)
+    args = parser.parse_args()
+
+    user_bgr = cv2.imread(args.user, cv2.IMREAD_COLOR)
+    gen_bgr = cv2.imread(args.generated, cv2.IMREAD_COLOR)
+    if user_bgr is None or gen_bgr is None:
+        raise SystemExit("could not read fixture images")
+
+    for label, scale in (("native", 1.0), ("1.5x", 1.5)):
+        u = cv2.resize(user_bgr, None, fx=scale, fy=scale) if scale != 1.0 else user_bgr
+        g = cv2.resize(gen_bgr, None, fx=scale, fy=scale) if scale != 1.0 else gen_bgr
+        legacy_ms, legacy_res = _time(legacy, u, g, repeat=args.repeat)
+        current_ms, current_res = _time(current, u, g, repeat=args.repeat)
+        print(f"{label:>6} {g.shape[1]}x{g.shape[0]}: legacy {legacy_ms:7.1f} ms  current {current_ms:7.1f} ms  "
+              f"speedup {legacy_ms / current_ms:4.1f}x")
+        print(f"        faces legacy={len(legacy_res[0])} current={len(current_res[0])}  "
+              f"dst legacy={tuple(max(legacy_res[2], key=lambda r: r[2] * r[3])) if len(legacy_res[2]) else None} "
+              f"current={current_res[2]}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""Tail latency with and without hedged Gemini attempts (GEMINI_HEDGE, see app.upstream).
+
+Runs ``pipeline.generate_variants`` in-process (result cache off) against the stub,
+which injects stragglers: ``--slow-rate`` of the calls take ``--slow-s`` longer. The
+same load runs with hedging off and then on (the latency window is warm by then).
+The report gives p50/p95/p99 request latency and the upstream calls per request,
+which is the duplicate work that hedging spent.
+
+    cd backend && python -m bench.hedging --requests 200 --concurrency 4
+    cd backend && GEMINI_HEDGE_PERCENTILE=90 GEMINI_HEDGE_BUDGET=2 python -m bench.hedging
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import time
+from typing import Any, Dict, List
+
+from .stub_gemini import StubGemini
+from .suite import _fixture
+
+
+def _pct(samples: List[float], p: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(p / 100.0 * (len(ordered) - 1))))]
+
+
+async def _phase(requests: int, concurrency: int, user_png: bytes, cloth_png: bytes, stub: StubGemini) -> Dict[str, Any]:
+    from app import metrics, pipeline
+
+    latencies: List[float] = []
+    failures = 0
+    upstream_before = stub.requests
+    started_before, won_before = metrics.hedges.value(event="started"), metrics.hedges.value(event="won")
+    queue: "asyncio.Queue[int]" = asyncio.Queue()
+    for i in range(requests):
+        queue.put_nowait(i)
+
+    async def client() -> None:
+        nonlocal failures
+        while not queue.empty():
+            queue.get_nowait()
+            t0 = time.monotonic()
+            images, _ = await pipeline.generate_variants(user_png, cloth_png, "Plain White", 1, use_cache=False)
+            latencies.append(time.monotonic() - t0)
+            failures += 0 if images else 1
+
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    return {
+        "requests": len(latencies),
+        "failures": failures,
+        "p50_s": _pct(latencies, 50),
+        "p95_s": _pct(latencies, 95),
+        "p99_s": _pct(latencies, 99),
+        "max_s": max(latencies),
+        "upstream_per_request": (stub.requests - upstream_before) / float(len(latencies)),
+        "hedges_started": int(metrics.hedges.value(event="started") - started_before),
+        "hedges_won": int(metrics.hedges.value(event="won") - won_before),
+    }
+
+
+async def _run(args: argparse.Namespace, stub: StubGemini) -> Dict[str, Dict[str, Any]]:
+    from app import upstream
+
+    user_png = _fixture("step01.png", 1)
+    cloth_png = _fixture("shirt.png", 3)
+    results = {}
+    upstream.hedge_enabled = False
+    await _phase(max(20, args.concurrency), args.concurrency, user_png, cloth_png, stub)  # warm-up
+    results["hedge_off"] = await _phase(args.requests, args.concurrency, user_png, cloth_png, stub)
+    upstream.hedge_enabled = True
+    results["hedge_on"] = await _phase(args.requests, args.concurrency, user_png, cloth_png, stub)
+    results["hedge_on"]["hedge_delay_s"] = upstream.hedge_delay()
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=200, help="requests per phase")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--latency", type=float, default=0.5, help="stub base latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.2, help="uniform extra latency in seconds")
+    parser.add_argument("--slow-rate", type=float, default=0.03, help="fraction of calls that straggle")
+    parser.add_argument("--slow-s", type=float, default=6.0, help="extra latency of a straggler")
+    parser.add_argument("--json", help="write results to this file")
+    args = parser.parse_args()
+    logging.getLogger("app.gemini").setLevel(logging.CRITICAL)
+
+    with StubGemini(latency_s=args.latency, jitter_s=args.jitter, slow_rate=args.slow_rate, slow_s=args.slow_s,
+                    image_png=_fixture("gemini-result.png", 2), seed=7) as stub:
+        os.environ.update(GEMINI_API_BASE=stub.base_url, GEMINI_API_KEY="bench")
+        results = asyncio.run(_run(args, stub))
+
+    print(f"stub {args.latency}s + U(0, {args.jitter})s, {args.slow_rate:.0%} stragglers +{args.slow_s}s, "
+          f"{args.concurrency} clients, {args.requests} requests per phase")
+    print(f"{'phase':<10} {'p50 s':>7} {'p95 s':>7} {'p99 s':>7} {'max s':>7} {'calls/req':>10} {'hedges':>7} {'won':>5} {'failed':>7}")
+    for name, r in results.items():
+        print(f"{name:<10} {r['p50_s']:>7.2f} {r['p95_s']:>7.2f} {r['p99_s']:>7.2f} {r['max_s']:>7.2f} "
+              f"{r['upstream_per_request']:>10.2f} {r['hedges_started']:>7} {r['hedges_won']:>5} {r['failures']:>7}")
+    if args.json:
+        with open(args.json, "w") as fh:
+            json.dump(results, fh, indent=2)
+
+
+if __name__ == "__main__":
+    main()
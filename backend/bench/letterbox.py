@@ -0,0 +1,131 @@
+"""Microbenchmark and equivalence check for letterbox detection.
+
+Compares the vectorized ``app.postprocess.letterbox_box`` against the original
+column-by-column Python loop on 1536 px and 4096 px frames, and checks that both
+give identical crops for black bars (the legacy loop does not know other colors).
+
+    cd backend && python -m bench.letterbox --repeat 5
+"""
+import argparse
+import statistics
+import time
+
+import cv2
+import numpy as np
+
+from app.postprocess import letterbox_box
+
+
+def legacy_letterbox_box(bgr):
+    """The pre-vectorization implementation, kept verbatim as the reference."""
+    H, W = bgr.shape[:2]
+    if H < 10 or W < 10:
+        return None
+    gray = cv2.cvtColor(bgr, cv2.COLOR_BGR2GRAY)
+    black_thresh = 14
+    max_frac = 0.20
+    min_run = 6
+
+    def count_black_cols_from_edge(img_gray, from_left):
+        h, w = img_gray.shape
+        limit = int(w * max_frac)
+        run = 0
+        rng = range(w) if from_left else range(w - 1, -1, -1)
+        for xi, x in enumerate(rng):
+            if xi >= limit:
+                break
+            col = img_gray[:, x]
+            black_ratio = float((col <= black_thresh).sum()) / float(h)
+            if black_ratio >= 0.98:
+                run += 1
+            else:
+                break
+        return run if run >= min_run else 0
+
+    def count_black_rows_from_edge(img_gray, from_top):
+        h, w = img_gray.shape
+        limit = int(h * max_frac)
+        run = 0
+        rng = range(h) if from_top else range(h - 1, -1, -1)
+        for yi, y in enumerate(rng):
+            if yi >= limit:
+                break
+            row = img_gray[y, :]
+            black_ratio = float((row <= black_thresh).sum()) / float(w)
+            if black_ratio >= 0.98:
+                run += 1
+            else:
+                break
+        return run if run >= min_run else 0
+
+    x0 = count_black_cols_from_edge(gray, True)
+    x1 = W - count_black_cols_from_edge(gray, False)
+    y0 = count_black_rows_from_edge(gray, True)
+    y1 = H - count_black_rows_from_edge(gray, False)
+    if x0 < 0 or y0 < 0 or x1 <= x0 + 10 or y1 <= y0 + 10:
+        return None
+    if (y0, y1, x0, x1) == (0, H, 0, W):
+        return None
+    return y0, y1, x0, x1
+
+
+def _frame(long_side, rng, bars=(0, 0, 0, 0), color=(0, 0, 0), speckle=0.0):
+    """Noisy content frame (3:4) with bars of ``color`` (left, right, top, bottom)."""
+    H, W = long_side, long_side * 3 // 4
+    img = rng.integers(40, 220, size=(H, W, 3), dtype=np.uint8)
+    left, right, top, bottom = bars
+    for sl in (np.s_[:, :left], np.s_[:, W - right:] if right else None, np.s_[:top], np.s_[H - bottom:] if bottom else None):
+        if sl is not None:
+            img[sl] = color
+    if speckle:
+        mask = rng.random((H, W)) < speckle
+        img[mask] = 128
+    return img
+
+
+def _time(fn, img, repeat):
+    samples = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn(img)
+        samples.append((time.perf_counter() - t0) * 1000)
+    return statistics.median(samples)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Letterbox detection benchmark")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--random-cases", type=int, default=200, help="randomized equivalence cases")
+    args = parser.parse_args()
+    rng = np.random.default_rng(0)
+
+    scenarios = [
+        ("no bars", dict()),
+        ("black side bars", dict(bars=(90, 90, 0, 0))),
+        ("black all edges", dict(bars=(40, 60, 80, 30), speckle=0.01)),
+        ("white side bars", dict(bars=(90, 90, 0, 0), color=(250, 250, 250))),
+        ("teal top/bottom", dict(bars=(0, 0, 70, 70), color=(120, 128, 10))),
+    ]
+    print(f"{'frame':>6} {'scenario':<18} {'legacy ms':>10} {'vector ms':>10} {'speedup':>8}  crops")
+    for long_side in (1536, 4096):
+        for name, kw in scenarios:
+            img = _frame(long_side, rng, **kw)
+            legacy_ms = _time(legacy_letterbox_box, img, args.repeat)
+            vector_ms = _time(letterbox_box, img, args.repeat)
+            print(f"{long_side:>6} {name:<18} {legacy_ms:>10.2f} {vector_ms:>10.2f} {legacy_ms / vector_ms:>7.1f}x  "
+                  f"legacy={legacy_letterbox_box(img)} vector={letterbox_box(img)}")
+
+    mismatches = 0
+    for _ in range(args.random_cases):
+        long_side = int(rng.integers(40, 900))
+        bars = tuple(int(b) for b in rng.integers(0, max(2, long_side // 4), size=4) * (rng.random(4) < 0.5))
+        img = _frame(long_side, rng, bars=bars, speckle=float(rng.choice([0.0, 0.01, 0.03])))
+        if legacy_letterbox_box(img) != letterbox_box(img):
+            mismatches += 1
+    print(f"black-bar equivalence: {args.random_cases - mismatches}/{args.random_cases} identical")
+    if mismatches:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
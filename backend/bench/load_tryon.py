@@ -0,0 +1,175 @@
+"""Load benchmark for /api/tryon against a stubbed Gemini upstream.
+
+Runs the FastAPI app in-process under uvicorn, drives it with increasing client
+concurrency and reports p50/p99 latency of /api/tryon together with /health
+latency sampled while the load is running (a blocked event loop shows up there)
+and process RSS (peak and at the end of each level).
+
+    cd backend && python -m bench.load_tryon --levels 1,4,8,16 --latency 2.0
+    # sustained load for memory comparisons between commits
+    cd backend && python -m bench.load_tryon --levels 8 --duration 120 --distinct 16 --json rss.json
+"""
+import argparse
+import json
+import os
+import socket
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+import requests
+
+from app.memtrack import rss_bytes
+
+from .stub_gemini import StubGemini, synthetic_png
+
+
+def _percentile(samples: List[float], pct: float) -> float:
+    if not samples:
+        return float("nan")
+    ordered = sorted(samples)
+    idx = min(len(ordered) - 1, max(0, int(round(pct / 100.0 * (len(ordered) - 1)))))
+    return ordered[idx]
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_app(port: int):
+    """Import the app (after env is configured) and serve it from a background thread."""
+    import uvicorn
+    from app.main import app
+
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    deadline = time.time() + 120
+    while not server.started and time.time() < deadline:
+        time.sleep(0.05)
+    return server, thread
+
+
+def run_level(base: str, concurrency: int, total: int, user_pngs: List[bytes], cloth_png: bytes,
+              variants: int = 1, duration: float = 0.0) -> Dict[str, float]:
+    """Drive one concurrency level: ``total`` requests, or as many as fit in ``duration`` seconds."""
+    latencies: List[float] = []
+    health: List[float] = []
+    rss: List[int] = []
+    errors = 0
+    stop = threading.Event()
+
+    def probe_health():
+        while not stop.is_set():
+            t0 = time.perf_counter()
+            try:
+                requests.get(f"{base}/health", timeout=30)
+                health.append(time.perf_counter() - t0)
+            except requests.RequestException:
+                pass
+            sample = rss_bytes()
+            if sample is not None:
+                rss.append(sample)
+            stop.wait(0.1)
+
+    def one(i):
+        t0 = time.perf_counter()
+        resp = requests.post(
+            f"{base}/api/tryon",
+            files={"user_image": ("user.png", user_pngs[i % len(user_pngs)], "image/png"),
+                   "clothing_image": ("cloth.png", cloth_png, "image/png")},
+            data={"background": "Plain White", "variants": str(variants)},
+            timeout=300,
+        )
+        return time.perf_counter() - t0, resp.status_code
+
+    def sustained(worker):
+        out = []
+        i = worker
+        while time.perf_counter() - t_start < duration:
+            out.append(one(i))
+            i += concurrency
+        return out
+
+    prober = threading.Thread(target=probe_health, daemon=True)
+    prober.start()
+    t_start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        if duration > 0:
+            results = [r for batch in pool.map(sustained, range(concurrency)) for r in batch]
+        else:
+            results = list(pool.map(one, range(total)))
+    wall = time.perf_counter() - t_start
+    stop.set()
+    prober.join()
+    for elapsed, status in results:
+        latencies.append(elapsed)
+        if status != 200:
+            errors += 1
+    mb = 1024.0 * 1024.0
+    return {
+        "concurrency": concurrency,
+        "requests": len(results),
+        "errors": errors,
+        "throughput_rps": len(results) / wall if wall else 0.0,
+        "p50_s": _percentile(latencies, 50),
+        "p99_s": _percentile(latencies, 99),
+        "mean_s": statistics.fmean(latencies) if latencies else float("nan"),
+        "health_p50_ms": _percentile(health, 50) * 1000,
+        "health_p99_ms": _percentile(health, 99) * 1000,
+        "rss_peak_mb": max(rss) / mb if rss else float("nan"),
+        "rss_end_mb": rss[-1] / mb if rss else float("nan"),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--levels", default="1,2,4,8,16", help="comma-separated client concurrency levels")
+    parser.add_argument("--per-level", type=int, default=3, help="requests per client at each level")
+    parser.add_argument("--latency", type=float, default=2.0, help="stub Gemini latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.5, help="extra uniform random latency in seconds")
+    parser.add_argument("--variants", type=int, default=1, help="variants per request (server caps at MAX_VARIANTS)")
+    parser.add_argument("--duration", type=float, default=0.0,
+                        help="sustain each level for this many seconds instead of --per-level requests")
+    parser.add_argument("--distinct", type=int, default=1,
+                        help="number of distinct user images to rotate through (defeats the cut-out cache)")
+    parser.add_argument("--size", type=int, default=1024, help="longest side of the uploaded test images")
+    parser.add_argument("--json", dest="json_out", help="write results to this JSON file")
+    args = parser.parse_args()
+
+    stub = StubGemini(latency_s=args.latency, jitter_s=args.jitter).start()
+    os.environ["GEMINI_API_BASE"] = stub.base_url
+    os.environ.setdefault("GEMINI_API_KEY", "bench")
+
+    port = _free_port()
+    server, thread = start_app(port)
+    base = f"http://127.0.0.1:{port}"
+    user_pngs = [synthetic_png(args.size * 3 // 4, args.size, seed=1 + i) for i in range(max(1, args.distinct))]
+    cloth_png = synthetic_png(args.size, args.size, seed=2)
+
+    results = []
+    try:
+        print(f"{'conc':>5} {'reqs':>5} {'err':>4} {'rps':>7} {'p50 s':>8} {'p99 s':>8} "
+              f"{'health p50 ms':>14} {'health p99 ms':>14} {'rss peak MB':>12} {'rss end MB':>11}")
+        for level in [int(x) for x in args.levels.split(",") if x.strip()]:
+            r = run_level(base, level, level * args.per_level, user_pngs, cloth_png, args.variants, args.duration)
+            results.append(r)
+            print(f"{r['concurrency']:>5} {r['requests']:>5} {r['errors']:>4} {r['throughput_rps']:>7.2f} "
+                  f"{r['p50_s']:>8.2f} {r['p99_s']:>8.2f} {r['health_p50_ms']:>14.1f} {r['health_p99_ms']:>14.1f} "
+                  f"{r['rss_peak_mb']:>12.1f} {r['rss_end_mb']:>11.1f}")
+    finally:
+        server.should_exit = True
+        thread.join(timeout=10)
+        stub.stop()
+
+    if args.json_out:
+        with open(args.json_out, "w") as fh:
+            json.dump({"stub_latency_s": args.latency, "results": results}, fh, indent=2)
+
+
+if __name__ == "__main__":
+    main()
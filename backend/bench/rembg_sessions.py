@@ -0,0 +1,120 @@
+"""rembg throughput per core for onnxruntime session configurations.
+
+Each configuration runs ``--clients`` threads that cut out a fixed image for
+``--seconds``. The configurations are:
+
+- shared-default: the old setup, one session with default onnxruntime threading
+  used by every thread at once
+- pool SxT: S pooled sessions (app.sessions.SessionPool) with T intra-op threads each
+
+The report gives images/s, images/s per core, and p50/p90 latency.
+
+    cd backend && python -m bench.rembg_sessions --model u2netp --size 1024
+    cd backend && python -m bench.rembg_sessions --configs 1x8,2x4,4x2,8x1 --graph-opt basic
+"""
+import argparse
+import io
+import json
+import os
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, List, Tuple
+
+from PIL import Image
+
+from .stub_gemini import synthetic_png
+
+
+def _run(use_session: Callable[[], Any], image: Image.Image, clients: int, seconds: float) -> Dict[str, float]:
+    from rembg import remove
+
+    latencies: List[float] = []
+    lock = threading.Lock()
+    stop_at = time.monotonic() + seconds
+
+    def client() -> None:
+        while time.monotonic() < stop_at:
+            t0 = time.perf_counter()
+            with use_session() as session:
+                remove(image, session=session)
+            with lock:
+                latencies.append(time.perf_counter() - t0)
+
+    t_start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=clients) as pool:
+        for f in [pool.submit(client) for _ in range(clients)]:
+            f.result()
+    wall = time.monotonic() - t_start
+    latencies.sort()
+    cores = os.cpu_count() or 1
+    return {
+        "images": len(latencies),
+        "images_per_s": len(latencies) / wall,
+        "images_per_s_per_core": len(latencies) / wall / cores,
+        "p50_ms": statistics.median(latencies) * 1000 if latencies else float("nan"),
+        "p90_ms": latencies[int(0.9 * (len(latencies) - 1))] * 1000 if latencies else float("nan"),
+    }
+
+
+def _parse_configs(spec: str) -> List[Tuple[int, int]]:
+    out = []
+    for item in spec.split(","):
+        sessions_n, _, threads = item.strip().partition("x")
+        out.append((int(sessions_n), int(threads)))
+    return out
+
+
+def main() -> None:
+    cores = os.cpu_count() or 1
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", default=os.getenv("REMBG_MODEL", "u2netp"))
+    parser.add_argument("--size", type=int, default=1024, help="longest side of the test image")
+    parser.add_argument("--clients", type=int, default=cores, help="concurrent callers")
+    parser.add_argument("--seconds", type=float, default=15.0, help="duration per configuration")
+    parser.add_argument("--configs", default=",".join(
+        f"{s}x{max(1, cores // s)}" for s in sorted({1, max(1, cores // 4), max(1, cores // 2), cores})
+    ), help="comma-separated SESSIONSxINTRA_THREADS pool configurations")
+    parser.add_argument("--graph-opt", default="all", choices=("disable", "basic", "extended", "all"))
+    parser.add_argument("--json", help="write results to this file")
+    args = parser.parse_args()
+
+    from rembg import new_session
+
+    from app import sessions
+
+    image = Image.open(io.BytesIO(synthetic_png(args.size * 3 // 4, args.size, seed=1))).convert("RGBA")
+    results: Dict[str, Dict[str, Any]] = {}
+
+    shared = new_session(args.model)
+
+    @contextmanager
+    def use_shared():
+        yield shared
+
+    _run(use_shared, image, 1, 0.5)  # warm up
+    results["shared-default"] = _run(use_shared, image, args.clients, args.seconds)
+
+    sessions.graph_opt = args.graph_opt
+    for n_sessions, threads in _parse_configs(args.configs):
+        sessions.intra_threads = threads
+        pool = sessions.SessionPool(args.model, n_sessions)
+        pool.release(pool.fill())
+        _run(pool.session, image, 1, 0.5)
+        results[f"pool {n_sessions}x{threads}"] = _run(pool.session, image, args.clients, args.seconds)
+
+    print(f"model {args.model}, {args.size}px, {args.clients} clients, {cores} cores, graph opt {args.graph_opt}")
+    print(f"{'config':<16} {'images':>7} {'img/s':>8} {'img/s/core':>11} {'p50 ms':>9} {'p90 ms':>9}")
+    for name, r in results.items():
+        print(f"{name:<16} {r['images']:>7} {r['images_per_s']:>8.2f} {r['images_per_s_per_core']:>11.3f} "
+              f"{r['p50_ms']:>9.1f} {r['p90_ms']:>9.1f}")
+    if args.json:
+        with open(args.json, "w") as fh:
+            json.dump({"model": args.model, "size": args.size, "clients": args.clients, "cores": cores,
+                       "graph_opt": args.graph_opt, "results": results}, fh, indent=2)
+
+
+if __name__ == "__main__":
+    main()
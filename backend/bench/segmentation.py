@@ -0,0 +1,135 @@
+"""Quality versus latency of the reduced-resolution segmentation path (app.segment).
+
+Every fixture is decoded the way uploads are (MAX_DIM) and cut out with the current
+full-resolution ``rembg.remove()``, which is the reference. Each variant is then
+compared against it:
+
+- mask320 / mask512: mask predicted on a copy at most 320 / 512 px, either with
+  guided edge refinement or plain bilinear upsampling (``-none``)
+- int8 variants: the same with the quantized model, if ``python -m app.preprocess
+  --quantize`` has written it
+
+The report gives median latency over ``--repeat`` runs, IoU of the alpha >= 128
+region, mean absolute alpha error over the image, and the same error inside the edge
+band (soft or boundary pixels of the reference, dilated by 4 px), where downsampling
+artifacts show.
+
+    cd backend && python -m bench.segmentation --repeat 5 --json seg.json
+"""
+import argparse
+import json
+import os
+import statistics
+import time
+from typing import Any, Callable, Dict, List, Tuple
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from .suite import _fixture
+
+# (fixture in frontend/public, role) -- people use the user model, garments the clothing model
+FIXTURES = [
+    ("step01.png", "user"),
+    ("face01.png", "user"),
+    ("founder-photo.png", "user"),
+    ("clothing-model-reference.png", "user"),
+    ("shirt.png", "clothing"),
+    ("jacket.jpeg", "clothing"),
+]
+VARIANTS: List[Tuple[str, int, str]] = [
+    ("mask320", 320, "guided"),
+    ("mask320-none", 320, "none"),
+    ("mask512", 512, "guided"),
+    ("mask512-none", 512, "none"),
+]
+
+
+def _median_ms(fn: Callable[[], Any], repeat: int) -> Tuple[float, Any]:
+    out = fn()  # warm-up, and the output that gets scored
+    samples = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - t0)
+    return statistics.median(samples) * 1000, out
+
+
+def _alpha(img: Image.Image) -> np.ndarray:
+    return np.asarray(img.convert("RGBA").getchannel("A")).astype(np.float32)
+
+
+def score(ref: np.ndarray, alpha: np.ndarray) -> Dict[str, float]:
+    fg_ref, fg = ref >= 128, alpha >= 128
+    union = np.logical_or(fg_ref, fg).sum()
+    iou = float(np.logical_and(fg_ref, fg).sum() / union) if union else 1.0
+    err = np.abs(ref - alpha) / 255.0
+    soft = ((ref > 8) & (ref < 247)).astype(np.uint8)
+    boundary = cv2.morphologyEx(fg_ref.astype(np.uint8), cv2.MORPH_GRADIENT, np.ones((3, 3), np.uint8))
+    band = cv2.dilate(soft | boundary, np.ones((9, 9), np.uint8)).astype(bool)
+    return {
+        "iou": iou,
+        "alpha_mae": float(err.mean()),
+        "edge_mae": float(err[band].mean()) if band.any() else 0.0,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=5, help="timed runs per fixture and variant")
+    parser.add_argument("--json", help="write results to this file")
+    args = parser.parse_args()
+
+    from rembg import remove
+
+    from app import preprocess, segment, sessions
+
+    sessions.quantized = False
+    int8_sessions: Dict[str, Any] = {}
+    for model in sorted(set(sessions.ROLE_MODELS.values())):
+        if os.path.exists(sessions.quantized_path(model)):
+            sessions.quantized = True
+            int8_sessions[model] = sessions.SessionPool(model, 1).fill()[0]
+            sessions.quantized = False
+    variants = [(name, dim, method, False) for name, dim, method in VARIANTS]
+    if int8_sessions:
+        variants += [(f"int8-{name}", dim, method, True) for name, dim, method in VARIANTS]
+
+    rows: Dict[str, Dict[str, List[float]]] = {}
+    per_fixture: Dict[str, Dict[str, Any]] = {}
+    for name, role in FIXTURES:
+        img = preprocess.decode_image(_fixture(name, fallback_seed=len(name)))
+        model = sessions.model_for(role)
+        with sessions.pool(model).session() as session:
+            ref_ms, ref = _median_ms(lambda: remove(img, session=session), args.repeat)
+            ref_alpha = _alpha(ref)
+            results: Dict[str, Any] = {"size": list(img.size), "model": model, "reference": {"median_ms": ref_ms}}
+            rows.setdefault("reference", {}).setdefault("median_ms", []).append(ref_ms)
+            for vname, dim, method, int8 in variants:
+                if int8 and model not in int8_sessions:
+                    continue
+                s = int8_sessions[model] if int8 else session
+                ms, out = _median_ms(lambda: segment.cutout(img, s, dim, method), args.repeat)
+                r = {"median_ms": ms, **score(ref_alpha, _alpha(out))}
+                results[vname] = r
+                for key, value in r.items():
+                    rows.setdefault(vname, {}).setdefault(key, []).append(value)
+        per_fixture[name] = results
+
+    print(f"{len(per_fixture)} fixtures, MAX_DIM {preprocess.max_dim}, models {sessions.ROLE_MODELS}")
+    print(f"{'variant':<20} {'median ms':>10} {'IoU':>7} {'alpha MAE':>10} {'edge MAE':>9}")
+    summary: Dict[str, Dict[str, float]] = {}
+    for vname, cols in rows.items():
+        summary[vname] = {key: statistics.mean(values) for key, values in cols.items()}
+        s = summary[vname]
+        print(f"{vname:<20} {s['median_ms']:>10.1f} {s.get('iou', 1.0):>7.4f} "
+              f"{s.get('alpha_mae', 0.0):>10.4f} {s.get('edge_mae', 0.0):>9.4f}")
+    if args.json:
+        with open(args.json, "w") as fh:
+            json.dump({"max_dim": preprocess.max_dim, "models": sessions.ROLE_MODELS,
+                       "summary": summary, "fixtures": per_fixture}, fh, indent=2)
+
+
+if __name__ == "__main__":
+    main()
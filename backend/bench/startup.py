@@ -0,0 +1,121 @@
+"""Startup benchmark: time to liveness, readiness and first try-on, plus memory.
+
+Starts the server as a subprocess (against the Gemini stub) and reports:
+
+- live_s: until ``/health/live`` answers
+- ready_s: until ``/health/ready`` returns 200
+- first_tryon_s: until the first ``/api/tryon`` completes, sent once the server is ready
+- RSS and PSS summed over the process tree. PSS splits shared pages between the
+  processes that map them, so it shows the copy-on-write sharing of ``app.serve``.
+
+    cd backend && python -m bench.startup --mode uvicorn --workers 4
+    cd backend && python -m bench.startup --mode serve --workers 4
+    cd backend && MODEL_LOAD=startup python -m bench.startup --mode uvicorn   # the old blocking warmup
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+from typing import Dict, List, Optional
+
+import requests
+
+from .load_tryon import _free_port
+from .stub_gemini import StubGemini, synthetic_png
+
+
+def _children(pid: int) -> List[int]:
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as fh:
+            kids = [int(x) for x in fh.read().split()]
+    except OSError:
+        return []
+    return kids + [k for kid in kids for k in _children(kid)]
+
+
+def _memory_mb(root: int) -> Dict[str, Optional[float]]:
+    rss = pss = 0
+    for pid in [root] + _children(root):
+        try:
+            with open(f"/proc/{pid}/smaps_rollup") as fh:
+                for line in fh:
+                    if line.startswith("Rss:"):
+                        rss += int(line.split()[1])
+                    elif line.startswith("Pss:"):
+                        pss += int(line.split()[1])
+        except OSError:
+            return {"rss_mb": None, "pss_mb": None}
+    return {"rss_mb": rss / 1024.0, "pss_mb": pss / 1024.0, "processes": len(_children(root)) + 1}
+
+
+def _wait(fn, timeout: float) -> Optional[float]:
+    t0 = time.monotonic()
+    while time.monotonic() - t0 < timeout:
+        try:
+            if fn():
+                return time.monotonic()
+        except requests.RequestException:
+            pass
+        time.sleep(0.02)
+    return None
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mode", choices=("uvicorn", "serve"), default="serve")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--timeout", type=float, default=300.0)
+    parser.add_argument("--json", help="write results to this file")
+    args = parser.parse_args()
+
+    stub = StubGemini(latency_s=0.2).start()
+    port = _free_port()
+    env = dict(os.environ, GEMINI_API_BASE=stub.base_url, GEMINI_API_KEY="bench")
+    if args.mode == "serve":
+        cmd = [sys.executable, "-m", "app.serve", "--workers", str(args.workers), "--host", "127.0.0.1",
+               "--port", str(port), "--log-level", "warning"]
+    else:
+        cmd = [sys.executable, "-m", "uvicorn", "app.main:app", "--workers", str(args.workers), "--host", "127.0.0.1",
+               "--port", str(port), "--log-level", "warning"]
+    base = f"http://127.0.0.1:{port}"
+    user_png = synthetic_png(768, 1024, seed=1)
+    cloth_png = synthetic_png(768, 768, seed=2)
+
+    t0 = time.monotonic()
+    proc = subprocess.Popen(cmd, env=env)
+    try:
+        live = _wait(lambda: requests.get(f"{base}/health/live", timeout=5).ok, args.timeout)
+        ready = _wait(lambda: requests.get(f"{base}/health/ready", timeout=5).status_code == 200, args.timeout)
+        first = _wait(lambda: requests.post(
+            f"{base}/api/tryon",
+            files={"user_image": ("u.png", user_png, "image/png"), "clothing_image": ("c.png", cloth_png, "image/png")},
+            data={"background": "Plain White"}, timeout=args.timeout,
+        ).ok, args.timeout)
+        time.sleep(1.0)  # let every worker finish its own startup
+        result = {
+            "mode": args.mode,
+            "workers": args.workers,
+            "model_load": os.getenv("MODEL_LOAD", "background"),
+            "live_s": live - t0 if live else None,
+            "ready_s": ready - t0 if ready else None,
+            "first_tryon_s": first - t0 if first else None,
+            **_memory_mb(proc.pid),
+        }
+    finally:
+        proc.terminate()
+        try:
+            proc.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+        stub.stop()
+
+    print(json.dumps(result, indent=2))
+    if args.json:
+        with open(args.json, "w") as fh:
+            json.dump(result, fh, indent=2)
+
+
+if __name__ == "__main__":
+    main()
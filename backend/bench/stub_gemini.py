@@ -0,0 +1,131 @@
+"""Local stand-in for the Gemini ``generateContent`` endpoint.
+
+Serves a fixed image with configurable latency, stragglers (``slow_rate`` of the
+calls take ``slow_s`` longer) and error injection (optionally with a Retry-After
+header; ``error_rate`` can be changed while running) so the backend
+can be load-tested without network access or API quota. Point the app at it with
+``GEMINI_API_BASE=<stub.base_url>`` before importing ``app.main``.
+"""
+import base64
+import io
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional
+
+import numpy as np
+from PIL import Image
+
+
+def synthetic_png(width: int = 768, height: int = 1024, seed: int = 0) -> bytes:
+    """Deterministic, non-trivial test image (noise over a gradient) encoded as PNG."""
+    rng = np.random.default_rng(seed)
+    y = np.linspace(0, 255, height, dtype=np.float32)[:, None]
+    x = np.linspace(0, 255, width, dtype=np.float32)[None, :]
+    base = np.stack([np.broadcast_to(y, (height, width)), np.broadcast_to(x, (height, width)),
+                     np.full((height, width), 128, np.float32)], axis=-1)
+    noise = rng.normal(0, 12, size=base.shape)
+    arr = np.clip(base + noise, 0, 255).astype(np.uint8)
+    buf = io.BytesIO()
+    Image.fromarray(arr, "RGB").save(buf, format="PNG")
+    return buf.getvalue()
+
+
+class StubGemini:
+    def __init__(
+        self,
+        latency_s: float = 0.5,
+        jitter_s: float = 0.0,
+        slow_rate: float = 0.0,
+        slow_s: float = 0.0,
+        error_rate: float = 0.0,
+        error_status: int = 503,
+        retry_after: Optional[float] = None,
+        image_png: Optional[bytes] = None,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        seed: int = 0,
+    ) -> None:
+        self.latency_s = latency_s
+        self.jitter_s = jitter_s
+        self.slow_rate = slow_rate
+        self.slow_s = slow_s
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.retry_after = retry_after
+        self.image_b64 = base64.b64encode(image_png or synthetic_png()).decode("utf-8")
+        self.requests = 0
+        self.requests_by_model: Dict[str, int] = {}
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._handler())
+        self._server.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/v1beta/models"
+
+    def _sample(self, path: str):
+        # .../models/<model>:generateContent?key=...
+        model = path.split("?", 1)[0].rsplit("/", 1)[-1].split(":", 1)[0]
+        with self._lock:
+            self.requests += 1
+            self.requests_by_model[model] = self.requests_by_model.get(model, 0) + 1
+            delay = self.latency_s + (self._rng.uniform(0, self.jitter_s) if self.jitter_s else 0.0)
+            if self.slow_rate and self._rng.random() < self.slow_rate:
+                delay += self.slow_s
+            fail = self._rng.random() < self.error_rate
+        return delay, fail
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):  # keep benchmark output clean
+                pass
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                self.rfile.read(length)
+                delay, fail = stub._sample(self.path)
+                time.sleep(delay)
+                if fail:
+                    body = json.dumps({"error": {"code": stub.error_status, "message": "injected"}}).encode()
+                    self.send_response(stub.error_status)
+                    if stub.retry_after is not None:
+                        self.send_header("Retry-After", str(int(stub.retry_after)))
+                else:
+                    body = json.dumps({
+                        "candidates": [{"content": {"parts": [
+                            {"inlineData": {"mimeType": "image/png", "data": stub.image_b64}}
+                        ]}}]
+                    }).encode()
+                    self.send_response(200)
+                try:
+                    self.send_header("Content-Type", "application/json")
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass  # the client gave up on this call (hedged or cancelled)
+
+        return Handler
+
+    def start(self) -> "StubGemini":
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self) -> "StubGemini":
+        return self.start()
+
+    def __exit__(self, *exc) -> None:
+        self.stop()
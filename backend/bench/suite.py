@@ -0,0 +1,268 @@
+"""Offline benchmark suite with JSON results and regression thresholds.
+
+Microbenchmarks time the CPU stages on recorded fixtures: the images in
+``frontend/public``, with ``gemini-result.png`` as a recorded Gemini output. They
+cover letterbox crop, Poisson face blend, collage guard, full post-processing, the
+Gemini request body per upload codec (time and size), and rembg at fixed sizes.
+End-to-end scenarios serve the app in-process with uvicorn against ``StubGemini``,
+which returns the recorded output with the configured latency and error rate. The result cache is off by default, so every request
+really generates.
+
+    cd backend && python -m bench.suite --out bench-main.json
+    # after a change: compare, failing (exit 1) on regressions beyond the threshold
+    cd backend && python -m bench.suite --out bench-new.json --baseline bench-main.json
+    cd backend && python -m bench.suite --quick --only micro --baseline bench-main.json --threshold rembg_1536=0.5
+
+A timing counts as a regression when it exceeds baseline * (1 + threshold), and by
+more than a small absolute slack (2 ms, or 50/100 ms for end-to-end p50/p99). The
+default threshold is ``--max-regression`` (0.25). Use ``--threshold name=value``
+for noisy entries. End-to-end scenarios also fail if their error count rises.
+Compare results taken on the same machine only.
+"""
+import argparse
+import base64
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+import cv2
+import numpy as np
+
+from .stub_gemini import StubGemini, synthetic_png
+
+_FIXTURES = os.path.join(os.path.dirname(__file__), "..", "..", "frontend", "public")
+
+# name -> (stub latency s, stub error rate, client concurrency, requests per client)
+SCENARIOS = {
+    "e2e_single": (0.5, 0.0, 1, 4),
+    "e2e_concurrent": (0.5, 0.0, 8, 3),
+    "e2e_flaky_upstream": (0.5, 0.2, 8, 3),
+}
+
+# Compared keys (lower is better) -> absolute slack below which a slowdown is noise
+_COMPARED = {"median_ms": 2.0, "p90_ms": 2.0, "p50_s": 0.05, "p99_s": 0.1}
+
+
+def _fixture(name: str, fallback_seed: int) -> bytes:
+    path = os.path.join(_FIXTURES, name)
+    try:
+        with open(path, "rb") as fh:
+            return fh.read()
+    except OSError:
+        return synthetic_png(832, 1248, seed=fallback_seed)
+
+
+def _decode(data: bytes) -> np.ndarray:
+    return cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+
+
+def _time(fn: Callable[[], Any], repeat: int, warmup: int = 1) -> Dict[str, float]:
+    for _ in range(warmup):
+        fn()
+    samples = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - t0) * 1000)
+    samples.sort()
+    return {
+        "median_ms": statistics.median(samples),
+        "p90_ms": samples[min(len(samples) - 1, int(round(0.9 * (len(samples) - 1))))],
+        "min_ms": samples[0],
+        "repeat": repeat,
+    }
+
+
+def run_micro(repeat: int) -> Dict[str, Dict[str, Any]]:
+    from app import postprocess
+
+    user_png = _fixture("step01.png", 1)
+    generated_png = _fixture("gemini-result.png", 2)
+    user_bgr = _decode(user_png)
+    gen_bgr = _decode(generated_png)
+    # Letterboxed copy: 8% black bars top and bottom
+    bar = gen_bgr.shape[0] * 8 // 100
+    boxed = cv2.copyMakeBorder(gen_bgr, bar, bar, 0, 0, cv2.BORDER_CONSTANT, value=(0, 0, 0))
+    gen_b64 = base64.b64encode(generated_png).decode("ascii")
+
+    results: Dict[str, Dict[str, Any]] = {
+        "auto_crop_letterbox": _time(lambda: postprocess.auto_crop_letterbox(boxed), repeat),
+        "auto_crop_letterbox_clean": _time(lambda: postprocess.auto_crop_letterbox(gen_bgr), repeat),
+        "preserve_face_with_poisson": _time(lambda: postprocess.preserve_face_with_poisson(user_bgr, gen_bgr), repeat),
+        "reject_if_collage": _time(lambda: postprocess.reject_if_collage(gen_bgr), repeat),
+        "postprocess_run_png": _time(lambda: postprocess.run(user_png, gen_b64, blend=True), repeat),
+        "postprocess_run_webp": _time(lambda: postprocess.run(user_png, gen_b64, blend=True, fmt="webp"), repeat),
+    }
+    results.update(_payload_micro(user_png, _fixture("shirt.png", 3), repeat))
+    results.update(_rembg_micro(user_png, repeat))
+    return results
+
+
+def _payload_micro(user_png: bytes, cloth_png: bytes, repeat: int) -> Dict[str, Dict[str, Any]]:
+    """Gemini request body (both images encoded) per upload codec, with its size."""
+    from app import gemini
+
+    saved = (gemini._image_format, gemini._image_max_dim)
+    results: Dict[str, Dict[str, Any]] = {}
+    try:
+        for fmt, max_dim in (("png", 0), ("webp", 0), ("jpeg", 0), ("webp", 1024)):
+            gemini._image_format, gemini._image_max_dim = fmt, max_dim
+            build = lambda: gemini.EncodedInputs(user_png, cloth_png).body("Plain White", False, None, "sep10")
+            name = f"gemini_body_{fmt}" + (f"_{max_dim}" if max_dim else "")
+            results[name] = {**_time(build, repeat), "body_kb": len(build()) / 1024.0}
+    finally:
+        gemini._image_format, gemini._image_max_dim = saved
+    return results
+
+
+def _rembg_micro(user_png: bytes, repeat: int) -> Dict[str, Dict[str, Any]]:
+    try:
+        from PIL import Image
+
+        from app import preprocess
+
+        preprocess.warmup()
+    except Exception as err:  # model unavailable offline
+        return {"rembg": {"skipped": f"{type(err).__name__}: {err}"}}
+    results: Dict[str, Dict[str, Any]] = {}
+    source = preprocess.decode_image(user_png)
+    for size in (512, 1024, 1536):
+        scale = size / float(max(source.size))
+        img = source.resize((max(1, int(source.width * scale)), max(1, int(source.height * scale))), Image.LANCZOS)
+        results[f"rembg_{size}"] = _time(lambda: preprocess.remove_background_png(img.copy()), max(1, repeat // 2))
+    return results
+
+
+def run_e2e(scale: float) -> Dict[str, Dict[str, Any]]:
+    from . import load_tryon
+
+    os.environ.setdefault("GEMINI_API_KEY", "bench")
+    os.environ.setdefault("RESULT_CACHE_MB", "0")
+    os.environ.setdefault("RESULT_CACHE_DISK_MB", "0")
+    stub = StubGemini(latency_s=0.5, image_png=_fixture("gemini-result.png", 2)).start()
+    os.environ["GEMINI_API_BASE"] = stub.base_url
+    port = load_tryon._free_port()
+    server, thread = load_tryon.start_app(port)
+    base = f"http://127.0.0.1:{port}"
+    user_pngs = [_fixture("step01.png", 1)] + [synthetic_png(768, 1024, seed=10 + i) for i in range(7)]
+    cloth_png = _fixture("shirt.png", 3)
+    results: Dict[str, Dict[str, Any]] = {}
+    try:
+        for name, (latency, error_rate, concurrency, per_client) in SCENARIOS.items():
+            stub.latency_s = latency
+            stub.error_rate = error_rate
+            upstream_before = stub.requests
+            r = load_tryon.run_level(
+                base, concurrency, max(concurrency, int(concurrency * per_client * scale)), user_pngs, cloth_png
+            )
+            r["upstream_requests"] = stub.requests - upstream_before
+            results[name] = r
+    finally:
+        server.should_exit = True
+        thread.join(timeout=10)
+        stub.stop()
+    return results
+
+
+def _meta(args: argparse.Namespace) -> Dict[str, Any]:
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, timeout=10
+        ).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        commit = None
+    return {
+        "commit": commit,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "quick": args.quick,
+    }
+
+
+def compare(
+    current: Dict[str, Dict[str, Any]], baseline: Dict[str, Dict[str, Any]],
+    default_threshold: float, thresholds: Dict[str, float],
+) -> List[str]:
+    """Human-readable regressions of ``current`` against ``baseline`` (empty when none)."""
+    failures = []
+    for name, base in baseline.items():
+        cur = current.get(name)
+        if cur is None or "skipped" in cur or "skipped" in base:
+            continue
+        limit = thresholds.get(name, default_threshold)
+        for key, slack in _COMPARED.items():
+            if key not in base or key not in cur or not base[key] or base[key] != base[key]:
+                continue
+            ratio = cur[key] / base[key]
+            marker = "REGRESSION" if ratio > 1 + limit and cur[key] - base[key] > slack else ""
+            print(f"  {name:<32} {key:<10} {base[key]:>10.2f} -> {cur[key]:>10.2f}  x{ratio:5.2f} {marker}")
+            if marker:
+                failures.append(f"{name} {key}: {base[key]:.2f} -> {cur[key]:.2f} (limit x{1 + limit:.2f})")
+        if cur.get("errors", 0) > base.get("errors", 0):
+            failures.append(f"{name} errors: {base.get('errors', 0)} -> {cur['errors']}")
+    return failures
+
+
+def _parse_thresholds(values: List[str]) -> Dict[str, float]:
+    out = {}
+    for item in values:
+        name, _, value = item.partition("=")
+        out[name.strip()] = float(value)
+    return out
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--out", help="write results JSON here")
+    parser.add_argument("--baseline", help="results JSON to compare against")
+    parser.add_argument("--only", choices=("micro", "e2e"), help="run one half of the suite")
+    parser.add_argument("--quick", action="store_true", help="fewer repetitions (smoke runs, CI)")
+    parser.add_argument("--repeat", type=int, default=15, help="microbenchmark repetitions")
+    parser.add_argument("--max-regression", type=float, default=0.25, help="allowed slowdown fraction")
+    parser.add_argument("--threshold", action="append", default=[], metavar="NAME=FRACTION",
+                        help="per-benchmark allowed slowdown, e.g. e2e_flaky_upstream=0.5")
+    args = parser.parse_args(argv)
+    logging.getLogger("app.gemini").setLevel(logging.ERROR)  # injected upstream errors are expected
+
+    results: Dict[str, Dict[str, Any]] = {}
+    if args.only in (None, "micro"):
+        results.update(run_micro(3 if args.quick else args.repeat))
+    if args.only in (None, "e2e"):
+        results.update(run_e2e(0.5 if args.quick else 1.0))
+
+    for name, r in results.items():
+        if "skipped" in r:
+            print(f"{name:<32} skipped ({r['skipped']})")
+        elif "median_ms" in r:
+            print(f"{name:<32} median {r['median_ms']:9.2f} ms  p90 {r['p90_ms']:9.2f} ms")
+        else:
+            print(f"{name:<32} p50 {r['p50_s']:6.2f} s  p99 {r['p99_s']:6.2f} s  {r['throughput_rps']:6.2f} rps  "
+                  f"errors {r['errors']}/{r['requests']}  upstream {r['upstream_requests']}")
+
+    if args.out:
+        with open(args.out, "w") as fh:
+            json.dump({"meta": _meta(args), "results": results}, fh, indent=2)
+
+    if not args.baseline:
+        return 0
+    with open(args.baseline) as fh:
+        baseline = json.load(fh)
+    print(f"\ncompared with {args.baseline} (commit {baseline.get('meta', {}).get('commit')}):")
+    failures = compare(results, baseline.get("results", {}), args.max_regression, _parse_thresholds(args.threshold))
+    if failures:
+        print("\nperformance regressions:\n  " + "\n  ".join(failures))
+        return 1
+    print("\nno regressions")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
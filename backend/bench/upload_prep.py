@@ -0,0 +1,93 @@
+"""Upload bytes and server CPU with and without client-side preparation.
+
+Simulates what the browser sends for each fixture: a camera-sized JPEG
+(``--camera-dim`` on the longest side, as phones upload them) versus the same photo
+resized to ``/api/upload-config``'s target the way ``frontend/src/lib/image.ts``
+does it. The server-side cost reported is decode to MAX_DIM, and the cut-out PNG
+from a client-supplied mask versus from rembg (when the model file is present).
+
+    cd backend && python -m bench.upload_prep --repeat 5
+"""
+import argparse
+import io
+import json
+import os
+from typing import Any, Dict
+
+import numpy as np
+from PIL import Image
+
+from .suite import _fixture, _time
+
+FIXTURES = ["step01.png", "face01.png", "founder-photo.png", "shirt.png"]
+
+
+def _jpeg(img: Image.Image, max_side: int, quality: int) -> bytes:
+    w, h = img.size
+    scale = max_side / float(max(w, h))
+    out = img.convert("RGB").resize((max(1, round(w * scale)), max(1, round(h * scale))), Image.LANCZOS)
+    buf = io.BytesIO()
+    out.save(buf, format="JPEG", quality=quality)
+    return buf.getvalue()
+
+
+def _ellipse_mask(size: Any) -> bytes:
+    """A plausible person-shaped mask at reduced size, as a local segmenter would send it."""
+    w, h = size[0] // 4, size[1] // 4
+    yy, xx = np.mgrid[:h, :w]
+    inside = ((xx - w / 2.0) / (w * 0.35)) ** 2 + ((yy - h / 2.0) / (h * 0.45)) ** 2 <= 1.0
+    buf = io.BytesIO()
+    Image.fromarray((inside * 255).astype(np.uint8), "L").save(buf, format="PNG")
+    return buf.getvalue()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--camera-dim", type=int, default=4032, help="longest side of a raw phone photo")
+    parser.add_argument("--json", help="write results to this file")
+    args = parser.parse_args()
+
+    from app import preprocess, sessions
+
+    target = preprocess.upload_target()
+    quality = int(round(target["quality"] * 100))
+    # remove_background_png raises without a model file: only time it with one
+    rembg_ok = os.path.exists(sessions.load_path(sessions.model_for("user")))
+    if not rembg_ok:
+        print(f"{sessions.load_path(sessions.model_for('user'))} missing, skipping the server cut-out")
+    results: Dict[str, Dict[str, Any]] = {}
+    for name in FIXTURES:
+        src = Image.open(io.BytesIO(_fixture(name, fallback_seed=len(name))))
+        src.load()
+        raw = _jpeg(src, args.camera_dim, 92)
+        prepared = _jpeg(src, target["max_dim"], quality)
+        mask = _ellipse_mask(preprocess.decode_image(prepared).size)
+        r: Dict[str, Any] = {
+            "raw_kb": len(raw) / 1024.0,
+            "prepared_kb": len(prepared) / 1024.0,
+            "mask_kb": len(mask) / 1024.0,
+            "decode_raw_ms": _time(lambda: preprocess.decode_image(raw), args.repeat)["median_ms"],
+            "decode_prepared_ms": _time(lambda: preprocess.decode_image(prepared), args.repeat)["median_ms"],
+            "client_mask_ms": _time(lambda: preprocess.apply_mask_png(prepared, mask), args.repeat)["median_ms"],
+        }
+        if rembg_ok:
+            r["rembg_ms"] = _time(
+                lambda: preprocess.remove_background_png(preprocess.decode_image(prepared), "user"), args.repeat
+            )["median_ms"]
+        results[name] = r
+
+    print(f"target: {target['max_dim']} px {target['format']} q{quality}; raw: {args.camera_dim} px JPEG q92")
+    print(f"{'fixture':<20} {'raw KB':>8} {'prep KB':>8} {'mask KB':>8} {'dec raw ms':>11} {'dec prep ms':>12} "
+          f"{'mask ms':>8} {'rembg ms':>9}")
+    for name, r in results.items():
+        rembg = f"{r['rembg_ms']:>9.1f}" if "rembg_ms" in r else f"{'-':>9}"
+        print(f"{name:<20} {r['raw_kb']:>8.0f} {r['prepared_kb']:>8.0f} {r['mask_kb']:>8.1f} {r['decode_raw_ms']:>11.1f} "
+              f"{r['decode_prepared_ms']:>12.1f} {r['client_mask_ms']:>8.1f} {rembg}")
+    if args.json:
+        with open(args.json, "w") as fh:
+            json.dump({"target": target, "camera_dim": args.camera_dim, "fixtures": results}, fh, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""Gemini upstream protection under a 429 storm (see app.upstream).
+
+Drives ``generate_tryon_image_async`` directly against the stub in three phases:
+healthy, a storm where every call gets 429 with Retry-After, and recovery. For
+each phase it prints client outcomes, how many requests actually reached the
+upstream, and the limiter/breaker state at the end. With protection on, the storm
+phase should show far fewer upstream requests than client calls, with failures
+returned in milliseconds instead of after the full retry chain.
+
+    cd backend && python -m bench.upstream_storm --concurrency 16 --phase-seconds 10
+    # compare with protection effectively off
+    cd backend && GEMINI_BREAKER_THRESHOLD=1000 GEMINI_AIMD_INITIAL=1024 GEMINI_AIMD_MIN=1024 \\
+        python -m bench.upstream_storm
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import statistics
+import time
+from typing import Any, Dict, List
+
+from .stub_gemini import StubGemini, synthetic_png
+
+
+async def _phase(name: str, seconds: float, concurrency: int, stub: StubGemini) -> Dict[str, Any]:
+    from app import gemini, upstream
+
+    user_png = synthetic_png(256, 256, seed=1)
+    clothing_png = synthetic_png(256, 256, seed=2)
+    upstream_before = stub.requests
+    outcomes: Dict[str, int] = {}
+    latencies: Dict[str, List[float]] = {}
+    stop_at = time.monotonic() + seconds
+
+    async def client() -> None:
+        while time.monotonic() < stop_at:
+            started = time.monotonic()
+            try:
+                await gemini.generate_tryon_image_async(user_png, clothing_png, "white", api_key="bench")
+                kind = "ok"
+            except upstream.UpstreamUnavailable:
+                kind = "unavailable"
+            except upstream.UpstreamBusy:
+                kind = "busy"
+            except RuntimeError:
+                kind = "error"
+            outcomes[kind] = outcomes.get(kind, 0) + 1
+            latencies.setdefault(kind, []).append(time.monotonic() - started)
+            if kind != "ok":
+                # A real client would not hammer a failing endpoint in a tight loop
+                await asyncio.sleep(0.05)
+
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    return {
+        "phase": name,
+        "client_calls": sum(outcomes.values()),
+        "outcomes": outcomes,
+        "p50_ms": {k: round(statistics.median(v) * 1000, 1) for k, v in latencies.items()},
+        "upstream_requests": stub.requests - upstream_before,
+        "upstream": upstream.stats(),
+    }
+
+
+async def _run(args: argparse.Namespace, stub: StubGemini) -> List[Dict[str, Any]]:
+    results = []
+    stub.error_rate = 0.0
+    results.append(await _phase("healthy", args.phase_seconds, args.concurrency, stub))
+    stub.error_rate = 1.0
+    results.append(await _phase("storm", args.phase_seconds, args.concurrency, stub))
+    stub.error_rate = 0.0
+    results.append(await _phase("recovery", args.phase_seconds * 2, args.concurrency, stub))
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--phase-seconds", type=float, default=10.0)
+    parser.add_argument("--latency", type=float, default=0.2, help="stub latency in seconds")
+    parser.add_argument("--retry-after", type=float, default=2.0, help="Retry-After sent with each 429")
+    parser.add_argument("--json", help="write results to this file")
+    args = parser.parse_args()
+    logging.getLogger("app.gemini").setLevel(logging.CRITICAL)  # one line per injected 429 otherwise
+
+    with StubGemini(latency_s=args.latency, jitter_s=args.latency / 4, error_status=429,
+                    retry_after=args.retry_after) as stub:
+        os.environ["GEMINI_API_BASE"] = stub.base_url
+        # Short cooldowns so the recovery phase fits in a benchmark run
+        os.environ.setdefault("GEMINI_BREAKER_COOLDOWN", "3")
+        os.environ.setdefault("GEMINI_BACKOFF_BASE", "0.1")
+        results = asyncio.run(_run(args, stub))
+
+    print(f"{'phase':<10} {'calls':>6} {'ok':>6} {'failed':>7} {'upstream':>9} {'p50 ok ms':>10} {'p50 fail ms':>12} {'limit':>6}")
+    for r in results:
+        failed = r["client_calls"] - r["outcomes"].get("ok", 0)
+        fail_p50 = max((v for k, v in r["p50_ms"].items() if k != "ok"), default=float("nan"))
+        print(
+            f"{r['phase']:<10} {r['client_calls']:>6} {r['outcomes'].get('ok', 0):>6} {failed:>7} "
+            f"{r['upstream_requests']:>9} {r['p50_ms'].get('ok', float('nan')):>10} {fail_p50:>12} "
+            f"{r['upstream']['limiter']['limit']:>6}"
+        )
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+import gzip
+
+import pytest
+from starlette.responses import FileResponse
+
+from app import assets
+from app.assets import IMMUTABLE, AssetFiles
+
+BUNDLE = "assets/index-Ab12Cd34.js"
+JS = b"console.log('try-on');\n" * 200
+
+
+@pytest.fixture
+def static(tmp_path):
+    (tmp_path / "assets").mkdir()
+    (tmp_path / "index.html").write_bytes(b"<!doctype html><div id=root></div>" * 40)
+    (tmp_path / BUNDLE).write_bytes(JS)
+    (tmp_path / "logo.png").write_bytes(b"\x89PNG\r\n\x1a\n" + bytes(64))
+    totals = assets.precompress(str(tmp_path))
+    assert totals["files"] == 2  # the PNG is not compressible, nothing else is too small
+    # Stands in for a brotli variant whether or not the package is installed
+    (tmp_path / (BUNDLE + ".br")).write_bytes(b"br-bytes")
+    return AssetFiles(str(tmp_path))
+
+
+def test_cache_control():
+    assert assets.cache_control("index.html") == "no-cache"
+    assert assets.cache_control(BUNDLE) == IMMUTABLE
+    assert assets.cache_control("assets/logo.svg").startswith("public, max-age=")
+    assert assets.cache_control("logo.png") == f"public, max-age={assets.max_age}"
+
+
+@pytest.mark.parametrize("accept, coding", [
+    ("", None),
+    ("gzip, deflate", "gzip"),
+    ("gzip, br", "br"),
+    ("br;q=0, gzip", "gzip"),
+    ("gzip;q=0", None),
+    ("*", "br"),
+    ("identity", None),
+])
+def test_negotiate(accept, coding):
+    assert assets.negotiate(accept, {"br": "x.br", "gzip": "x.gz"}) == coding
+
+
+def test_serves_the_negotiated_variant(static):
+    plain = static.response(BUNDLE, {})
+    gz = static.response(BUNDLE, {"accept-encoding": "gzip"})
+    br = static.response(BUNDLE, {"accept-encoding": "gzip, br"})
+    assert isinstance(plain, FileResponse) and plain.path.endswith(".js")
+    assert gz.path.endswith(".js.gz") and gz.headers["content-encoding"] == "gzip"
+    assert br.path.endswith(".js.br") and br.headers["content-encoding"] == "br"
+    for resp in (plain, gz, br):
+        assert resp.headers["cache-control"] == IMMUTABLE
+        assert resp.headers["vary"] == "Accept-Encoding"
+        assert resp.media_type == "text/javascript"
+    # Each representation has its own strong ETag
+    assert len({plain.headers["etag"], gz.headers["etag"], br.headers["etag"]}) == 3
+
+
+def test_if_none_match_answers_304(static):
+    etag = static.response(BUNDLE, {"accept-encoding": "gzip"}).headers["etag"]
+    for header in (etag, f"W/{etag}", f'"other", {etag}', "*"):
+        resp = static.response(BUNDLE, {"accept-encoding": "gzip", "if-none-match": header})
+        assert resp.status_code == 304
+        assert resp.body == b""
+        assert resp.headers["etag"] == etag
+    # The identity representation does not match the gzip ETag
+    assert static.response(BUNDLE, {"if-none-match": etag}).status_code == 200
+
+
+def test_index_is_held_in_memory_and_revalidated(static):
+    resp = static.response("index.html", {"accept-encoding": "gzip"})
+    assert resp.status_code == 200
+    assert resp.headers["cache-control"] == "no-cache"
+    assert gzip.decompress(resp.body).startswith(b"<!doctype html>")
+
+
+def test_uncompressed_file_and_missing_file(static):
+    logo = static.response("logo.png", {"accept-encoding": "gzip, br"})
+    assert "content-encoding" not in logo.headers
+    assert "vary" not in logo.headers
+    assert static.response("nope.js", {}).status_code == 404
+    assert static.response("../app/main.py", {}).status_code == 404
@@ -0,0 +1,79 @@
+import os
+
+from app import cache
+from app.cache import ByteCache, content_key
+
+
+def test_content_key_covers_params():
+    assert content_key(b"x", "u2net", 1536) == content_key(b"x", "u2net", 1536)
+    assert content_key(b"x", "u2net", 1536) != content_key(b"x", "u2net", 1024)
+    assert content_key(b"x", "ab") != content_key(b"x", "a", "b")
+
+
+def test_lru_evicts_least_recently_used():
+    c = ByteCache("test-lru", max_bytes=30)
+    c.put("a", b"a" * 10)
+    c.put("b", b"b" * 10)
+    c.put("c", b"c" * 10)
+    assert c.get("a") is not None  # a is now the most recent
+    c.put("d", b"d" * 10)
+    assert c.get("b") is None
+    assert c.get("a") == b"a" * 10
+    stats = c.stats()
+    assert stats["evictions"] == 1
+    assert stats["bytes"] == 30
+
+
+def test_oversized_value_is_not_cached():
+    c = ByteCache("test-oversized", max_bytes=10)
+    c.put("big", b"x" * 11)
+    assert c.get("big") is None
+    assert c.stats()["bytes"] == 0
+
+
+def test_replacing_a_key_keeps_the_byte_count():
+    c = ByteCache("test-replace", max_bytes=100)
+    c.put("k", b"x" * 40)
+    c.put("k", b"y" * 10)
+    assert c.get("k") == b"y" * 10
+    assert c.stats()["bytes"] == 10
+
+
+def test_memory_ttl(monkeypatch, clock):
+    monkeypatch.setattr(cache, "time", clock)
+    c = ByteCache("test-ttl", max_bytes=100, ttl=60)
+    c.put("k", b"v")
+    clock.advance(59)
+    assert c.get("k") == b"v"
+    clock.advance(2)
+    assert c.get("k") is None
+    stats = c.stats()
+    assert stats["expired"] == 1
+    assert stats["entries"] == 0
+    assert stats["bytes"] == 0
+
+
+def test_disk_tier_survives_a_new_instance(tmp_path):
+    ByteCache("test-disk", max_bytes=100, disk_dir=str(tmp_path), disk_max_bytes=1000).put("k", b"v")
+    c = ByteCache("test-disk", max_bytes=100, disk_dir=str(tmp_path), disk_max_bytes=1000)
+    assert c.get("k") == b"v"
+    assert c.stats()["disk_hits"] == 1
+
+
+def test_disk_ttl(monkeypatch, clock, tmp_path):
+    monkeypatch.setattr(cache, "time", clock)
+    ByteCache("test-disk-ttl", max_bytes=100, disk_dir=str(tmp_path), disk_max_bytes=1000, ttl=60).put("k", b"v")
+    c = ByteCache("test-disk-ttl", max_bytes=100, disk_dir=str(tmp_path), disk_max_bytes=1000, ttl=60)
+    clock.advance(61)
+    assert c.get("k") is None
+    # The expired file is removed on the lookup
+    assert not os.path.exists(tmp_path / "k.bin")
+
+
+def test_disk_eviction_keeps_the_budget(tmp_path):
+    c = ByteCache("test-disk-evict", max_bytes=1000, disk_dir=str(tmp_path), disk_max_bytes=100)
+    for i in range(5):
+        c.put(f"k{i}", bytes(40))
+    total = sum(p.stat().st_size for p in tmp_path.glob("*.bin"))
+    assert total <= 100
+    assert c.stats()["disk_evictions"] > 0
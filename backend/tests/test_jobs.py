@@ -0,0 +1,83 @@
+import asyncio
+
+import pytest
+
+from app import jobs
+
+
+def _resolve(url):
+    return asyncio.run(jobs.resolve_webhook_url(url))
+
+
+@pytest.mark.parametrize("url", [
+    "ftp://example.com/hook",
+    "/relative/hook",
+    "http:///no-host",
+    "javascript:alert(1)",
+])
+def test_rejects_non_http_urls(url):
+    with pytest.raises(ValueError, match="absolute http"):
+        _resolve(url)
+
+
+@pytest.mark.parametrize("url", [
+    "http://127.0.0.1/hook",
+    "http://localhost:8000/hook",
+    "http://10.0.0.5/hook",
+    "http://192.168.1.1/hook",
+    "http://172.16.0.1/hook",
+    "http://169.254.169.254/latest/meta-data",
+    "http://100.64.0.1/hook",
+    "http://0.0.0.0/hook",
+    "http://[::1]/hook",
+    "http://[fd00::1]/hook",
+    "http://[fe80::1]/hook",
+    "http://[::ffff:127.0.0.1]/hook",
+    "http://224.0.0.1/hook",
+])
+def test_rejects_private_and_reserved_addresses(url):
+    with pytest.raises(ValueError, match="private or reserved"):
+        _resolve(url)
+
+
+def test_rejects_a_name_with_any_private_answer(monkeypatch):
+    async def getaddrinfo(host, port, **kwargs):
+        return [(2, 1, 6, "", ("93.184.216.34", port)), (2, 1, 6, "", ("10.0.0.1", port))]
+
+    loop = asyncio.new_event_loop()
+    monkeypatch.setattr(loop, "getaddrinfo", getaddrinfo)
+    try:
+        with pytest.raises(ValueError, match="private or reserved"):
+            loop.run_until_complete(jobs.resolve_webhook_url("https://hooks.example.com/x"))
+    finally:
+        loop.close()
+
+
+def test_unresolvable_host(monkeypatch):
+    async def getaddrinfo(host, port, **kwargs):
+        raise OSError("no such host")
+
+    loop = asyncio.new_event_loop()
+    monkeypatch.setattr(loop, "getaddrinfo", getaddrinfo)
+    try:
+        with pytest.raises(ValueError, match="does not resolve"):
+            loop.run_until_complete(jobs.resolve_webhook_url("https://nowhere.invalid/x"))
+    finally:
+        loop.close()
+
+
+def test_public_address_is_pinned():
+    url, address = _resolve("https://93.184.216.34:8443/hook")
+    assert address == "93.184.216.34"
+    pinned, headers, extensions = jobs._pinned_request("https://hooks.example.com:8443/hook?a=1", address)
+    assert pinned == "https://93.184.216.34:8443/hook?a=1"
+    assert headers == {"Host": "hooks.example.com:8443"}
+    assert extensions == {"sni_hostname": "hooks.example.com"}
+
+
+def test_allowlist(monkeypatch):
+    monkeypatch.setattr(jobs, "_webhook_hosts", {"internal.example"})
+    # Listed hosts may be private and are connected to by name
+    assert _resolve("http://Internal.example/hook") == ("http://Internal.example/hook", None)
+    with pytest.raises(ValueError, match="not allowed"):
+        _resolve("https://93.184.216.34/hook")
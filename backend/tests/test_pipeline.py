@@ -0,0 +1,235 @@
+import asyncio
+import base64
+import io
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from app import pipeline, upstream
+from app.cache import ByteCache
+from app.gemini import DEFAULT_MODEL
+
+
+def _png(seed: int = 0, size=(96, 64)) -> bytes:
+    rng = np.random.default_rng(seed)
+    buf = io.BytesIO()
+    Image.fromarray(rng.integers(40, 220, (size[1], size[0], 3), dtype=np.uint8), "RGB").save(buf, format="PNG")
+    return buf.getvalue()
+
+
+USER = _png(1)
+CLOTHING = _png(2)
+GENERATED = base64.b64encode(_png(3)).decode("ascii")
+
+
+class StubGemini:
+    """Replaces ``generate_tryon_image_async``: counts calls, optionally holds them until
+    released. ``delays`` makes call i take ``delays[i]`` seconds.
+    """
+
+    def __init__(self) -> None:
+        self.calls = 0
+        self.models = []
+        self.delays = []
+        self.cancelled = []
+        self.started = asyncio.Event()
+        self.release = asyncio.Event()
+        self.release.set()
+        self.error = None
+
+    async def __call__(self, *args, model=None, **kwargs) -> str:
+        call = self.calls
+        self.calls += 1
+        self.models.append(model)
+        self.started.set()
+        try:
+            await self.release.wait()
+            if call < len(self.delays):
+                await asyncio.sleep(self.delays[call])
+        except asyncio.CancelledError:
+            self.cancelled.append(call)
+            raise
+        if self.error is not None:
+            raise self.error
+        return GENERATED
+
+
+@pytest.fixture
+def stub(monkeypatch):
+    monkeypatch.setattr(pipeline, "result_cache", ByteCache("test-results", 1 << 24, ttl=60))
+    monkeypatch.setattr(pipeline, "_result_cache_enabled", True)
+    monkeypatch.setattr(pipeline, "_inflight", {})
+    monkeypatch.setattr(pipeline, "_max_attempts", 1)
+    monkeypatch.setattr(upstream, "hedge_enabled", False)
+    gemini = StubGemini()
+    monkeypatch.setattr(pipeline, "generate_tryon_image_async", gemini)
+    return gemini
+
+
+def _generate(**kwargs):
+    return pipeline.generate_variants(USER, CLOTHING, "Plain White", 1, **kwargs)
+
+
+def test_identical_concurrent_requests_share_one_call(stub):
+    joined = pipeline._coalesced["joined"]
+
+    async def run():
+        stub.release = asyncio.Event()
+        tasks = [asyncio.ensure_future(_generate()) for _ in range(5)]
+        await stub.started.wait()
+        await asyncio.sleep(0.01)
+        stub.release.set()
+        results = await asyncio.gather(*tasks)
+        # Completed sets are served from the cache afterwards
+        results.append(await _generate())
+        return results
+
+    results = asyncio.run(run())
+    assert stub.calls == 1
+    assert pipeline._coalesced["joined"] - joined == 4
+    assert all(images == results[0][0] and len(images) == 1 for images, _ in results)
+    assert pipeline.result_cache.stats()["entries"] == 1
+
+
+def test_cancelled_leader_does_not_fail_followers(stub):
+    joined = pipeline._coalesced["joined"]
+
+    async def run():
+        stub.release = asyncio.Event()
+        leader = asyncio.ensure_future(_generate())
+        await stub.started.wait()
+        follower = asyncio.ensure_future(_generate())
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        await asyncio.sleep(0.01)
+        stub.release.set()
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        return await follower
+
+    images, timed_out = asyncio.run(run())
+    assert len(images) == 1 and not timed_out
+    assert pipeline._coalesced["joined"] - joined == 1
+    # The follower generated on its own once the leader was gone
+    assert stub.calls == 2
+
+
+def test_errors_are_not_cached(stub):
+    stub.error = RuntimeError("Gemini API error: 500")
+    assert asyncio.run(_generate()) == ([], False)
+    assert pipeline.result_cache.stats()["entries"] == 0
+    stub.error = None
+    images, _ = asyncio.run(_generate())
+    assert len(images) == 1
+    assert stub.calls == 2
+
+
+def test_use_cache_false_always_generates(stub):
+    asyncio.run(_generate())
+    asyncio.run(_generate(use_cache=False))
+    assert stub.calls == 2
+
+
+def _key(**overrides):
+    args = dict(
+        user_png=USER, clothing_png=CLOTHING, background="Plain White", count=1, fmt="webp", quality=80,
+        blend_mode=None,
+    )
+    args.update(overrides)
+    return pipeline.result_key(**args)
+
+
+@pytest.mark.parametrize("change", [
+    {"fmt": "jpeg"},
+    {"quality": 81},
+    {"blend_mode": "feather"},
+    {"background": "Studio"},
+    {"count": 2},
+    {"user_png": _png(4)},
+    {"clothing_png": _png(5)},
+])
+def test_result_key_covers_every_output_parameter(change):
+    assert _key(**change) != _key()
+
+
+def test_result_key_ignores_quality_for_png_and_garment_encoding():
+    assert _key(fmt="png", quality=10) == _key(fmt="png", quality=90)
+    # A registered garment (base64) and its bytes are the same input
+    assert _key(clothing_png=base64.b64encode(CLOTHING).decode("ascii")) == _key()
+
+
+@pytest.fixture
+def hedging(monkeypatch, stub):
+    """Hedging on with a 50 ms delay (no latency samples yet) and an idle limiter."""
+    monkeypatch.setattr(upstream, "hedge_enabled", True)
+    monkeypatch.setattr(upstream, "hedge_budget", 1)
+    monkeypatch.setattr(upstream, "hedge_model", None)
+    monkeypatch.setattr(upstream, "_hedge_delay", 0.05)
+    monkeypatch.setattr(upstream, "_hedge_min_delay", 0.0)
+    monkeypatch.setattr(upstream, "latencies", upstream.LatencyWindow(min_samples=3))
+    monkeypatch.setattr(upstream, "limiter", upstream.AIMDLimiter(initial=8, min_limit=1, max_limit=8))
+    return stub
+
+
+def test_hedge_delay(monkeypatch, hedging):
+    assert upstream.hedge_delay() == 0.05
+    for seconds in (1.0, 2.0, 3.0):
+        upstream.latencies.observe(seconds)
+    assert upstream.hedge_delay() == 3.0
+    monkeypatch.setattr(upstream, "_hedge_min_delay", 5.0)
+    assert upstream.hedge_delay() == 5.0
+    monkeypatch.setattr(upstream, "hedge_budget", 0)
+    assert upstream.hedge_delay() is None
+    monkeypatch.setattr(upstream, "hedge_budget", 1)
+    monkeypatch.setattr(upstream, "hedge_enabled", False)
+    assert upstream.hedge_delay() is None
+
+
+def test_no_hedge_without_a_free_limiter_slot(hedging):
+    asyncio.run(upstream.limiter.acquire())
+    upstream.limiter.limit = 1
+    assert not upstream.can_hedge()
+
+
+def test_slow_attempt_is_hedged_and_the_loser_cancelled(hedging):
+    hedging.delays = [5.0, 0.0]
+    images, _ = asyncio.run(_generate(use_cache=False))
+    assert len(images) == 1
+    assert hedging.calls == 2
+    assert hedging.cancelled == [0]
+
+
+def test_original_wins_and_the_hedge_is_cancelled(hedging):
+    hedging.delays = [0.2, 5.0]
+    images, _ = asyncio.run(_generate(use_cache=False))
+    assert len(images) == 1
+    assert hedging.calls == 2
+    assert hedging.cancelled == [1]
+
+
+def test_fast_attempt_is_not_hedged(hedging):
+    asyncio.run(_generate(use_cache=False))
+    assert hedging.calls == 1
+
+
+def test_budget_caps_hedges_per_request(monkeypatch, hedging):
+    monkeypatch.setattr(pipeline, "_max_variants", 3)
+    hedging.delays = [0.3] * 10
+    images, _ = asyncio.run(pipeline.generate_variants(USER, CLOTHING, "Plain White", 3, use_cache=False))
+    assert len(images) == 3
+    # Three variants, one duplicate between them
+    assert hedging.calls == 4
+
+
+def test_single_candidate_hedges_onto_the_same_model(hedging):
+    hedging.delays = [5.0, 0.0]
+    asyncio.run(_generate(use_cache=False))
+    assert hedging.models == [DEFAULT_MODEL, DEFAULT_MODEL]
+
+
+def test_hedge_model(monkeypatch, hedging):
+    monkeypatch.setattr(upstream, "hedge_model", "other-image-model")
+    hedging.delays = [5.0, 0.0]
+    asyncio.run(_generate(use_cache=False))
+    assert hedging.models == [DEFAULT_MODEL, "other-image-model"]
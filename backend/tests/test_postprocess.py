@@ -0,0 +1,110 @@
+import base64
+
+import cv2
+import numpy as np
+import pytest
+
+from app import metrics, postprocess
+from bench.letterbox import _frame, legacy_letterbox_box
+
+
+def _b64(bgr: np.ndarray) -> str:
+    ok, buf = cv2.imencode(".png", bgr)
+    assert ok
+    return base64.b64encode(buf.tobytes()).decode("ascii")
+
+
+def _decode(img_b64: str) -> np.ndarray:
+    return cv2.imdecode(np.frombuffer(base64.b64decode(img_b64), np.uint8), cv2.IMREAD_COLOR)
+
+
+@pytest.fixture
+def no_faces(monkeypatch):
+    monkeypatch.setattr(postprocess, "detect_faces", lambda bgr, min_size=50: [])
+
+
+def test_letterbox_matches_the_legacy_loop_on_black_bars():
+    rng = np.random.default_rng(0)
+    for _ in range(200):
+        long_side = int(rng.integers(40, 900))
+        bars = tuple(int(b) for b in rng.integers(0, max(2, long_side // 4), size=4) * (rng.random(4) < 0.5))
+        img = _frame(long_side, rng, bars=bars, speckle=float(rng.choice([0.0, 0.01, 0.03])))
+        assert postprocess.letterbox_box(img) == legacy_letterbox_box(img)
+
+
+@pytest.mark.parametrize("color", [(0, 0, 0), (250, 250, 250), (120, 128, 10)])
+def test_letterbox_crops_solid_bars(color):
+    img = _frame(400, np.random.default_rng(1), bars=(30, 30, 0, 0), color=color)
+    assert postprocess.letterbox_box(img) == (0, 400, 30, 300 - 30)
+
+
+def test_letterbox_leaves_plain_frames_and_caps_wide_bars():
+    rng = np.random.default_rng(2)
+    plain = _frame(400, rng)
+    assert postprocess.letterbox_box(plain) is None
+    assert postprocess.auto_crop_letterbox(plain) is plain
+    # At most 20% of the width is cropped per edge
+    assert postprocess.letterbox_box(_frame(400, rng, bars=(90, 0, 0, 0))) == (0, 400, 60, 300)
+
+
+@pytest.mark.parametrize("faces, rejected", [
+    ([], False),
+    ([(100, 60, 80, 80)], False),
+    ([(100, 60, 80, 80), (40, 300, 60, 60)], True),  # an extra face
+    ([(100, 330, 60, 60)], True),  # a face low in the frame, e.g. printed on clothing
+    ([(140, 60, 10, 10)], True),  # implausibly small
+])
+def test_is_collage(faces, rejected):
+    assert postprocess.is_collage(faces, (400, 300)) is rejected
+
+
+def test_run_rejects_collages(monkeypatch):
+    monkeypatch.setattr(postprocess, "detect_faces", lambda bgr, min_size=50: [(100, 60, 80, 80), (40, 300, 60, 60)])
+    before = metrics.collage_rejections.value()
+    result = postprocess.run(b"", _b64(_frame(400, np.random.default_rng(3))), blend=False)
+    assert result.image_b64 is None
+    assert metrics.collage_rejections.value() == before + 1
+
+
+def test_run_returns_unchanged_png_untouched(no_faces):
+    img_b64 = _b64(_frame(400, np.random.default_rng(4)))
+    result = postprocess.run(b"", img_b64, blend=False)
+    assert result.image_b64 is img_b64
+    assert result.fmt == "png"
+    assert {"decode", "detect", "crop"} <= set(result.timings)
+
+
+def test_run_crops_letterbox_once(no_faces):
+    img = _frame(400, np.random.default_rng(5), bars=(30, 30, 0, 0))
+    result = postprocess.run(b"", _b64(img), blend=False)
+    out = _decode(result.image_b64)
+    assert out.shape == (400, 240, 3)
+    assert np.array_equal(out, img[:, 30:270])
+
+
+@pytest.mark.parametrize("fmt, magic", [("webp", b"RIFF"), ("jpeg", b"\xff\xd8\xff")])
+def test_run_encodes_the_requested_format(no_faces, fmt, magic):
+    result = postprocess.run(b"", _b64(_frame(400, np.random.default_rng(6))), blend=False, fmt=fmt)
+    assert result.fmt == fmt
+    assert base64.b64decode(result.image_b64).startswith(magic)
+
+
+def test_run_applies_quality(no_faces):
+    img_b64 = _b64(_frame(400, np.random.default_rng(7)))
+    low = postprocess.run(b"", img_b64, blend=False, fmt="jpeg", quality=20).image_b64
+    high = postprocess.run(b"", img_b64, blend=False, fmt="jpeg", quality=95).image_b64
+    assert len(base64.b64decode(low)) < len(base64.b64decode(high))
+
+
+def test_run_falls_back_to_png_when_encoding_fails(monkeypatch, no_faces):
+    monkeypatch.setattr(postprocess, "encode_image", lambda *args, **kwargs: None)
+    img_b64 = _b64(_frame(400, np.random.default_rng(8)))
+    result = postprocess.run(b"", img_b64, blend=False, fmt="webp")
+    assert (result.image_b64, result.fmt) == (img_b64, "png")
+    assert postprocess.transcode(img_b64, "webp") == (img_b64, "png")
+
+
+def test_run_passes_undecodable_output_through():
+    result = postprocess.run(b"", base64.b64encode(b"not an image").decode("ascii"), blend=False, fmt="webp")
+    assert result.fmt == "png"
+    assert base64.b64decode(result.image_b64) == b"not an image"
@@ -0,0 +1,94 @@
+import asyncio
+import io
+
+import pytest
+from PIL import Image
+
+from app import preprocess
+from app.cache import ByteCache
+
+
+def _png(size=(64, 48), mode="RGB", color=(200, 120, 40)) -> bytes:
+    buf = io.BytesIO()
+    Image.new(mode, size, color).save(buf, format="PNG")
+    return buf.getvalue()
+
+
+@pytest.fixture
+def cutout_cache(monkeypatch):
+    c = ByteCache("test-cutout", max_bytes=1 << 20)
+    monkeypatch.setattr(preprocess, "cutout_cache", c)
+    return c
+
+
+def test_cutout_is_cached(monkeypatch, cutout_cache):
+    calls = []
+
+    def fake_remove(img, role="user"):
+        calls.append(role)
+        return _png(img.size, "RGBA", (1, 2, 3, 0))
+
+    monkeypatch.setattr(preprocess, "remove_background_png", fake_remove)
+    raw = _png()
+    first = asyncio.run(preprocess.cutout_png(raw, "user"))
+    assert asyncio.run(preprocess.cutout_png(raw, "user")) == first
+    assert calls == ["user"]
+
+
+def test_failed_cutout_is_not_cached(monkeypatch, cutout_cache):
+    def failing_remove(img, role="user"):
+        raise preprocess.CutoutFailed(b"uncut", RuntimeError("onnx"))
+
+    monkeypatch.setattr(preprocess, "remove_background_png", failing_remove)
+    raw = _png()
+    assert asyncio.run(preprocess.cutout_png(raw, "user")) == b"uncut"
+    assert cutout_cache.get(preprocess.cutout_key(raw, "user")) is None
+    # Callers that persist the result get the error instead
+    with pytest.raises(preprocess.CutoutFailed):
+        preprocess.cutout_png_sync(raw, "garment")
+
+
+def _mask(size, box=None, mode="L") -> bytes:
+    """A mask with the foreground (255) inside ``box``, or everywhere without one."""
+    img = Image.new("L", size, 0 if box else 255)
+    if box:
+        img.paste(255, box)
+    if mode != "L":
+        rgba = Image.new("RGBA", size, (10, 20, 30, 255))
+        rgba.putalpha(img)
+        img = rgba
+    buf = io.BytesIO()
+    img.save(buf, format="PNG")
+    return buf.getvalue()
+
+
+def test_mask_is_scaled_to_the_image():
+    mask = Image.new("L", (32, 24), 0)
+    mask.paste(255, (8, 6, 24, 18))
+    alpha = preprocess._check_mask(mask, (64, 48))
+    assert alpha.size == (64, 48)
+
+
+def test_mask_with_another_aspect_ratio_is_rejected():
+    with pytest.raises(preprocess.MaskError, match="aspect ratio"):
+        preprocess._check_mask(Image.new("L", (32, 32), 255), (64, 48))
+
+
+@pytest.mark.parametrize("fill", [0, 255])
+def test_empty_or_full_mask_is_rejected(fill):
+    with pytest.raises(preprocess.MaskError, match="foreground covers"):
+        preprocess._check_mask(Image.new("L", (64, 48), fill), (64, 48))
+
+
+def test_undecodable_mask_is_rejected():
+    with pytest.raises(preprocess.MaskError, match="not a decodable image"):
+        preprocess.apply_mask_png(_png(), b"not a png")
+
+
+@pytest.mark.parametrize("mode", ["L", "RGBA"])
+def test_apply_mask_cuts_out_the_foreground(mode):
+    out = Image.open(io.BytesIO(preprocess.apply_mask_png(_png((64, 48)), _mask((32, 24), (8, 6, 24, 18), mode))))
+    assert out.mode == "RGBA"
+    assert out.size == (64, 48)
+    assert out.getpixel((32, 24))[3] == 255
+    assert out.getpixel((2, 2))[3] == 0
@@ -0,0 +1,142 @@
+import base64
+import io
+import json
+
+import numpy as np
+import pytest
+from fastapi.testclient import TestClient
+from PIL import Image
+
+from app import main, pipeline, postprocess, streaming, upstream
+
+
+def _png(seed: int, size=(96, 64)) -> bytes:
+    rng = np.random.default_rng(seed)
+    buf = io.BytesIO()
+    Image.fromarray(rng.integers(40, 220, (size[1], size[0], 3), dtype=np.uint8), "RGB").save(buf, format="PNG")
+    return buf.getvalue()
+
+
+USER = _png(1)
+CLOTHING = _png(2)
+GENERATED = base64.b64encode(_png(3)).decode("ascii")
+
+
+@pytest.fixture
+def client(monkeypatch):
+    calls = {"n": 0, "error": None}
+
+    async def prepare(user_bytes, clothing_bytes=None, garment=None, user_mask=None, clothing_mask=None):
+        return USER, CLOTHING
+
+    async def generate(*args, **kwargs):
+        calls["n"] += 1
+        if calls["error"] is not None:
+            raise calls["error"]
+        return GENERATED
+
+    monkeypatch.setattr(pipeline, "prepare", prepare)
+    monkeypatch.setattr(pipeline, "generate_tryon_image_async", generate)
+    monkeypatch.setattr(pipeline, "_result_cache_enabled", False)
+    monkeypatch.setattr(pipeline, "_max_variants", 2)
+    monkeypatch.setattr(pipeline, "_max_attempts", 1)
+    monkeypatch.setattr(upstream, "hedge_enabled", False)
+    test_client = TestClient(main.app)
+    test_client.calls = calls
+    return test_client
+
+
+def _post(client, headers=None, **form):
+    files = {"user_image": ("u.png", USER, "image/png"), "clothing_image": ("c.png", CLOTHING, "image/png")}
+    data = {"background": "Plain White", "variants": "2", **form}
+    return client.post("/api/tryon", files=files, data=data, headers=headers or {})
+
+
+def _parse_ndjson(body: bytes):
+    events, images, pos = [], [], 0
+    while pos < len(body):
+        end = body.index(b"\n", pos)
+        event = json.loads(body[pos:end])
+        events.append(event)
+        pos = end + 1
+        if event["event"] == "image":
+            images.append(body[pos:pos + event["size"]])
+            pos += event["size"]
+            assert body[pos:pos + 1] == b"\n"
+            pos += 1
+    return events, images
+
+
+def _parse_multipart(body: bytes, boundary: str):
+    delimiter = b"--" + boundary.encode("ascii")
+    assert body.endswith(delimiter + b"--\r\n")
+    parts = []
+    for chunk in body[:-len(delimiter + b"--\r\n")].split(delimiter)[1:]:
+        head, _, payload = chunk[2:].partition(b"\r\n\r\n")
+        headers = dict(line.split(": ", 1) for line in head.decode("ascii").split("\r\n"))
+        assert payload.endswith(b"\r\n")
+        parts.append((headers, payload[:-2]))
+    return parts
+
+
+@pytest.mark.parametrize("requested, accept, mode", [
+    (None, None, "json"),
+    ("NDJSON", None, "ndjson"),
+    (None, "multipart/mixed", "multipart"),
+    (None, "application/x-ndjson, application/json;q=0.5", "ndjson"),
+    ("json", "multipart/mixed", "json"),
+    ("xml", None, None),
+])
+def test_negotiate_mode(requested, accept, mode):
+    assert streaming.negotiate_mode(requested, accept) == mode
+
+
+def test_ndjson_framing(client):
+    resp = _post(client, response_mode="ndjson", image_format="webp", quality="80")
+    assert resp.status_code == 200
+    assert resp.headers["content-type"].startswith("application/x-ndjson")
+    events, images = _parse_ndjson(resp.content)
+    assert [e["event"] for e in events] == ["image", "image", "done"]
+    assert [e["index"] for e in events[:2]] == [0, 1]
+    assert all(e["content_type"] == "image/webp" for e in events[:2])
+    assert events[-1] == {"event": "done", "count": 2}
+    assert all(Image.open(io.BytesIO(img)).format == "WEBP" for img in images)
+
+
+def test_multipart_framing(client):
+    resp = _post(client, headers={"Accept": "multipart/mixed"})
+    assert resp.status_code == 200
+    content_type = resp.headers["content-type"]
+    assert content_type.startswith("multipart/mixed; boundary=")
+    parts = _parse_multipart(resp.content, content_type.split("boundary=", 1)[1])
+    assert len(parts) == 3
+    for index, (headers, payload) in enumerate(parts[:2]):
+        assert headers["Content-Type"] == "image/png"
+        assert headers["X-Variant-Index"] == str(index)
+        assert int(headers["Content-Length"]) == len(payload)
+        assert Image.open(io.BytesIO(payload)).format == "PNG"
+    assert parts[2][0]["Content-Type"] == "application/json"
+    assert json.loads(parts[2][1]) == {"count": 2}
+
+
+def test_images_that_fall_back_to_png_are_labelled_png(client, monkeypatch):
+    monkeypatch.setattr(postprocess, "encode_image", lambda *args, **kwargs: None)
+    resp = _post(client, response_mode="ndjson", image_format="webp")
+    events, images = _parse_ndjson(resp.content)
+    assert all(e["content_type"] == "image/png" for e in events[:2])
+    assert all(Image.open(io.BytesIO(img)).format == "PNG" for img in images)
+
+
+@pytest.mark.parametrize("mode", ["ndjson", "multipart"])
+def test_failure_before_the_first_image_keeps_its_status(client, mode):
+    client.calls["error"] = RuntimeError("Gemini API error: 500")
+    resp = _post(client, response_mode=mode)
+    assert resp.status_code == 500
+    assert resp.json() == {"detail": "Generation failed"}
+
+
+def test_invalid_response_mode(client):
+    resp = _post(client, response_mode="xml")
+    assert resp.status_code == 400
+    assert "response_mode" in resp.json()["detail"]
+    assert client.calls["n"] == 0
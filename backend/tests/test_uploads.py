@@ -0,0 +1,35 @@
+from fastapi import FastAPI, Request
+from fastapi.testclient import TestClient
+
+from app import uploads
+from app.uploads import BodySizeLimitMiddleware
+
+
+def _client(max_bytes, path_limits):
+    app = FastAPI()
+
+    @app.post("/{path:path}")
+    async def echo(request: Request):
+        return {"size": len(await request.body())}
+
+    app.add_middleware(BodySizeLimitMiddleware, max_bytes=max_bytes, path_limits=path_limits)
+    return TestClient(app)
+
+
+def test_path_limits():
+    client = _client(100, {"/api/tryon": 300})
+    assert client.post("/api/jobs", content=b"x" * 100).json() == {"size": 100}
+    assert client.post("/api/jobs", content=b"x" * 101).status_code == 413
+    assert client.post("/api/tryon", content=b"x" * 300).json() == {"size": 300}
+    assert client.post("/api/tryon", content=b"x" * 301).status_code == 413
+
+
+def test_chunked_body_is_counted():
+    client = _client(100, {})
+    assert client.post("/x", content=iter([b"x" * 60, b"x" * 60])).status_code == 413
+
+
+def test_tryon_limit_fits_two_images_and_two_masks():
+    parts = 2 * uploads.max_upload_bytes + 2 * uploads.max_mask_bytes
+    assert uploads.max_tryon_request_bytes > parts
+    assert uploads.max_tryon_request_bytes >= uploads.max_request_bytes
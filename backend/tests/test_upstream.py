@@ -0,0 +1,177 @@
+import asyncio
+
+import pytest
+
+from app import upstream
+from app.upstream import AIMDLimiter, CircuitBreaker
+
+
+@pytest.fixture(autouse=True)
+def fake_time(monkeypatch, clock):
+    monkeypatch.setattr(upstream, "time", clock)
+    return clock
+
+
+def test_breaker_opens_after_threshold_failures(clock):
+    cb = CircuitBreaker("m", threshold=3, cooldown=10)
+    for _ in range(2):
+        cb.record_failure()
+        assert cb.state == "closed"
+        assert cb.allow()
+    cb.record_failure()
+    assert cb.state == "open"
+    assert not cb.allow()
+    assert cb.retry_in() == pytest.approx(10)
+    assert cb.stats()["short_circuited"] == 1
+
+
+def test_success_resets_the_failure_count():
+    cb = CircuitBreaker("m", threshold=3, cooldown=10)
+    cb.record_failure()
+    cb.record_failure()
+    cb.record_success()
+    cb.record_failure()
+    cb.record_failure()
+    assert cb.state == "closed"
+
+
+def test_half_open_lets_one_probe_through(clock):
+    cb = CircuitBreaker("m", threshold=1, cooldown=10)
+    cb.record_failure()
+    clock.advance(10)
+    assert cb.allow()
+    assert cb.state == "half_open"
+    assert not cb.allow()
+    cb.record_success()
+    assert cb.state == "closed"
+    assert cb.allow() and cb.allow()
+
+
+def test_failed_probe_doubles_the_cooldown(clock):
+    cb = CircuitBreaker("m", threshold=1, cooldown=10)
+    cb.record_failure()
+    clock.advance(10)
+    assert cb.allow()
+    cb.record_failure()
+    assert cb.state == "open"
+    assert cb.retry_in() == pytest.approx(20)
+    clock.advance(19)
+    assert not cb.allow()
+    clock.advance(1)
+    assert cb.allow()
+    cb.record_success()
+    assert cb.cooldown == 10
+
+
+def test_cooldown_is_capped():
+    cb = CircuitBreaker("m", threshold=1, cooldown=10)
+    cb.record_failure()
+    for _ in range(10):
+        cb.state = "half_open"
+        cb.record_failure()
+    assert cb.cooldown == 160
+
+
+def test_retry_after_extends_the_cooldown():
+    cb = CircuitBreaker("m", threshold=1, cooldown=10)
+    cb.record_failure(retry_after=45)
+    assert cb.retry_in() == pytest.approx(45)
+
+
+def test_released_probe_allows_another():
+    cb = CircuitBreaker("m", threshold=1, cooldown=0)
+    cb.record_failure()
+    assert cb.allow()
+    assert not cb.allow()
+    cb.release_probe()
+    assert cb.allow()
+
+
+def _acquire(limiter: AIMDLimiter, n: int = 1) -> None:
+    async def run():
+        for _ in range(n):
+            await limiter.acquire(timeout=0.01)
+
+    asyncio.run(run())
+
+
+def test_limiter_grows_by_about_one_per_window():
+    limiter = AIMDLimiter(initial=4, min_limit=1, max_limit=64)
+    for _ in range(4):
+        _acquire(limiter)
+        limiter.release(latency=1.0, success=True)
+    assert limiter.limit == pytest.approx(5, abs=0.2)
+
+
+def test_limiter_halves_on_overload_once_per_cooldown(clock):
+    limiter = AIMDLimiter(initial=16, min_limit=1, max_limit=64, cooldown=1.0)
+    _acquire(limiter, 2)
+    limiter.release(overloaded=True)
+    assert limiter.limit == 8
+    limiter.release(overloaded=True)
+    assert limiter.limit == 8
+    clock.advance(1.0)
+    _acquire(limiter)
+    limiter.release(overloaded=True)
+    assert limiter.limit == 4
+    assert limiter.stats()["decreases"] == 2
+
+
+@pytest.mark.parametrize("status", [400, 404, 500])
+def test_failed_calls_do_not_grow_the_limit(status):
+    limiter = AIMDLimiter(initial=4, min_limit=1, max_limit=64)
+    for _ in range(8):
+        _acquire(limiter)
+        limiter.release(latency=0.05, overloaded=status in upstream.TRANSIENT_STATUSES, success=False)
+    assert limiter.limit <= 4
+    # Fast errors do not drag down the latency baseline either
+    assert limiter.stats()["avg_latency_s"] is None
+
+
+def test_limiter_halves_on_slow_calls():
+    limiter = AIMDLimiter(initial=16, min_limit=1, max_limit=64, latency_tolerance=3.0)
+    _acquire(limiter)
+    limiter.release(latency=1.0, success=True)
+    before = limiter.limit
+    _acquire(limiter)
+    limiter.release(latency=10.0, success=True)
+    assert limiter.limit == pytest.approx(before / 2)
+
+
+def test_limiter_stays_within_bounds(clock):
+    limiter = AIMDLimiter(initial=2, min_limit=2, max_limit=3)
+    for _ in range(5):
+        _acquire(limiter)
+        limiter.release(overloaded=True)
+        clock.advance(2)
+    assert limiter.limit == 2
+    for _ in range(50):
+        _acquire(limiter)
+        limiter.release(latency=1.0, success=True)
+    assert limiter.limit == 3
+
+
+def test_limiter_rejects_when_full():
+    limiter = AIMDLimiter(initial=1, min_limit=1, max_limit=1)
+    _acquire(limiter)
+    with pytest.raises(upstream.UpstreamBusy):
+        _acquire(limiter)
+    assert limiter.stats()["rejected"] == 1
+    limiter.release(latency=1.0, success=True)
+    _acquire(limiter)
+    assert limiter.stats()["in_flight"] == 1
+
+
+def test_release_hands_the_slot_to_a_waiter():
+    limiter = AIMDLimiter(initial=1, min_limit=1, max_limit=1)
+
+    async def run():
+        await limiter.acquire(timeout=1)
+        waiter = asyncio.ensure_future(limiter.acquire(timeout=1))
+        await asyncio.sleep(0)
+        assert limiter.stats()["queued"] == 1
+        limiter.release(latency=1.0, success=True)
+        await waiter
+
+    asyncio.run(run())
+    assert limiter.stats()["in_flight"] == 1
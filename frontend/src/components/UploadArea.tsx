@@ -1,29 +1,40 @@
-import { useCallback, useState } from 'react'
+import { useCallback, useRef, useState } from 'react'
 import { UploadCloud, Image as ImageIcon } from 'lucide-react'
 
 export default function UploadArea({
   label,
   onFile,
   accept = 'image/*',
+  prepare,
 }: {
   label: string
   onFile: (file: File | null) => void
   accept?: string
+  // Runs once when a file is picked (e.g. resize before upload); its result is what onFile gets
+  prepare?: (file: File) => Promise<File>
 }) {
   const [isDragging, setIsDragging] = useState(false)
   const [preview, setPreview] = useState<string | null>(null)
+  // Bumped on every pick, so a slow prepare() for an earlier file cannot overwrite a later one
+  const latest = useRef(0)
 
-  const handleFiles = useCallback((files: FileList | null) => {
+  const handleFiles = useCallback(async (files: FileList | null) => {
+    const request = ++latest.current
     const file = files?.[0]
     if (!file) {
       onFile(null)
       setPreview(null)
       return
     }
-    onFile(file)
-    const url = URL.createObjectURL(file)
-    setPreview(url)
-  }, [onFile])
+    const ready = prepare ? await prepare(file).catch(() => file) : file
+    if (request !== latest.current) return
+    onFile(ready)
+    const url = URL.createObjectURL(ready)
+    setPreview((prev) => {
+      if (prev) URL.revokeObjectURL(prev)
+      return url
+    })
+  }, [onFile, prepare])
 
   return (
     <div
@@ -0,0 +1,83 @@
+// Client-side upload preparation: orient, resize to the server's MAX_DIM and re-encode
+// before /api/tryon, so uploads are small and the server skips its own downscale.
+
+export type UploadConfig = {
+  max_dim: number
+  format: string
+  quality: number
+  mask_format?: string
+  accepts_masks?: boolean
+  max_upload_bytes?: number
+  max_mask_bytes?: number
+}
+
+// Matches the backend defaults, for servers that do not publish /api/upload-config
+const DEFAULT_CONFIG: UploadConfig = { max_dim: 1536, format: 'image/jpeg', quality: 0.9 }
+
+const configs = new Map<string, Promise<UploadConfig>>()
+
+export function loadUploadConfig(apiBase: string): Promise<UploadConfig> {
+  let config = configs.get(apiBase)
+  if (!config) {
+    config = fetch(`${apiBase}/api/upload-config`)
+      .then((res) => (res.ok ? res.json() : DEFAULT_CONFIG))
+      .then((data) => ({ ...DEFAULT_CONFIG, ...data }))
+      .catch(() => DEFAULT_CONFIG)
+    configs.set(apiBase, config)
+  }
+  return config
+}
+
+function draw(ctx: OffscreenCanvasRenderingContext2D | CanvasRenderingContext2D, bitmap: ImageBitmap, width: number, height: number, opaque: boolean) {
+  if (opaque) {
+    // JPEG has no alpha: flatten transparent garments onto white rather than black
+    ctx.fillStyle = '#fff'
+    ctx.fillRect(0, 0, width, height)
+  }
+  ctx.imageSmoothingQuality = 'high'
+  ctx.drawImage(bitmap, 0, 0, width, height)
+}
+
+async function encode(bitmap: ImageBitmap, width: number, height: number, type: string, quality: number): Promise<Blob | null> {
+  const opaque = type === 'image/jpeg'
+  if (typeof OffscreenCanvas !== 'undefined') {
+    const canvas = new OffscreenCanvas(width, height)
+    const ctx = canvas.getContext('2d')
+    if (!ctx) return null
+    draw(ctx, bitmap, width, height, opaque)
+    return canvas.convertToBlob({ type, quality }).catch(() => null)
+  }
+  const canvas = document.createElement('canvas')
+  canvas.width = width
+  canvas.height = height
+  const ctx = canvas.getContext('2d')
+  if (!ctx) return null
+  draw(ctx, bitmap, width, height, opaque)
+  return new Promise<Blob | null>((resolve) => canvas.toBlob(resolve, type, quality))
+}
+
+// Returns the file to upload: upright (EXIF orientation applied), at most max_dim on the
+// longest side, in the server's format. Falls back to the original file if the browser
+// cannot decode or encode it.
+export async function prepareUpload(file: File, apiBase: string): Promise<File> {
+  const config = await loadUploadConfig(apiBase)
+  let bitmap: ImageBitmap
+  try {
+    bitmap = await createImageBitmap(file, { imageOrientation: 'from-image' })
+  } catch {
+    return file
+  }
+  try {
+    const scale = Math.min(1, config.max_dim / Math.max(bitmap.width, bitmap.height))
+    const width = Math.max(1, Math.round(bitmap.width * scale))
+    const height = Math.max(1, Math.round(bitmap.height * scale))
+    const blob = await encode(bitmap, width, height, config.format, config.quality)
+    // Browsers without an encoder for the format silently return PNG
+    if (!blob || blob.type !== config.format) return file
+    const ext = config.format.split('/')[1].replace('jpeg', 'jpg')
+    const name = file.name.replace(/\.[^.]*$/, '') || 'upload'
+    return new File([blob], `${name}.${ext}`, { type: config.format })
+  } finally {
+    bitmap.close()
+  }
+}
@@ -1,7 +1,8 @@
-import React, { useMemo, useRef, useState, useEffect } from 'react'
+import React, { useCallback, useMemo, useRef, useState, useEffect } from 'react'
 import { useAuth } from '../context/AuthContext'
 import { getUserProfile, decrementTrialCredit } from '../firebase'
 import UploadArea from '../components/UploadArea'
+import { loadUploadConfig, prepareUpload } from '../lib/image'
 import { Download, Share2, RotateCcw, AlertCircle } from 'lucide-react'
 import { motion, AnimatePresence } from 'framer-motion'
 
@@ -52,6 +53,12 @@ export default function TryOn() {
 
   const canSubmit = useMemo(() => !!userFile && !!clothFile && !isLoading, [userFile, clothFile, isLoading])
 
+  // Resize and re-encode picked files to the server's target before they are uploaded
+  useEffect(() => {
+    loadUploadConfig(API_BASE)
+  }, [])
+  const prepareFile = useCallback((file: File) => prepareUpload(file, API_BASE), [])
+
   // Load user credits when component mounts or user changes
   useEffect(() => {
     const loadUserCredits = async () => {
@@ -290,12 +297,12 @@ export default function TryOn() {
             <form onSubmit={handleSubmit} className="grid gap-6 rounded-2xl bg-white p-6 shadow-lg border border-gray-100">
               <div className="grid gap-2">
                 <label className="text-sm font-medium">Upload your photo</label>
-                <UploadArea label="Your photo" onFile={(f) => setUserFile(f)} />
+                <UploadArea label="Your photo" onFile={(f) => setUserFile(f)} prepare={prepareFile} />
               </div>
 
               <div className="grid gap-2">
                 <label className="text-sm font-medium">Upload clothing image</label>
-                <UploadArea label="Clothing image" onFile={(f) => setClothFile(f)} />
+                <UploadArea label="Clothing image" onFile={(f) => setClothFile(f)} prepare={prepareFile} />
               </div>
 
               <div className="grid gap-2">